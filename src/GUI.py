@@ -1,24 +1,26 @@
-import seabreeze
-seabreeze.use('pyseabreeze')
+'''
+Phenocart acquisition GUI
+the device drivers (seabreeze, LabJack u6, pyserial, PyTables) are imported when a subsystem is first used,
+so the window appears right away, python import_report.py GUI shows what the startup still imports
+'''
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
-from seabreeze.spectrometers import Spectrometer
 from pathlib import Path
 from threading import Event,Lock,Thread
 import threading
+import logging
 from rtk_gps import reach_rover
 from enum import Enum
-from time import sleep
-import numpy as np
-import serial
+from time import time
+import numpy as np #also needed at startup by recent_data, metrics and rtk_gps, see import_report.py
 from os import environ
-from serial.tools.list_ports import comports
 from utils import get_unique_filepath_from_string,SensorOrientation,SensorPosition
-from HDX_spec import HDXXR_spectrometer,HDX_reflectance_module,save_raw_spectra
-from IRR_labjack import log_temperatures
-from sdi12_sensors import make_ndvi_pairs,make_pri_pairs,log_ndvi_pri
+from recent_data import recent
+from live_plots import LivePlot
+from metrics import serve_metrics,log_summary_every
 
+log = logging.getLogger(__name__)
 
 class colors(Enum):
     RED = 0 
@@ -59,7 +61,7 @@ class MainApp(tk.Frame):
         self.gps_frame_container.grid(row=3,column=1,sticky=(tk.W,tk.E) ) #type: ignore
         ttk.Label(self,text='Puerto COM').grid(row=2,column=0)
         self.com_port_str = tk.StringVar()
-        self.COM_port_combo = ttk.Combobox(self,textvariable=self.com_port_str,values=[x.name for x in comports()],state='readonly')
+        self.COM_port_combo = ttk.Combobox(self,textvariable=self.com_port_str,state='readonly',postcommand=self.refresh_com_ports)
         self.COM_port_combo.bind('<<ComboboxSelected>>',self.select_comport_callback)
         self.COM_port_combo.grid(row=2,column=1,sticky=tk.W)
         self.connect_gps_bttn = ttk.Button(self.gps_frame_container,text='Conectar GPS',command=self.gps_connect_callback)
@@ -81,8 +83,23 @@ class MainApp(tk.Frame):
         self.spec_calibrated = False
         self.bind('<Destroy>',self.safe_exit) 
 
+        #live plots, refreshed from the Tk event loop with the recent data kept in memory by the loggers
+        self.plot_window_s = 300
+        self.plot_refresh_ms = 1000
+        self.live_frame = ttk.LabelFrame(self,text='En vivo')
+        self.live_frame.grid(row=0,column=2,rowspan=6,sticky=(tk.N,tk.S)) #type: ignore
+        self.temperature_plot = LivePlot(self.live_frame,'Temperatura objetivo (°C)')
+        self.temperature_plot.grid(row=0,column=0)
+        self.reflectance_plot = LivePlot(self.live_frame,'Reflectancia (%)')
+        self.reflectance_plot.grid(row=0,column=1)
+        self.ndvi_plot = LivePlot(self.live_frame,'NDVI')
+        self.ndvi_plot.grid(row=1,column=0)
+        self.pri_plot = LivePlot(self.live_frame,'PRI')
+        self.pri_plot.grid(row=1,column=1)
+
         for child in self.winfo_children():
             child.grid_configure(padx=5,pady=5)
+        self.refresh_plots()
 
     def select_directory(self):
         d = filedialog.askdirectory(initialdir=Path(environ['USERPROFILE']))
@@ -103,8 +120,7 @@ class MainApp(tk.Frame):
         if not self.gps_connected and not (self.gps is None):
             try:
                 tf = self.gps.spin()
-                f = Thread(target=self.seek_gps_status,daemon=True,args=(tf,) )
-                f.start()
+                self.seek_gps_status(tf)
                 self.connect_gps_bttn.config(text='Desconectar GPS')
                 self.gps_connected = True
             except Exception as e:
@@ -122,24 +138,50 @@ class MainApp(tk.Frame):
                 self.gps_connected = False
     
     def seek_gps_status(self,tf):
-        while True:
-            if tf.is_alive():
-                c = self.gps.coordinates
-                if c['metadata'][1] is None:
-                    self.status_color_label.config( background=colors(0).name )
-                else:
-                    # print(c['coordinates'])
-                    color = int( c['metadata'][1] )
-                    self.status_color_label.config( background=colors(color).name )
+        '''updates the fix quality color every second, scheduled with after() so widgets are only touched by the Tk thread'''
+        if tf.is_alive():
+            position = self.gps.coordinates_with_meta
+            if position is None:
+                self.status_color_label.config( background=colors(0).name )
             else:
-                self.status_color_label.config( background=colors(6).name )
-                self.connect_gps_bttn.config(text='Conectar GPS')
-                break
-            sleep(1)
+                self.status_color_label.config( background=colors(position.quality_fix).name )
+            self.after(1000,self.seek_gps_status,tf)
+        else:
+            self.status_color_label.config( background=colors(6).name )
+            self.connect_gps_bttn.config(text='Conectar GPS')
+
+    def refresh_plots(self):
+        '''redraws the live plots with the last plot_window_s seconds of data, then schedules itself again'''
+        now = time()
+        x_range = (-self.plot_window_s,0)
+        temperatures = recent.temperatures.window(now-self.plot_window_s)
+        self.temperature_plot.plot({unit:(temperatures['timestamp'][temperatures['sensor_id'] == unit]-now,
+                                          temperatures['target_temp_C'][temperatures['sensor_id'] == unit])
+                                    for unit in np.unique(temperatures['sensor_id'])},x_range,'s')
+        indices = recent.indices.window(now-self.plot_window_s)
+        for plot,index_type in ((self.ndvi_plot,'NDVI'),(self.pri_plot,'PRI')):
+            rows = indices[indices['type'] == index_type]
+            plot.plot({position:(rows['timestamp'][rows['sensor_position'] == position]-now,rows['index_value'][rows['sensor_position'] == position])
+                       for position in np.unique(rows['sensor_position'])},x_range,'s')
+        reflectance = {}
+        uplooking = recent.latest_spectra.get(SensorOrientation.UPLOOKING.name)
+        if self.spec_calibrated and uplooking is not None:
+            for module in self.hdx_modules:
+                downlooking = recent.latest_spectra.get(module.Position.name.upper())
+                if downlooking is not None:
+                    reflectance[module.Position.name.upper()] = (module.band_centers,module.reflectance(uplooking[1],downlooking[1]))
+        self.reflectance_plot.plot(reflectance,x_label='nm')
+        self.after(self.plot_refresh_ms,self.refresh_plots)
+
+    def refresh_com_ports(self):
+        '''lists the serial ports when the combobox opens, also finds adapters plugged after startup'''
+        from serial.tools.list_ports import comports
+        self.COM_port_combo['values'] = [x.name for x in comports()]
 
     def call_log_temperatures(self):
         if not self.temp_logging:
             try:
+                from IRR_labjack import log_temperatures #LabJack driver, imported on the first start
                 self.irr_stop_event.clear()
                 trial_name = self.name_suffix.get()
                 filepath = get_unique_filepath_from_string(self.wd,trial_name,'temp','.txt')
@@ -164,9 +206,12 @@ class MainApp(tk.Frame):
             self.start_temp_bttn.config(text="Start temp")
 
     def call_log_sdi12(self):
-        serial_port = serial.Serial()
         if not self.sdi12_logging:
+            serial_port = None
             try:
+                import serial #pyserial and the SDI-12 module, imported on the first start
+                from sdi12_sensors import make_ndvi_pairs,make_pri_pairs,log_ndvi_pri
+                serial_port = serial.Serial()
                 self.sdi12_stop_event.clear()
                 # serial_port = serial.Serial('COM15',19200,timeout=5)
                 serial_port.baudrate = 19200
@@ -190,19 +235,19 @@ class MainApp(tk.Frame):
                 print("Error logging NDVI/PRI")
                 self.sdi12_logging = False
                 self.start_sdi12_bttn.config(text="Start SDI12")
-                if serial_port.is_open:
+                if serial_port is not None and serial_port.is_open:
                     serial_port.close()
                     
         else:
             self.sdi12_stop_event.set()
             self.sdi12_logging = False
             self.start_sdi12_bttn.config(text="Start SDI12")
-            if serial_port.is_open:
-                serial_port.close()
 
     def calibrate_hdx_modules(self):
         try:
             if not self.spec_modules_created:
+                from HDX_spec import HDXXR_spectrometer,HDX_reflectance_module #selects the pyseabreeze backend
+                from seabreeze.spectrometers import Spectrometer
                 HDX_uplooking = HDXXR_spectrometer(Spectrometer.from_serial_number(self.hdx_uplooking['serial_number']),integration_time_ms = 25,boxcar_size=1,position=self.hdx_uplooking['position'],orientation=self.hdx_uplooking['orientation'])
                 HDX_downlooking = [HDXXR_spectrometer(Spectrometer.from_serial_number(device['serial_number']),integration_time_ms = 6,boxcar_size=1,position=device['position'],orientation=device['orientation'])
                                     for device in self.hdx_downlooking]
@@ -239,6 +284,7 @@ class MainApp(tk.Frame):
                 else:
                     print("Warning: El GPS no se ha conectado, las coordenadas son inválidas")
                     gps = None
+                from HDX_spec import save_raw_spectra
                 save_raw_spectra(filepath,self.spec_stop_event,self.hdx_modules,gps)
                 self.spec_logging = True
                 self.start_spec_bttn.config(text="Stop spec")
@@ -269,6 +315,15 @@ class MainApp(tk.Frame):
                 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    ## acquisition metrics at http://127.0.0.1:9108/metrics and a summary line in the log every minute
+    try:
+        metrics_server = serve_metrics(9108)
+    except OSError as e: #port in use, e.g. by another GUI
+        log.warning('metrics endpoint not started: %s',e)
+        metrics_server = None
+    metrics_stop_event = Event()
+    log_summary_every(60,metrics_stop_event)
     shared_lock = Lock()
 
     ## RTK-GPS configuration
@@ -323,3 +378,6 @@ if __name__ == '__main__':
     finally:
         if not(rtk_rover is None):
             rtk_rover.stop()
+        metrics_stop_event.set()
+        if metrics_server:
+            metrics_server.shutdown()
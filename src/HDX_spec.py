@@ -3,17 +3,25 @@ import seabreeze
 seabreeze.use('pyseabreeze')
 from math import trunc
 from pathlib import Path
-from datetime import datetime
 import time
 import itertools
-from rtk_gps import reach_rover
-from threading import Thread,Event
+import logging
+from rtk_gps import reach_rover,Position
+from threading import Thread,Event,Lock
+from queue import Queue,Full,Empty
+from concurrent.futures import ThreadPoolExecutor
 import tables
 from seabreeze.spectrometers import Spectrometer
 from utils import SensorOrientation,SensorPosition,get_unique_filepath_from_string
+from recent_data import recent
+from acquisition_clock import acquisition_clock
+from metrics import stage_timer,observe,count
+from dark_current import DarkCurrentModel,dark_models,detector_temperature_C
 
 pixel_number = 2068
 
+log = logging.getLogger(__name__)
+
 class SpectrometerTable(tables.IsDescription):
     index = tables.Int32Col(pos=0)
     integration_time_ms = tables.Float32Col(pos=1)
@@ -33,6 +41,7 @@ def threaded(fn):
     return wrapper
 
 class HDXXR_spectrometer():
+    last_optimal = {} #{serial number:(integration time ms,count offset)} warm start of optimize
     def __init__(self,spec:Spectrometer,integration_time_ms:int=100,scans_to_average:int=3,boxcar_size:int=0,orientation:SensorOrientation=SensorOrientation.UNDEFINED,position:SensorPosition=SensorPosition.UPSIDE) -> None:
         self.spec = spec
         self.max_integration_time_ms = 10000
@@ -41,16 +50,91 @@ class HDXXR_spectrometer():
         self._optimal_integration_time_us = integration_time_ms*1000 #this line might be redundant
         self.integration_time_ms = integration_time_ms
         self.optimized = False
+        self._warned_not_optimized = False
         self.scans_to_avg = scans_to_average #increases signal to noise ratio
         self.boxcar_size = boxcar_size
         self.orientation = orientation
         self.position = position
+        self._scan_lock = Lock()
+        self._scan_sum = None #preallocated scan accumulator
+        self._scan_cumsum = None #preallocated boxcar buffer
+        self._wavelengths_cache = None #(boxcar_size,wavelengths)
+        self._probes = 0
+        self.optimization_stats = None
 
-    def optimize(self,start_integration_time_ms=None,saturation_counts=52000,max_iterations = 50,max_err = 0.005):        
+    def optimize(self,start_integration_time_ms=None,saturation_counts=52000,max_iterations = 10,max_err = 0.005,scans_per_probe = 2):
         '''
         This method will find the optimal integration time for the spectrometer
+        counts are close to linear with the integration time below saturation (counts = offset + slope*t),
+        every probe refines a least squares fit of that line and the next probe goes where the line meets saturation_counts.
+        Probes that saturate the detector are not fitted, they only bound the search (bisection fallback).
+        The search warm-starts from the last optimal value and offset found for the same device serial number.
+          saturation_counts: number of counts that saturates the sensor at 85 % of the dynamic range
+          scans_per_probe: scans taken per probe, only the last one is used (the first scan after a change may be stale)
+        Number of probes and wall time are kept in self.optimization_stats
+        '''
+        if max_iterations < 1:
+            raise ValueError('max_iterations must be at least 1')
+        start = time.perf_counter()
+        self._probes = 0
+        hard_saturation = 0.98*getattr(self.spec,'max_intensity',65535)
+        warm_start = HDXXR_spectrometer.last_optimal.get(getattr(self.spec,'serial_number',None))
+        if start_integration_time_ms is None:
+            start_integration_time_ms = warm_start[0] if warm_start else self.integration_time_ms
+        offset = warm_start[1] if warm_start else 0.0
+        low,high = self.min_integration_time_ms,self.max_integration_time_ms #search bracket in ms
+        t = min(max(start_integration_time_ms,low),high)
+        points = [] #unsaturated (integration time ms, max count)
+        for i in range(max_iterations):
+            t = probed_ms = round(float(t),3) #microsecond resolution
+            count = float(self.get_max_count(int(t*1000),scans_per_probe))
+            if count >= hard_saturation: #outside the linear range, geometric bisection
+                high = t
+                t_next = (low*high)**0.5
+            else:
+                points.append((t,count))
+                if abs(count-saturation_counts)/saturation_counts < max_err:
+                    break
+                if count < saturation_counts:
+                    low = t
+                    if t >= self.max_integration_time_ms:
+                        log.warning("max integration time reached")
+                        break
+                else:
+                    high = t
+                if len(points) >= 2:
+                    slope,offset = np.polyfit(*zip(*points[-3:]),1)
+                else:
+                    slope = (count-offset)/t
+                t_next = (saturation_counts-offset)/slope if slope > 0 else 2*t
+                if t_next >= self.max_integration_time_ms and high == self.max_integration_time_ms:
+                    t_next = self.max_integration_time_ms
+                elif not (low < t_next < high): #the line disagrees with the bracket
+                    t_next = (low+high)/2
+            t = t_next
+        else:
+            log.warning("maximun iterations reached with %s at %s ms",count,probed_ms)
+        if points:
+            t,count = min(points,key=lambda p:abs(p[1]-saturation_counts))
+            t = float(t)
+            if len(points) >= 2:
+                slope,offset = np.polyfit(*zip(*points[-3:]),1)
+        else:
+            t = self.min_integration_time_ms
+        log.info("optimal integration time:%s ms, %s counts, %s probes",t,count,self._probes)
+        self.integration_time_ms = t
+        self.optimized = True
+        HDXXR_spectrometer.last_optimal[getattr(self.spec,'serial_number',None)] = (t,offset)
+        self.optimization_stats = {'method':'model','probes':self._probes,'wall_time_s':time.perf_counter()-start,'integration_time_ms':t}
+        return
+
+    def optimize_bisection(self,start_integration_time_ms=None,saturation_counts=52000,max_iterations = 50,max_err = 0.005):
+        '''
+        This method will find the optimal integration time for the spectrometer by doubling and bisection
           saturation_counts: number of counts that saturates the sensor at 85 % of the dynamic range
         '''
+        start = time.perf_counter()
+        self._probes = 0
         if start_integration_time_ms is None:
             start_integration_time_ms = self.integration_time_ms
 
@@ -64,21 +148,22 @@ class HDXXR_spectrometer():
             while True:
                 max_count = self.get_max_count(b*1000)
                 if max_count >= saturation_counts:
-                    print(f'{b} gets {self.get_max_count(b*1000)} counts')
+                    log.debug('%s gets %s counts',b,self.get_max_count(b*1000))
                     break
                 else:
                     a = b
                     b = 2*a
                     if b > self.max_integration_time_ms:
                         b = self.max_integration_time_ms
-                        print("Warning: max integration time reached")
+                        log.warning("max integration time reached")
                         break
-        print(f'start bisect with: {a} , {b}')
+        log.debug('start bisect with: %s , %s',a,b)
         optimal_integration_time_ms = self.bisect(a,b,saturation_counts,max_iterations,max_err)
         # self._optimal_integration_time_us = trunc(optimal_integration_time_ms)*1000
         self.integration_time_ms = trunc(optimal_integration_time_ms)
         self.optimized = True
         # self.spec.integration_time_micros(self.integration_time_ms*1000)
+        self.optimization_stats = {'method':'bisection','probes':self._probes,'wall_time_s':time.perf_counter()-start,'integration_time_ms':self.integration_time_ms}
         return
 
     def bisect(self,a,b,f_root,max_iterations, err):
@@ -87,9 +172,9 @@ class HDXXR_spectrometer():
             m = (a+b)/2 #m is in milliseconds
             max_count_m = self.get_max_count(trunc(m)*1000)
             error_m = abs((f_root - max_count_m)/f_root)
-            print(f"m: {m} ms, {max_count_m}:counts, error:{error_m} ")
+            log.debug("m: %s ms, %s:counts, error:%s",m,max_count_m,error_m)
             if error_m < err:
-                print(f"optimal integration time:{m}, {max_count_m}:counts, error:{error_m} ")
+                log.info("optimal integration time:%s, %s:counts, error:%s",m,max_count_m,error_m)
                 break
             else:
                 if max_count_m > f_root: #root is on the left side
@@ -99,41 +184,99 @@ class HDXXR_spectrometer():
                     a = m
                     b = b
             if next(iteration) >= max_iterations:
-                print(f"Maximun iterations reached with {max_count_m} at {m} ms ")
+                log.warning("maximun iterations reached with %s at %s ms",max_count_m,m)
                 break
         return(m)
 
+    def acquire(self):
+        '''returns (start timestamp,end timestamp,spectra,integration time ms) of one averaged spectrum'''
+        start = time.time()
+        spectra = self.spectra
+        return (start,time.time(),spectra,self.integration_time_ms)
+
     @property
     def spectra(self):
-        if self.optimized == False:
-            print("Warning: Spectrometer not optimized")
-        raw_spectras = np.array([self.spec.intensities(correct_nonlinearity=True) for i in range(self.scans_to_avg)])
-        spectra_avg = np.mean(raw_spectras,axis=0)
-        spectra_boxcar = np.convolve(spectra_avg, np.ones(self.boxcar_size)/self.boxcar_size, mode='valid')
-        return spectra_boxcar
-    
+        if self.optimized == False and not self._warned_not_optimized: #once, this runs on every frame
+            log.warning("spectrometer %s not optimized",self.position.name)
+            self._warned_not_optimized = True
+        with self._scan_lock:
+            scan = self.spec.intensities(correct_nonlinearity=True)
+            if self._scan_sum is None or self._scan_sum.shape != scan.shape:
+                self._scan_sum = np.empty(scan.shape,dtype=np.float64)
+                self._scan_cumsum = np.zeros(scan.shape[0]+1,dtype=np.float64)
+            np.copyto(self._scan_sum,scan)
+            for i in range(self.scans_to_avg-1):
+                np.add(self._scan_sum,self.spec.intensities(correct_nonlinearity=True),out=self._scan_sum)
+            self._scan_sum /= self.scans_to_avg
+            return self.boxcar(self._scan_sum,self._scan_cumsum)
+
+    def boxcar(self,values:np.ndarray,cumsum:np.ndarray=None) -> np.ndarray:
+        '''moving average of boxcar_size points (same result as np.convolve mode='valid') using a cumulative sum, O(n) for any boxcar size
+        cumsum: optional preallocated buffer of len(values)+1'''
+        if self.boxcar_size <= 1:
+            return values.copy()
+        if cumsum is None:
+            cumsum = np.zeros(values.shape[0]+1,dtype=np.float64)
+        cumsum[0] = 0.0
+        np.cumsum(values,out=cumsum[1:])
+        smoothed = cumsum[self.boxcar_size:] - cumsum[:-self.boxcar_size]
+        smoothed /= self.boxcar_size
+        return smoothed
+
     @property
     def wavelengths(self):
-        raw_wavelengths = self.spec.wavelengths()
-        wavelengths_box = np.convolve(raw_wavelengths, np.ones(self.boxcar_size)/self.boxcar_size, mode='valid')
-        return wavelengths_box
-    
+        '''device wavelengths after the boxcar, queried once per boxcar size and cached (read only)'''
+        if self._wavelengths_cache is None or self._wavelengths_cache[0] != self.boxcar_size:
+            wavelengths_box = self.boxcar(np.asarray(self.spec.wavelengths(),dtype=np.float64))
+            wavelengths_box.flags.writeable = False
+            self._wavelengths_cache = (self.boxcar_size,wavelengths_box)
+        return self._wavelengths_cache[1]
+
     @property
     def integration_time_ms(self):
         return self._optimal_integration_time_us/1000
     
     @integration_time_ms.setter
     def integration_time_ms(self,integration_time_ms):
-        self._optimal_integration_time_us = integration_time_ms*1000
+        self._optimal_integration_time_us = int(round(integration_time_ms*1000))
         self.spec.integration_time_micros(self._optimal_integration_time_us)
     
-    def get_max_count(self,integration_time_us:int):
+    def capture_dark_model(self,integration_times_ms:list[float]=None) -> DarkCurrentModel:
+        '''captures dark spectra at several integration times and fits the dark current model, the fiber must be covered
+        by default the current integration time and 1/4, 1/2, 2 and 4 times it within the device limits'''
+        current_ms = self.integration_time_ms
+        if integration_times_ms is None:
+            integration_times_ms = sorted({min(max(current_ms*k,self.min_integration_time_ms),self.max_integration_time_ms) for k in (0.25,0.5,1,2,4)})
+        dark_spectra = []
+        try:
+            for t in integration_times_ms:
+                self.integration_time_ms = t
+                self.spec.intensities(correct_nonlinearity=True) #the first scan after a change may be stale
+                dark_spectra.append(self.spectra)
+        finally:
+            self.integration_time_ms = current_ms
+        serial_number = getattr(self.spec,'serial_number',None)
+        model = DarkCurrentModel.fit(integration_times_ms,dark_spectra,detector_temperature_C(self.spec),serial_number)
+        dark_models[serial_number] = model
+        log.info('dark model of %s: %d integration times, fit rms %.1f counts',serial_number,len(integration_times_ms),model.residual_counts)
+        return model
+
+    @property
+    def dark_model(self) -> DarkCurrentModel|None:
+        '''cached dark model of the device, None if there is none, the detector temperature moved since its capture
+        or, without a temperature, it is older than dark_current.max_age_s'''
+        model = dark_models.get(getattr(self.spec,'serial_number',None))
+        if model is None or not model.valid_for(detector_temperature_C(self.spec)):
+            return None
+        return model
+
+    def get_max_count(self,integration_time_us:int,scans:int=3):
+        self._probes += 1
         self.spec.integration_time_micros(integration_time_us)
-        max_counts = [self.spec.intensities(correct_nonlinearity=False).max() for i in range(3)] #to do: check how to overcome sensor stabilization
+        max_counts = [self.spec.intensities(correct_nonlinearity=False).max() for i in range(scans)] #to do: check how to overcome sensor stabilization
         # spectra = self.spec.intensities(correct_nonlinearity=False)
         max_count = np.array(max_counts)[-1]
-        print(max_counts)
-        print(f'{integration_time_us/1000} ms gets {max_count} counts')
+        log.debug('%s ms gets %s counts %s',integration_time_us/1000,max_count,max_counts)
         return max_count
     
 class HDXXR_pair():
@@ -156,7 +299,7 @@ class HDXXR_pair():
         self.white_cal_wavelengths = white_cal_wavelengths
         self.white_cal_reflectance = white_cal_reflectance
         if self.band_centers is None:
-            print('Warning: band centers not defined, using downlooking spectrometer wavelengths instead')
+            log.warning('band centers not defined, using downlooking spectrometer wavelengths instead')
             self.calibration_panel_reflectance = np.interp(self.downlooking_spec.wavelengths,white_cal_wavelengths,white_cal_reflectance)
         else:
             self.calibration_panel_reflectance = np.interp(self.band_centers,white_cal_wavelengths,white_cal_reflectance)
@@ -179,17 +322,21 @@ class HDXXR_pair():
         if optimize_downlooking:
             self.downlooking_spec.optimize()
         self.downlooking_white_ref = self.downlooking_spec.spectra
-        input("Cubre cuidadosamente la punta de la fibra óptica con DIFUSOR DE COSENO y presiona <ENTER> para continuar")
-        self.uplooking_dark_ref = self.uplooking_spec.spectra
-        input(f"Cubre cuidadosamente la punta de la fibra óptica en la posición: {self.downlooking_spec.position.name} y presiona <ENTER> para continuar")
-        self.downlooking_dark_ref = self.downlooking_spec.spectra
+        #the fibers are only covered when there is no valid dark model for the device (see dark_current)
+        if self.uplooking_spec.dark_model is None:
+            input("Cubre cuidadosamente la punta de la fibra óptica con DIFUSOR DE COSENO y presiona <ENTER> para continuar")
+            self.uplooking_spec.capture_dark_model()
+        if self.downlooking_spec.dark_model is None:
+            input(f"Cubre cuidadosamente la punta de la fibra óptica en la posición: {self.downlooking_spec.position.name} y presiona <ENTER> para continuar")
+            self.downlooking_spec.capture_dark_model()
+        self.update_dark_references()
 
         # This section is only for live visualization of canopy reflectance purposes, to do: refactor this section
         cal_incident_irradiance = self.uplooking_white_ref - self.uplooking_dark_ref
         cal_upwelling_radiance = self.downlooking_white_ref - self.downlooking_dark_ref
 
         if self.band_centers is None:
-            print('Warning: band centers not defined, using downlooking spectrometer wavelengths instead')
+            log.warning('band centers not defined, using downlooking spectrometer wavelengths instead')
             cal_incident_irradiance = np.interp(self.downlooking_spec.wavelengths,self.uplooking_spec.wavelengths,cal_incident_irradiance)
         else:
             cal_incident_irradiance = np.interp(self.band_centers,self.uplooking_spec.wavelengths,cal_incident_irradiance)
@@ -198,26 +345,36 @@ class HDXXR_pair():
         self.correction_factors = cal_incident_irradiance/cal_upwelling_radiance
         print(f"Calibración {current_pair_position} completa\n")
     
+    def update_dark_references(self):
+        '''dark references at the current integration times from the dark models, e.g. after optimize changed them'''
+        for spec,name in ((self.uplooking_spec,'uplooking_dark_ref'),(self.downlooking_spec,'downlooking_dark_ref')):
+            model = spec.dark_model
+            if model is not None:
+                setattr(self,name,model.dark(spec.integration_time_ms))
+
     #just for visualization purposes
     @property
     def reflectance_spectra(self):
         if self.correction_factors is None:
-            print("Please run inter_calibrate first")
+            log.error("please run inter_calibrate first")
             return
-        
-        upwelling_radiance = self.downlooking_spec.spectra-self.downlooking_dark_ref
-        incident_irradiance = self.uplooking_spec.spectra-self.uplooking_dark_ref
+        reflectance_spectra = self.reflectance(self.uplooking_spec.spectra,self.downlooking_spec.spectra)
+        log.info("reflectance spectra calculated")
+        return(reflectance_spectra)
+
+    def reflectance(self,uplooking_spectra:np.ndarray,downlooking_spectra:np.ndarray) -> np.ndarray:
+        '''reflectance (%) at the band centers from raw spectra already acquired, e.g. the latest logged frame'''
+        upwelling_radiance = downlooking_spectra-self.downlooking_dark_ref
+        incident_irradiance = uplooking_spectra-self.uplooking_dark_ref
 
         if self.band_centers is None:
-            print('Warning: band centers not defined, using downlooking spectrometer wavelengths instead')
+            log.warning('band centers not defined, using downlooking spectrometer wavelengths instead')
             incident_irradiance = np.interp(self.downlooking_spec.wavelengths,self.uplooking_spec.wavelengths,incident_irradiance)
         else:
             upwelling_radiance = np.interp(self.band_centers,self.downlooking_spec.wavelengths,upwelling_radiance)
             incident_irradiance = np.interp(self.band_centers,self.uplooking_spec.wavelengths,incident_irradiance)
 
-        reflectance_spectra = (upwelling_radiance/incident_irradiance)*(self.correction_factors)*100#*self.calibration_panel_reflectance*100
-        print("Reflectance spectra calculated")
-        return(reflectance_spectra)
+        return (upwelling_radiance/incident_irradiance)*(self.correction_factors)*100#*self.calibration_panel_reflectance*100
     
     @property
     def band_centers(self):
@@ -238,8 +395,103 @@ class HDX_reflectance_module(HDXXR_pair):
         self.Position = position
         # self.Orientation = orientation
 
+class SpectraWriter():
+    '''Writer stage of save_raw_spectra, appends acquired frames to the raw tables from its own thread
+    frames wait in a bounded queue and are copied into NumPy record batches, the batches are appended
+    and flushed every flush_rows frames or flush_interval_s seconds, whichever comes first.
+    A frame is a list with one SpectrometerTable row tuple per table.
+    put() only blocks when the queue is full (backpressure), this is counted in stats.
+    If the writer thread fails its exception is kept in error and raised again by put() and close()'''
+    def __init__(self,raw_tables:list[tables.Table],max_queue_frames:int=256,flush_rows:int=64,flush_interval_s:float=2.0) -> None:
+        self.raw_tables = raw_tables
+        self.queue = Queue(maxsize=max_queue_frames)
+        self.flush_rows = flush_rows
+        self.flush_interval_s = flush_interval_s
+        self._batches = [np.zeros(flush_rows,dtype=table.dtype) for table in raw_tables]
+        self._batch_rows = 0
+        self._last_flush = time.monotonic()
+        self.stats = {'frames':0,'flushes':0,'max_queue_depth':0,'blocked_puts':0,'blocked_s':0.0}
+        self._thread = None
+        self.error = None
+        self.poll_s = 0.5 #how often a blocked put() or close() checks that the writer is still running
+
+    def start(self):
+        self._thread = self.run()
+        return self._thread
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put_while_running(self,item):
+        '''blocking put that gives up (raising the writer error) if the writer thread stops'''
+        while True:
+            self._check()
+            try:
+                self.queue.put(item,timeout=self.poll_s)
+                return
+            except Full:
+                if self._thread is not None and not self._thread.is_alive():
+                    self._check()
+                    return #stopped without an error, nobody will read the queue
+
+    def put(self,frame:list[tuple]):
+        self._check()
+        try:
+            self.queue.put_nowait(frame)
+        except Full:
+            start = time.monotonic()
+            self._put_while_running(frame)
+            self.stats['blocked_puts'] += 1
+            self.stats['blocked_s'] += time.monotonic()-start
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'],self.queue.qsize())
+
+    def close(self):
+        '''writes every queued frame and waits for the writer thread, raises the writer error if it failed'''
+        if self._thread is not None and self._thread.is_alive():
+            self._put_while_running(None)
+            self._thread.join()
+        self._check()
+
+    @threaded
+    def run(self):
+        try:
+            while True:
+                timeout = max(0.0,self._last_flush + self.flush_interval_s - time.monotonic())
+                try:
+                    frame = self.queue.get(timeout=timeout)
+                except Empty:
+                    self.flush()
+                    continue
+                if frame is None:
+                    break
+                for batch,row in zip(self._batches,frame):
+                    batch[self._batch_rows] = row
+                self._batch_rows += 1
+                self.stats['frames'] += 1
+                if self._batch_rows == self.flush_rows or time.monotonic()-self._last_flush >= self.flush_interval_s:
+                    self.flush()
+            self.flush()
+        except Exception as e: #raised in the acquisition thread by put() or close()
+            self.error = e
+
+    def flush(self):
+        if self._batch_rows > 0:
+            with stage_timer('spectrometer','write'):
+                for table,batch in zip(self.raw_tables,self._batches):
+                    table.append(batch[:self._batch_rows])
+                    table.flush()
+            self._batch_rows = 0
+            self.stats['flushes'] += 1
+        self._last_flush = time.monotonic()
+
 @threaded
-def save_raw_spectra(file:Path,stop_event:Event=None,reflectance_modules:list[HDX_reflectance_module]=None,gps:reach_rover=None):
+def save_raw_spectra(file:Path,stop_event:Event=None,reflectance_modules:list[HDX_reflectance_module]=None,gps:reach_rover=None,frame_period_s:float=0.0,
+                     max_queue_frames:int=256,flush_rows:int=64,flush_interval_s:float=2.0):
+    '''Logs raw spectra of the uplooking and every downlooking spectrometer to an HDF5 file
+    all spectrometers are triggered together, rows of the same frame share the same index
+    frame_period_s: frame period on the acquisition clock, 0 runs as fast as the spectrometers allow
+    max_queue_frames,flush_rows,flush_interval_s: SpectraWriter queue size and flush budget'''
     stop = stop_event 
     with tables.open_file(file,'w') as f:
         reference_panel_group = f.create_group(f.root,'reference_panel','Standard reflectance panel data')
@@ -258,6 +510,10 @@ def save_raw_spectra(file:Path,stop_event:Event=None,reflectance_modules:list[HD
             f.create_array(module_group,'calibration_panel_radiance',module.downlooking_white_ref)
             f.create_array(module_group,'uplooking_dark_reference',module.uplooking_dark_ref)
             f.create_array(module_group,'downlooking_dark_reference',module.downlooking_dark_ref)
+            for orientation,spec in (('uplooking',module.uplooking_spec),('downlooking',module.downlooking_spec)):
+                model = spec.dark_model
+                if model is not None: #dark reference of any integration time for the offline reflectance
+                    model.save(f,module_group,f'{orientation}_dark_model')
         #start logging raw data
         uplooking_spec = reflectance_modules[0].uplooking_spec
         downlooking_spec = [x.downlooking_spec for x in reflectance_modules]
@@ -273,31 +529,47 @@ def save_raw_spectra(file:Path,stop_event:Event=None,reflectance_modules:list[HD
 
         raw_data_tables = [f.create_table(group,'raw',SpectrometerTable,f'{spec.orientation.name.upper()}_{spec.position.name.upper()}_raw_data')
                             for spec,group in zip(spectrometers_list,spectrometers_group_list)]
-        rows = [table.row for table in raw_data_tables]
-        index = itertools.count()
-        while not stop.is_set():
-            for row,spec in zip(rows,spectrometers_list):
-                timestamp = time.time()
-                if gps:
-                    coordinates_with_meta = gps.coordinates_with_meta
-                else:
-                    datetime_iso = datetime.fromtimestamp(timestamp).isoformat(' ','milliseconds')
-                    coordinates_with_meta = {'latitude':0.0,'longitude':0.0,'altitude':0.0,'datetime_iso':datetime_iso,'quality_fix':0}
-                spectra = spec.spectra
-                row['index'] = next(index)
-                row['integration_time_ms'] = spec.integration_time_ms
-                row['timestamp'] = timestamp
-                row['datetimeiso'] = coordinates_with_meta['datetime_iso']
-                row['latitude'] = coordinates_with_meta['latitude']
-                row['longitude'] = coordinates_with_meta['longitude']
-                row['altitude'] = coordinates_with_meta['altitude']
-                row['quality_fix'] = coordinates_with_meta['quality_fix']
-                row['spectrum'] = spectra
-                row.append()
-                time.sleep(0.2)
-        for table in raw_data_tables:
-            table.flush()
-        print('Logging stopped')
+        spec_positions = [group._v_name for group in spectrometers_group_list]
+        positions = [Position() for _ in spectrometers_list] #filled again on every frame, the rows copy their values
+        writer = SpectraWriter(raw_data_tables,max_queue_frames,flush_rows,flush_interval_s)
+        writer.start()
+        try:
+            frame_index = itertools.count()
+            task = acquisition_clock.task('spectra',frame_period_s)
+            #one worker per spectrometer, every frame triggers all of them at once
+            with ThreadPoolExecutor(max_workers=len(spectrometers_list),thread_name_prefix='spectrometer') as pool:
+                while task.wait(stop):
+                    index = next(frame_index)
+                    frame = list(pool.map(HDXXR_spectrometer.acquire,spectrometers_list))
+                    frame_rows = []
+                    for spec_position,position,(timestamp,end_timestamp,spectra,integration_time_ms) in zip(spec_positions,positions,frame):
+                        observe('spectrometer','device_read',end_timestamp-timestamp)
+                        if not (gps and gps.coordinates_at((timestamp+end_timestamp)/2,out=position)): #position at the middle of the acquisition
+                            position.set_local(timestamp)
+                        frame_rows.append((index,integration_time_ms,timestamp,position.datetime_iso,
+                                           position.latitude,position.longitude,position.altitude,position.quality_fix,spectra))
+                        #frame start time for every row so the recent rows stay time sorted
+                        recent.spectra.append((frame[0][0],index,spec_position,integration_time_ms,spectra.max(),spectra.mean(),
+                                               position.latitude,position.longitude))
+                        recent.set_spectrum(spec_position,timestamp,spectra)
+                    writer.put(frame_rows)
+                    count('samples','spectrometer',len(frame_rows))
+        except Exception as e:
+            if e is not writer.error: #a failed writer is logged below
+                raise
+        finally: #the writer must drain its queue even if the acquisition fails
+            try:
+                writer.close()
+            except Exception as e:
+                if e is not writer.error:
+                    raise
+        if writer.error is not None:
+            log.error('spectra writer failed after %d frames, logging stopped: %s',writer.stats['frames'],writer.error,exc_info=writer.error)
+            return
+        log.info("writer: %d frames, %d flushes, max queue depth %d, %d blocked puts (%.2f s)",writer.stats['frames'],writer.stats['flushes'],
+                 writer.stats['max_queue_depth'],writer.stats['blocked_puts'],writer.stats['blocked_s'])
+        log.info(task.summary())
+        log.info('logging stopped')
 
     
 
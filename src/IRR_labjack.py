@@ -1,12 +1,18 @@
 import u6
-from math import log
+import logging
+import numpy as np
 from time import sleep, time
-from rtk_gps import reach_rover
+from rtk_gps import reach_rover,Position
 from pathlib import Path
 from utils import threaded
 from threading import Event
 from typing import Dict
-from datetime import datetime
+from binary_logs import temperature_log,temperature_dtype,position_names
+from recent_data import recent
+from acquisition_clock import acquisition_clock,AcquisitionTask
+from metrics import stage_timer,observe,count
+
+log = logging.getLogger(__name__)
 
 #calibration coefficients mc2,mc1,mc0,bc2,bc1,bc0
 units_cc = { 
@@ -20,136 +26,257 @@ units_cc = {
 
 # irr_unit_T = Dict[str,str,str,int,int,int,enumerate,list]
 
-def get_temp(irr_unit:dict ,sensor_mV,object_mV,voltaje_divider = False):
-    A = 1.129241e-3 
+def get_temperatures(cc:np.ndarray,sensor_mV:np.ndarray,object_mV:np.ndarray,voltaje_divider:bool=False) -> tuple[np.ndarray,np.ndarray]:
+    '''Array version of the IRR temperature model
+    cc: calibration coefficients mc2,mc1,mc0,bc2,bc1,bc0 in the last axis, shape (sensors,6) or (samples,6)
+    sensor_mV,object_mV: thermistor and thermopile voltages, shape (samples,sensors), (sensors,) or (samples,)
+    returns sensor body and target temperatures in °C with the shape of the voltages'''
+    A = 1.129241e-3
     B = 2.341077e-4
     C = 8.775468e-8
     fix_resistor = 24900 #ohms
-    
+    cc = np.asarray(cc,dtype=np.float64)
+    sensor_mV = np.asarray(sensor_mV,dtype=np.float64)
+    object_mV = np.asarray(object_mV,dtype=np.float64)
+
     if voltaje_divider == True: #with voltaje divider of 2.5 V in
-        Rt = fix_resistor * (2500/sensor_mV - 1) 
+        Rt = fix_resistor * (2500/sensor_mV - 1)
     else: #with constant current source of 10 uA
         Rt = sensor_mV/0.010 - fix_resistor
     #temperature detected by thermistor also known as sensor body temperature
-    sensor_body_t_C = 1/(A+B*log(Rt) + C*log(Rt)**3 ) - 273.15
+    log_Rt = np.log(Rt)
+    sensor_body_t_C = 1/(A + B*log_Rt + C*log_Rt**3) - 273.15
 
-    cc = irr_unit['cc']
-    m = cc[0]*sensor_body_t_C**2 + cc[1]*sensor_body_t_C + cc[2]
-    b = cc[3]*sensor_body_t_C**2 + cc[4]*sensor_body_t_C + cc[5]
+    m = (cc[...,0]*sensor_body_t_C + cc[...,1])*sensor_body_t_C + cc[...,2]
+    b = (cc[...,3]*sensor_body_t_C + cc[...,4])*sensor_body_t_C + cc[...,5]
 
-    target_t_C = ( (sensor_body_t_C + 273.15)**4 + m*object_mV + b )**0.25 -273.5
+    target_t_C = ((sensor_body_t_C + 273.15)**4 + m*object_mV + b)**0.25 - 273.5
     return (sensor_body_t_C,target_t_C)
 
+def get_temp(irr_unit:dict ,sensor_mV,object_mV,voltaje_divider = False):
+    sensor_body_t_C,target_t_C = get_temperatures(irr_unit['cc'],sensor_mV,object_mV,voltaje_divider)
+    return (float(sensor_body_t_C),float(target_t_C))
 
-def get_irr_array_temperatures(d:u6.U6,irr_array:list):
+#thermopiles are read differential with gain index 3 (x1000)
+thermopile_gain_index = 3
+stream_max_resolution_index = 8 #U6 stream mode does not support the high resolution indexes
+feedback_max_ain24 = 14 #AIN24 commands that fit in one 64 byte Feedback packet
+
+def calibration_matrix(irr_array:list) -> np.ndarray:
+    '''calibration coefficients of every IRR stacked as a (sensors,6) array'''
+    return np.array([units_cc[IRR['unit']] if IRR.get('cc') is None else IRR['cc'] for IRR in irr_array],dtype=np.float64)
+
+def thermistor_voltages(series_resistor_mV:np.ndarray) -> np.ndarray:
+    '''individual thermistor voltages from the accumulated voltages of the current loop (last axis = sensors)'''
+    series_resistor_mV = np.asarray(series_resistor_mV,dtype=np.float64)
+    thermistor_mV = series_resistor_mV.copy()
+    thermistor_mV[...,:-1] -= series_resistor_mV[...,1:]
+    return thermistor_mV
+
+def irr_feedback_commands(irr_array:list) -> list:
+    '''AIN24 commands reading every thermistor then every thermopile of the array'''
+    return ([u6.AIN24(IRR['thermistor_ain'],ResolutionIndex=IRR['res_index'],GainIndex=IRR['gain_index']) for IRR in irr_array] +
+            [u6.AIN24(IRR['thermopile_ain'],ResolutionIndex=6,GainIndex=thermopile_gain_index,Differential=True) for IRR in irr_array])
+
+def read_irr_voltages(d:u6.U6,irr_array:list,commands:list=None) -> tuple[np.ndarray,np.ndarray]:
+    '''reads every thermistor and thermopile once, returns (thermistor_mV,thermopile_mV) per sensor
+    all the channels are packed in as few Feedback packets as possible (one USB round trip for up to 7 sensors)'''
+    if commands is None:
+        commands = irr_feedback_commands(irr_array)
+    raw_values = []
+    for i in range(0,len(commands),feedback_max_ain24):
+        raw_values.extend(d.getFeedback(commands[i:i+feedback_max_ain24]))
+    mV = np.array([d.binaryToCalibratedAnalogVoltage(command.gainIndex,value,resolutionIndex=command.resolutionIndex)
+                   for command,value in zip(commands,raw_values)])*1000
+    # correct thermistor voltages for the series resistor
+    return (thermistor_voltages(mV[:len(irr_array)]),mV[len(irr_array):])
+
+def read_irr_voltages_getain(d:u6.U6,irr_array:list) -> tuple[np.ndarray,np.ndarray]:
+    '''same as read_irr_voltages with one getAIN call (one USB round trip) per channel'''
     # read voltajes in every thermistor and correct for series resistor
     series_resistor_volt = [d.getAIN(IRR['thermistor_ain'],resolutionIndex = IRR['res_index'],gainIndex = IRR['gain_index'])*1000 for IRR in irr_array ]
-    # calculate individual thermistor voltages for resistance calculation
-    diff_list = [series_resistor_volt[i] - series_resistor_volt[i+1] for i in range(len(series_resistor_volt)-1)]
-    diff_list.append(series_resistor_volt[-1])
-    thermistor_voltage = diff_list
-    thermopile_voltage = [d.getAIN(IRR['thermopile_ain'],resolutionIndex=6,gainIndex=3,differential=True)*1000 for IRR in irr_array]
+    thermopile_voltage = [d.getAIN(IRR['thermopile_ain'],resolutionIndex=6,gainIndex=thermopile_gain_index,differential=True)*1000 for IRR in irr_array]
+    return (thermistor_voltages(series_resistor_volt),np.array(thermopile_voltage))
+
+def stream_scan_list(irr_array:list) -> tuple[list[int],list[int]]:
+    '''stream channel numbers and options: every thermistor then every thermopile
+    option bits 4-5 are the gain index, bit 7 selects a differential reading'''
+    channels = [IRR['thermistor_ain'] for IRR in irr_array] + [IRR['thermopile_ain'] for IRR in irr_array]
+    options = [IRR['gain_index'] << 4 for IRR in irr_array] + [(thermopile_gain_index << 4) | 0x80 for IRR in irr_array]
+    return channels,options
 
-    temp_array_C = [get_temp(x[0],x[1],x[2]) for x in zip(irr_array,thermistor_voltage,thermopile_voltage)]
+def stream_irr_voltages(d:u6.U6,irr_array:list,stop_event:Event,scan_rate_hz:float=100,scans_per_block:int=100,resolution_index:int=stream_max_resolution_index):
+    '''Hardware timed acquisition with the U6 stream interface, all channels of a scan are sampled back to back
+    yields (sample times,thermistor_mV,thermopile_mV) blocks of scans_per_block scans, arrays are (scans,sensors)
+    sample times are the host time at streamStart plus the scan number over the scan rate'''
+    channels,options = stream_scan_list(irr_array)
+    d.streamConfig(NumChannels=len(channels),ResolutionIndex=min(resolution_index,stream_max_resolution_index),SettlingFactor=0,
+                   ChannelNumbers=channels,ChannelOptions=options,ScanFrequency=scan_rate_hz)
+    keys = [f'AIN{channel}' for channel in channels]
+    sensors = len(irr_array)
+    scan_count = 0
+    pending_scans = []
+    pending_values = []
+    d.streamStart()
+    stream_start = time()
+    try:
+        for packet in d.streamData():
+            if stop_event.is_set():
+                break
+            if packet is None: #no data ready yet
+                continue
+            if packet['errors'] or packet['missed']:
+                log.warning('stream errors: %s, missed samples: %s',packet['errors'],packet['missed'])
+                count('missed_samples','irr',packet['missed'])
+                scan_count += packet['missed']//len(channels) #keeps the sample clock
+            values = np.array([packet[key] for key in keys],dtype=np.float64).T*1000 #(scans,channels) in mV
+            pending_scans.append(scan_count + np.arange(len(values)))
+            pending_values.append(values)
+            scan_count += len(values)
+            if sum(len(v) for v in pending_values) < scans_per_block:
+                continue
+            scans = np.concatenate(pending_scans)
+            values = np.concatenate(pending_values)
+            blocks = len(values)//scans_per_block*scans_per_block
+            pending_scans,pending_values = [scans[blocks:]],[values[blocks:]]
+            for block_scans,block_values in zip(np.split(scans[:blocks],blocks//scans_per_block),np.split(values[:blocks],blocks//scans_per_block)):
+                yield (stream_start + block_scans/scan_rate_hz,thermistor_voltages(block_values[:,:sensors]),block_values[:,sensors:])
+    finally:
+        d.streamStop()
+
+def average_scans(values:np.ndarray,scans:int) -> np.ndarray:
+    '''averages consecutive groups of scans along the first axis, a partial last group is dropped'''
+    rows = len(values)//scans
+    return values[:rows*scans].reshape(rows,scans,*values.shape[1:]).mean(axis=1)
+
+def get_irr_array_temperatures(d:u6.U6,irr_array:list):
+    thermistor_voltage,thermopile_voltage = read_irr_voltages(d,irr_array)
+    body_t_C,target_t_C = get_temperatures(calibration_matrix(irr_array),thermistor_voltage,thermopile_voltage)
     #{'sensor_id':,
     # 'sensor_position':,
     # 'sensor_body_t_C':,
     # 'target_t_C':}
-    result = [{'sensor_id':x[0]['unit'],'sensor_position':x[0]['position'],'sensor_body_t_C':x[1][0],'target_t_C':x[1][1]} for x in zip(irr_array,temp_array_C)]
+    result = [{'sensor_id':x[0]['unit'],'sensor_position':x[0]['position'],'sensor_body_t_C':x[1],'target_t_C':x[2]} for x in zip(irr_array,body_t_C.tolist(),target_t_C.tolist())]
     return(result)
 
-def get_temperature_with_coordinates(d:u6.U6,irr_array:list,GPS_rover:reach_rover=None):
+def temperature_rows(irr_array:list) -> np.ndarray:
+    '''one TemperatureRecord row per IRR with the sensor_id (irr_array order) and sensor_position codes filled'''
+    rows = np.zeros(len(irr_array),dtype=temperature_dtype)
+    rows['sensor_id'] = np.arange(len(irr_array))
+    rows['sensor_position'] = [position_names.index(irr['position'].name.upper()) for irr in irr_array]
+    return rows
+
+def fill_temperature_rows(rows:np.ndarray,timestamp:float,position:Position,body_t_C:np.ndarray,target_t_C:np.ndarray,
+                          thermistor_mV:np.ndarray=np.nan,thermopile_mV:np.ndarray=np.nan) -> np.ndarray:
+    '''fills the measured columns of temperature_rows() in place, one value per IRR'''
+    rows['timestamp'] = timestamp
+    rows['datetime_s'] = position.gps_time
+    rows['quality_fix'] = position.quality_fix
+    rows['lat'] = position.latitude
+    rows['long'] = position.longitude
+    rows['alt'] = position.altitude
+    rows['sensorbody_temp_C'] = body_t_C
+    rows['target_temp_C'] = target_t_C
+    rows['thermistor_mV'] = thermistor_mV
+    rows['thermopile_mV'] = thermopile_mV
+    return rows
+
+def get_temperature_with_coordinates(d:u6.U6,irr_array:list,GPS_rover:reach_rover=None,out:np.ndarray=None,position:Position=None) -> np.ndarray:
+    '''reads every IRR once, returns the rows of the binary log (temperature_log(path,[irr['unit'] for irr in irr_array]))
+    out,position: rows of a previous call (or temperature_rows(irr_array)) and a Position to fill again instead of allocating them'''
     sleep(0.8)
-    # read voltajes in every thermistor and correct for series resistor
-    series_resistor_volt = [d.getAIN(IRR['thermistor_ain'],resolutionIndex = IRR['res_index'],gainIndex = IRR['gain_index'])*1000 for IRR in irr_array ]
-    # calculate individual thermistor voltages for resistance calculation
-    diff_list = [series_resistor_volt[i] - series_resistor_volt[i+1] for i in range(len(series_resistor_volt)-1)]
-    diff_list.append(series_resistor_volt[-1])
-    thermistor_voltage = diff_list
-    thermopile_voltage = [d.getAIN(IRR['thermopile_ain'],resolutionIndex=6,gainIndex=3,differential=True)*1000 for IRR in irr_array]
+    thermistor_voltage,thermopile_voltage = read_irr_voltages(d,irr_array)
 
     timestamp = time()
-    temp_array_C = [get_temp(x[0],x[1],x[2]) for x in zip(irr_array,thermistor_voltage,thermopile_voltage)]
-    if GPS_rover:
-        coordinates_with_meta = GPS_rover.coordinates
-        lat,long,alt = coordinates_with_meta['coordinates']
-        datetime_iso,quality_fix = coordinates_with_meta['metadata']
-
-        result = [{'timestamp':timestamp,
-                    'datetime_iso':datetime_iso,
-                    'quality_fix':quality_fix,
-                    'lat': lat,
-                    'long': long,
-                    'alt': alt,
-                    'sensor_id':x[0]['unit'],
-                    'sensor_position':x[0]['position'],
-                    'sensorbody_temp_C':x[1][0],
-                    'target_temp_C':x[1][1]} for x in zip(irr_array,temp_array_C)]
-    else:
-        result = [{'timestamp':timestamp,
-                    'datetime_iso':0,
-                    'quality_fix':0,
-                    'lat': 0,
-                    'long': 0,
-                    'alt': 0,
-                    'sensor_id':x[0]['unit'],
-                    'sensor_position':x[0]['position'],
-                    'sensorbody_temp_C':x[1][0],
-                    'target_temp_C':x[1][1]} for x in zip(irr_array,temp_array_C)]
+    body_t_C,target_t_C = get_temperatures(calibration_matrix(irr_array),thermistor_voltage,thermopile_voltage)
+    position = Position() if position is None else position
+    if not (GPS_rover and GPS_rover.coordinates_at(timestamp,out=position)):
+        position.set_local(timestamp)
+    return(fill_temperature_rows(temperature_rows(irr_array) if out is None else out,timestamp,position,body_t_C,target_t_C,thermistor_voltage,thermopile_voltage))
 
-    return(result)
+def _command_response_cycles(d:u6.U6,irr_list:list,stop_event:Event,cycle_latencies:list,task:AcquisitionTask):
+    '''one Feedback reading of every channel on every tick of task, yields the same blocks as stream_irr_voltages with one row'''
+    commands = irr_feedback_commands(irr_list)
+    while task.wait(stop_event):
+        read_start = time()
+        thermistor_voltage,thermopile_voltage = read_irr_voltages(d,irr_list,commands)
+        timestamp = time()
+        cycle_latencies.append(timestamp-read_start)
+        observe('irr','device_read',timestamp-read_start)
+        yield np.array([(read_start+timestamp)/2]),thermistor_voltage[np.newaxis],thermopile_voltage[np.newaxis],np.array([timestamp])
+
+def _stream_cycles(d:u6.U6,irr_list:list,stop_event:Event,scan_rate_hz:float,average:int):
+    scans_per_block = max(1,round(scan_rate_hz/average))*average #about one block per second
+    for sample_times,thermistor_voltage,thermopile_voltage in stream_irr_voltages(d,irr_list,stop_event,scan_rate_hz,scans_per_block):
+        sample_times = average_scans(sample_times,average)
+        yield sample_times,average_scans(thermistor_voltage,average),average_scans(thermopile_voltage,average),sample_times
 
 @threaded
-def log_temperatures(txt_path:Path,irr_list:list[Dict],stop_event:Event,gps:reach_rover=None):
-    u6_device = u6.U6()
+def log_temperatures(txt_path:Path,irr_list:list[Dict],stop_event:Event,gps:reach_rover=None,u6_device:u6.U6=None,
+                     stream_scan_rate_hz:float=None,stream_average_scans:int=1,cycle_latencies:list=None,period_s:float=0.6):
+    '''Logs the IRR temperatures and raw voltages, csv or binary (.h5) depending on txt_path
+    period_s: polling period on the acquisition clock, 0.6 s is the 1H1 step response time
+    stream_scan_rate_hz: None polls the channels every period_s, otherwise the U6 streams
+    the scan list at this rate and stream_average_scans consecutive scans are averaged per row
+    cycle_latencies: if given, the duration (s) of every polling read cycle is appended to it'''
+    if u6_device is None:
+        u6_device = u6.U6()
     u6_device.getCalibrationData()
     stop_event = stop_event
+    if cycle_latencies is None:
+        cycle_latencies = []
     try:
         for irr in irr_list:
             irr['cc'] = units_cc[irr['unit']]
-        with txt_path.open('w',encoding='utf-8') as f:
-            header = 'timestamp,datetime_iso,quality_fix,lat,long,alt,sensor_id,sensor_position,sensorbody_temp_C,target_temp_C\n'
-            f.write(header)
-            while not stop_event.is_set():
-                sleep(0.6) #0.6 1H1 step response time
-                # read voltajes in every thermistor and correct for series resistor
-                series_resistor_volt = [u6_device.getAIN(IRR['thermistor_ain'],resolutionIndex = IRR['res_index'],gainIndex = IRR['gain_index'])*1000 for IRR in irr_list ]
-                # calculate individual thermistor voltages for resistance calculation
-                diff_list = [series_resistor_volt[i] - series_resistor_volt[i+1] for i in range(len(series_resistor_volt)-1)]
-                diff_list.append(series_resistor_volt[-1])
-                thermistor_voltage = diff_list
-                thermopile_voltage = [u6_device.getAIN(IRR['thermopile_ain'],resolutionIndex=6,gainIndex=3,differential=True)*1000 for IRR in irr_list]
-
-                timestamp = time()
-                if gps:
-                    coordinates_with_meta = gps.coordinates_with_meta
-                else:
-                    coordinates_with_meta = {'latitude':'0.0',
-                                             'longitude':'0.0',
-                                             'altitude':'0.0',
-                                             'datetime_iso':'' }
-                    coordinates_with_meta = None
-                for irr,thermistor_V,thermopile_V in zip(irr_list,thermistor_voltage,thermopile_voltage):
-                    sensorbody_t,target_t = get_temp(irr,thermistor_V,thermopile_V)
-                    irr['sensorbody_t_C'] = sensorbody_t
-                    irr['target_t_C'] = target_t
-                    print(f"{irr['unit']}: {sensorbody_t},{target_t}")
-                    if coordinates_with_meta is None:
-                        timestamp_iso = datetime.fromtimestamp(timestamp).isoformat(' ','milliseconds')
-                        line =','.join([f"{timestamp:.6f},{timestamp_iso},0",
-                                "0.0,0.0,0.0",
-                                f"{irr['unit']},{irr['position'].name.upper()},{sensorbody_t:.6f},{target_t:.6f}"]) + '\n'
+        cc = calibration_matrix(irr_list)
+        if stream_scan_rate_hz:
+            cycles = _stream_cycles(u6_device,irr_list,stop_event,stream_scan_rate_hz,stream_average_scans)
+        else:
+            task = acquisition_clock.task('temperature',period_s)
+            cycles = _command_response_cycles(u6_device,irr_list,stop_event,cycle_latencies,task)
+        binary = txt_path.suffix == '.h5' #binary columnar log instead of csv
+        position = Position() #filled again for every row
+        rows = temperature_rows(irr_list)
+        with (temperature_log(txt_path,[irr['unit'] for irr in irr_list]) if binary else txt_path.open('w',encoding='utf-8')) as f:
+            if not binary:
+                header = 'timestamp,datetime_iso,quality_fix,lat,long,alt,sensor_id,sensor_position,sensorbody_temp_C,target_temp_C,thermistor_mV,thermopile_mV\n'
+                f.write(header)
+            for position_times,thermistor_block,thermopile_block,timestamps in cycles:
+                with stage_timer('irr','compute'):
+                    body_block,target_block = get_temperatures(cc,thermistor_block,thermopile_block)
+                write_start = time()
+                for position_time,thermistor_voltage,thermopile_voltage,body_t_C,target_t_C,timestamp in zip(position_times.tolist(),thermistor_block,thermopile_block,body_block,target_block,timestamps.tolist()):
+                    #position at the middle of the readings
+                    located = gps is not None and gps.coordinates_at(position_time,out=position) is not None
+                    if not located:
+                        position.set_local(timestamp)
+                    if binary: #the rows of the whole array are copied to the log at once
+                        f.extend(fill_temperature_rows(rows,timestamp,position,body_t_C,target_t_C,thermistor_voltage,thermopile_voltage))
+                    elif located:
+                        gps_fields = f"{timestamp:.6f},{position.datetime_iso},{position.quality_fix},{position.latitude:.9f},{position.longitude:.9f},{position.altitude:.4f}"
                     else:
-                        line =','.join([f"{timestamp:.6f},{coordinates_with_meta['datetime_iso']},{coordinates_with_meta['quality_fix']}",
-                                f"{coordinates_with_meta['latitude']},{coordinates_with_meta['longitude']},{coordinates_with_meta['altitude']}",
-                                f"{irr['unit']},{irr['position'].name.upper()},{sensorbody_t:.6f},{target_t:.6f}"]) + '\n'
-                    f.write(line)
+                        gps_fields = f"{timestamp:.6f},{position.datetime_iso},0,0.0,0.0,0.0"
+                    for irr,sensorbody_t,target_t,thermistor_V,thermopile_V in zip(irr_list,body_t_C.tolist(),target_t_C.tolist(),thermistor_voltage.tolist(),thermopile_voltage.tolist()):
+                        irr['sensorbody_t_C'] = sensorbody_t
+                        irr['target_t_C'] = target_t
+                        recent.temperatures.append((timestamp,irr['unit'],irr['position'].name.upper(),sensorbody_t,target_t,position.latitude,position.longitude))
+                        if not binary:
+                            f.write(f"{gps_fields},{irr['unit']},{irr['position'].name.upper()},{sensorbody_t:.6f},{target_t:.6f},{thermistor_V:.9f},{thermopile_V:.9f}\n")
+                observe('irr','write',time()-write_start)
+                count('samples','irr',len(timestamps)*len(irr_list))
+                if log.isEnabledFor(logging.DEBUG):
+                    for irr in irr_list:
+                        log.debug('%s: %s,%s',irr['unit'],irr['sensorbody_t_C'],irr['target_t_C'])
+        if not stream_scan_rate_hz:
+            log.info(task.summary())
+        if cycle_latencies:
+            log.info('IRR read cycles: %d, mean %.1f ms, max %.1f ms',len(cycle_latencies),1000*np.mean(cycle_latencies),1000*np.max(cycle_latencies))
     except ZeroDivisionError as e:
         u6_device.close()
-        print(e)
+        log.error(e)
     except Exception as e:
         u6_device.close()
-        print(e)
+        log.exception(e)
     # finally:
         # raise
 
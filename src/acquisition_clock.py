@@ -0,0 +1,123 @@
+'''
+Shared acquisition clock for the sensor loops
+every loop gets an AcquisitionTask with a target period, ticks are deadlines on a grid common to all
+the tasks (clock epoch + k*period) so sensors running at the same or harmonic rates sample together,
+and the loops do not drift since a late tick does not move the following ones.
+A period of 0 runs the loop as fast as the device allows (the device call sets the pace).
+
+every task records the start jitter of its ticks and the deadlines it missed
+
+    task = acquisition_clock.task('temperature',0.6)
+    while task.wait(stop_event):
+        read()
+
+or let the clock run the callbacks in their own threads
+    acquisition_clock.register('spectra',0.5,acquire_frame)
+    acquisition_clock.start(stop_event)
+'''
+import time
+import numpy as np
+from threading import Event,Lock
+from utils import threaded
+
+class AcquisitionTask():
+    '''deadline based ticks of one sensor loop'''
+    jitter_history = 1024 #ticks kept for the jitter statistics
+
+    def __init__(self,name:str,period_s:float,clock:'AcquisitionClock') -> None:
+        self.name = name
+        self.period_s = period_s
+        self.clock = clock
+        self.ticks = 0
+        self.missed = 0
+        self.first_tick = None
+        self.last_tick = None
+        self._next_deadline = None
+        self._jitter = np.zeros(self.jitter_history)
+
+    def _next_grid_point(self,now:float) -> float:
+        '''first deadline of the clock grid at or after now'''
+        k = np.ceil((now-self.clock.epoch)/self.period_s)
+        return self.clock.epoch + k*self.period_s
+
+    def wait(self,stop_event:Event=None) -> bool:
+        '''blocks until the next deadline, returns False if stop_event is set meanwhile'''
+        now = self.clock.now()
+        if self.period_s > 0:
+            if self._next_deadline is None:
+                self._next_deadline = self._next_grid_point(now)
+            deadline = self._next_deadline
+            if deadline > now:
+                if stop_event is None:
+                    time.sleep(deadline-now)
+                elif stop_event.wait(deadline-now):
+                    return False
+        else:
+            deadline = now
+        if stop_event is not None and stop_event.is_set():
+            return False
+        tick = self.clock.now()
+        self._jitter[self.ticks % self.jitter_history] = tick-deadline
+        self.ticks += 1
+        if self.first_tick is None:
+            self.first_tick = tick
+        self.last_tick = tick
+        if self.period_s > 0:
+            #a late tick runs at once, the other deadlines that passed meanwhile are counted as missed and skipped
+            self._next_deadline = max(deadline+self.period_s,self._next_grid_point(tick))
+            self.missed += int(round((self._next_deadline-deadline)/self.period_s))-1
+        return True
+
+    def stats(self) -> dict:
+        jitter = self._jitter[:min(self.ticks,self.jitter_history)]*1000
+        elapsed = (self.last_tick-self.first_tick) if self.ticks > 1 else 0.0
+        return {'name':self.name,
+                'period_s':self.period_s,
+                'ticks':self.ticks,
+                'missed':self.missed,
+                'rate_hz':(self.ticks-1)/elapsed if elapsed > 0 else 0.0,
+                'jitter_mean_ms':float(jitter.mean()) if len(jitter) else 0.0,
+                'jitter_p95_ms':float(np.percentile(jitter,95)) if len(jitter) else 0.0,
+                'jitter_max_ms':float(jitter.max()) if len(jitter) else 0.0}
+
+    def summary(self) -> str:
+        s = self.stats()
+        target = f"{1/s['period_s']:.2f} Hz" if s['period_s'] > 0 else 'max rate'
+        return (f"{s['name']}: {s['ticks']} ticks at {s['rate_hz']:.2f} Hz (target {target}), {s['missed']} missed deadlines, "
+                f"jitter mean {s['jitter_mean_ms']:.2f} ms p95 {s['jitter_p95_ms']:.2f} ms max {s['jitter_max_ms']:.2f} ms")
+
+class AcquisitionClock():
+    '''monotonic clock shared by all the acquisition loops of the process'''
+    def __init__(self) -> None:
+        self.epoch = time.monotonic()
+        self.tasks = {}
+        self._callbacks = {}
+        self._lock = Lock()
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def task(self,name:str,period_s:float) -> AcquisitionTask:
+        '''new task, a task with the same name is replaced (e.g. a logger started again)'''
+        with self._lock:
+            self.tasks[name] = AcquisitionTask(name,period_s,self)
+            return self.tasks[name]
+
+    def register(self,name:str,period_s:float,callback):
+        '''callback() is called on every tick of the task once the clock is started'''
+        self._callbacks[name] = (period_s,callback)
+
+    @threaded
+    def _run(self,task:AcquisitionTask,callback,stop_event:Event):
+        while task.wait(stop_event):
+            callback()
+
+    def start(self,stop_event:Event) -> list:
+        '''runs every registered callback in its own thread until stop_event is set, returns the threads'''
+        return [self._run(self.task(name,period_s),callback,stop_event) for name,(period_s,callback) in self._callbacks.items()]
+
+    def report(self) -> list[str]:
+        with self._lock:
+            return [task.summary() for task in self.tasks.values()]
+
+acquisition_clock = AcquisitionClock()
@@ -0,0 +1,169 @@
+'''
+End-to-end acquisition benchmark on simulated devices
+runs save_raw_spectra, log_ndvi_pri and log_temperatures together for N minutes and
+reports samples/s per logger, per-stage device latency and CPU/memory usage
+
+usage: python benchmark.py --minutes 2 [--output folder] [--no-gps]
+'''
+import argparse
+import logging
+import tempfile
+import time
+import numpy as np
+import tables
+from pathlib import Path
+from threading import Event, Lock
+from rtk_gps import reach_rover
+from HDX_spec import HDXXR_spectrometer,HDX_reflectance_module,save_raw_spectra
+from IRR_labjack import log_temperatures
+from sdi12_sensors import make_ndvi_pairs,make_pri_pairs,log_ndvi_pri
+from acquisition_clock import acquisition_clock
+from metrics import registry
+from simulators import SimulatedSpectrometer,SimulatedU6,SimulatedSDI12Serial,SimulatedReachServer
+from utils import SensorOrientation,SensorPosition,get_unique_filepath_from_string
+
+#same wiring as the cart configuration in GUI.py
+irr_units = [
+    {'unit':'1141','thermistor_ain':13,'thermopile_ain':10,'res_index':12,'gain_index':0,'position':SensorPosition.RIGHT,'cc':None},
+    {'unit':'1142','thermistor_ain':9,'thermopile_ain':6,'res_index':12,'gain_index':0,'position':SensorPosition.CENTER,'cc':None},
+    {'unit':'1140','thermistor_ain':5,'thermopile_ain':2,'res_index':8,'gain_index':1,'position':SensorPosition.LEFT,'cc':None}
+    ]
+ndvi_units = [
+    {'id':'1','position':SensorPosition.CENTER,'orientation':SensorOrientation.UPLOOKING},
+    {'id':'4','position':SensorPosition.RIGHT,'orientation':SensorOrientation.DOWNLOOKING},
+    {'id':'3','position':SensorPosition.CENTER,'orientation':SensorOrientation.DOWNLOOKING},
+    {'id':'2','position':SensorPosition.LEFT,'orientation':SensorOrientation.DOWNLOOKING}
+    ]
+pri_units = [
+    {'id':'a','position':SensorPosition.CENTER,'orientation':SensorOrientation.UPLOOKING},
+    {'id':'b','position':SensorPosition.RIGHT,'orientation':SensorOrientation.DOWNLOOKING},
+    {'id':'c','position':SensorPosition.CENTER,'orientation':SensorOrientation.DOWNLOOKING},
+    {'id':'d','position':SensorPosition.LEFT,'orientation':SensorOrientation.DOWNLOOKING}
+    ]
+sdi12_readings = {'1':(0.2512,0.4021),'4':(0.0204,0.1987),'3':(0.0221,0.2102),'2':(0.0198,0.1893),
+                  'a':(0.1534,0.1622),'b':(0.0150,0.0162),'c':(0.0148,0.0159),'d':(0.0152,0.0166)}
+downlooking_positions = [SensorPosition.RIGHT,SensorPosition.CENTER,SensorPosition.LEFT]
+
+def make_simulated_hdx_modules(rover:reach_rover=None) -> list[HDX_reflectance_module]:
+    '''builds and calibrates the uplooking + 3 downlooking reflectance modules on simulated spectrometers'''
+    uplooking = HDXXR_spectrometer(SimulatedSpectrometer('SIMUP001'),integration_time_ms=25,boxcar_size=1,
+                                   position=SensorPosition.CENTER,orientation=SensorOrientation.UPLOOKING)
+    modules = []
+    for i,position in enumerate(downlooking_positions):
+        downlooking = HDXXR_spectrometer(SimulatedSpectrometer(f'SIMDN00{i+1}',vegetation=True),integration_time_ms=6,boxcar_size=1,
+                                         position=position,orientation=SensorOrientation.DOWNLOOKING)
+        module = HDX_reflectance_module(uplooking,downlooking,rtk_rover=rover,position=position)
+        panel_wavelengths = np.linspace(250.0,2500.0,226)
+        module.set_calibration_panel_reflectance(panel_wavelengths,np.full(panel_wavelengths.shape,0.99))
+        module.uplooking_white_ref = uplooking.spectra
+        module.downlooking_white_ref = downlooking.spectra
+        for spec in (uplooking,downlooking): #covered fibers, the uplooking model is captured once and cached
+            if spec.dark_model is None:
+                spec.spec.light_level = 0.0
+                spec.capture_dark_model()
+                spec.spec.light_level = 1.0
+        module.update_dark_references()
+        modules.append(module)
+    return modules
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError: #windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def latency_summary(latencies:list) -> dict:
+    values = np.array(latencies)*1000
+    return {'n':len(values),'mean_ms':values.mean(),'p50_ms':np.percentile(values,50),
+            'p95_ms':np.percentile(values,95),'max_ms':values.max()}
+
+def count_samples(temp_file:Path,sdi12_file:Path,spec_file:Path) -> dict:
+    with temp_file.open(encoding='utf-8') as f:
+        temp_rows = sum(1 for _ in f) - 1
+    with sdi12_file.open(encoding='utf-8') as f:
+        sdi12_rows = sum(1 for _ in f) - 1
+    with tables.open_file(spec_file,'r') as f:
+        spec_rows = sum(table.nrows for table in f.walk_nodes('/spectrometers','Table'))
+    return {'temperature':temp_rows,'sdi12':sdi12_rows,'spectra':spec_rows}
+
+def run_benchmark(minutes:float,output_folder:Path,use_gps:bool=True) -> dict:
+    server = None
+    rover = None
+    if use_gps:
+        server = SimulatedReachServer()
+        server.serve()
+        rover = reach_rover(server.ip,server.port,Lock())
+        rover.spin()
+        deadline = time.monotonic() + 5
+        while rover.coordinates_with_meta is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    hdx_modules = make_simulated_hdx_modules(rover)
+    u6_device = SimulatedU6(irr_units)
+    serial_port = SimulatedSDI12Serial(sdi12_readings)
+    ndvi_list = make_ndvi_pairs(ndvi_units[0],ndvi_units[1:],serial_port,rover)
+    pri_list = make_pri_pairs(pri_units[0],pri_units[1:],serial_port,rover)
+    temp_file = get_unique_filepath_from_string(output_folder,'benchmark','temp','.txt')
+    sdi12_file = get_unique_filepath_from_string(output_folder,'benchmark','SDI12','.txt')
+    spec_file = get_unique_filepath_from_string(output_folder,'benchmark','spec','.h5')
+    stop_event = Event()
+    irr_cycle_latencies = []
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    threads = [log_temperatures(temp_file,irr_units,stop_event,rover,u6_device,cycle_latencies=irr_cycle_latencies),
+               log_ndvi_pri(sdi12_file,ndvi_list,pri_list,stop_event),
+               save_raw_spectra(spec_file,stop_event,hdx_modules,rover)]
+    time.sleep(minutes*60)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    if rover:
+        rover.stop()
+        server.stop()
+
+    samples = count_samples(temp_file,sdi12_file,spec_file)
+    spectrometers = {id(s):s for m in hdx_modules for s in (m.uplooking_spec.spec,m.downlooking_spec.spec)}
+    stage_latencies = {'irr read cycle':irr_cycle_latencies}
+    for device in [u6_device,serial_port]+list(spectrometers.values()):
+        for stage,latencies in device.latencies.items():
+            stage_latencies.setdefault(stage,[]).extend(latencies)
+    return {'wall_time_s':wall_time,
+            'cpu_time_s':cpu_time,
+            'samples':samples,
+            'samples_per_s':{k:v/wall_time for k,v in samples.items()},
+            'stage_latency':{k:latency_summary(v) for k,v in stage_latencies.items() if len(v) > 0},
+            'peak_memory_mb':peak_memory_mb(),
+            'acquisition_clock':acquisition_clock.report(),
+            'metrics':registry.summary()}
+
+def print_report(report:dict):
+    print(f"wall time: {report['wall_time_s']:.1f} s, cpu time: {report['cpu_time_s']:.1f} s "
+          f"({100*report['cpu_time_s']/report['wall_time_s']:.1f} % of one core)")
+    if report['peak_memory_mb'] is not None:
+        print(f"peak memory: {report['peak_memory_mb']:.1f} MB")
+    for logger,rate in report['samples_per_s'].items():
+        print(f"{logger:>12}: {report['samples'][logger]} samples, {rate:.3f} samples/s")
+    for line in report['acquisition_clock']:
+        print(line)
+    for stage,s in report['stage_latency'].items():
+        print(f"{stage:>25}: n={s['n']} mean={s['mean_ms']:.2f} ms p50={s['p50_ms']:.2f} ms "
+              f"p95={s['p95_ms']:.2f} ms max={s['max_ms']:.2f} ms")
+    print(report['metrics'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Acquisition throughput benchmark on simulated devices')
+    parser.add_argument('--minutes',type=float,default=1.0,help='benchmark duration in minutes')
+    parser.add_argument('--output',type=Path,default=None,help='folder for the output files, a temporary folder by default')
+    parser.add_argument('--no-gps',action='store_true',help='run without the simulated RTK rover')
+    parser.add_argument('--log-level',default='WARNING',help='logging level of the loggers, e.g. INFO or DEBUG')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(),format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.output is None:
+        with tempfile.TemporaryDirectory() as d:
+            print_report(run_benchmark(args.minutes,Path(d),not args.no_gps))
+    else:
+        print_report(run_benchmark(args.minutes,args.output,not args.no_gps))
@@ -0,0 +1,35 @@
+'''
+Integration time optimizer benchmark on a simulated spectrometer
+compares HDXXR_spectrometer.optimize (linear model) with optimize_bisection under several light levels,
+reporting device probes, wall time and the counts reached at the chosen integration time
+
+usage: python benchmark_optimizer.py [--time-scale 1.0]
+'''
+import argparse
+from HDX_spec import HDXXR_spectrometer
+from simulators import SimulatedSpectrometer
+
+light_levels = [1.0,0.3,0.05] #clear sky, thin clouds, heavy clouds
+
+def run_optimizer(method:str,light_level:float,time_scale:float,serial_number:str,start_integration_time_ms:int=25) -> dict:
+    spec = SimulatedSpectrometer(serial_number,time_scale=time_scale)
+    spec.light_level = light_level
+    hdx = HDXXR_spectrometer(spec,integration_time_ms=start_integration_time_ms,boxcar_size=1)
+    getattr(hdx,method)()
+    spec.integration_time_micros(hdx.integration_time_ms*1000)
+    stats = dict(hdx.optimization_stats)
+    stats['max_count'] = float(spec.intensities().max())
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Integration time optimizer benchmark')
+    parser.add_argument('--time-scale',type=float,default=1.0,help='scale of the simulated integration times, 0 skips the waits')
+    args = parser.parse_args()
+    for light_level in light_levels:
+        runs = [('bisection',run_optimizer('optimize_bisection',light_level,args.time_scale,f'BISECT{light_level}')),
+                ('model',run_optimizer('optimize',light_level,args.time_scale,f'MODEL{light_level}')),
+                #same device again with 10 % less light, starts from the last optimal value
+                ('model warm start',run_optimizer('optimize',light_level*0.9,args.time_scale,f'MODEL{light_level}'))]
+        for name,stats in runs:
+            print(f"light {light_level:4.2f} {name:>16}: {stats['probes']:2d} probes, {stats['wall_time_s']:6.2f} s, "
+                  f"{stats['integration_time_ms']:8.3f} ms -> {stats['max_count']:.0f} counts")
@@ -0,0 +1,114 @@
+'''
+RTK stream reader benchmark against a local TCP stand-in of the Reach rover
+compares the byte-at-a-time reader used before with reach_rover.read_stream,
+reporting recv syscalls and CPU time per 1000 fixes, after checking that stale fixes are not used to tag samples
+
+usage: python benchmark_rtk.py [--fixes 2000] [--rate 200]
+'''
+import argparse
+import socket
+import time
+import multiprocessing
+from io import BytesIO
+from threading import Lock
+from rtk_gps import reach_rover
+from simulators import SimulatedReachServer
+
+def _serve(port_queue,rate_hz:float):
+    server = SimulatedReachServer(rate_hz=rate_hz)
+    port_queue.put(server.port)
+    server.serve().join()
+
+def start_server(rate_hz:float) -> tuple[multiprocessing.Process,int]:
+    '''runs the simulated rover in its own process so its CPU time is not counted'''
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve,args=(port_queue,rate_hz),daemon=True)
+    process.start()
+    return process,port_queue.get(timeout=10)
+
+def byte_at_a_time_reader(port:int,fixes:int) -> dict:
+    '''the reader reach_rover.spin used before, one recv call per byte and a new BytesIO per line'''
+    rover = reach_rover('127.0.0.1',port,Lock())
+    recv_calls = 0
+    lines = 0
+    bytes_buffer = BytesIO()
+    with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as sock:
+        sock.connect(('127.0.0.1',port))
+        sock.settimeout(5)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        while lines < fixes:
+            c = sock.recv(1)
+            recv_calls += 1
+            if (c == b'\n' or c == b'\r'):
+                line = bytes_buffer.getvalue().strip().decode('ascii')
+                if len(line) > 0:
+                    rover.parse_stream(line)
+                    lines += 1
+                bytes_buffer.close()
+                bytes_buffer = BytesIO()
+            else:
+                bytes_buffer.write(c)
+    return {'fixes':lines,'recv_calls':recv_calls,'cpu_s':time.process_time()-cpu_start,'wall_s':time.perf_counter()-wall_start}
+
+def chunked_reader(port:int,fixes:int) -> dict:
+    rover = reach_rover('127.0.0.1',port,Lock())
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    thread = rover.spin()
+    while rover.stats['lines'] < fixes and thread.is_alive():
+        time.sleep(0.01)
+    cpu_s = time.process_time()-cpu_start
+    wall_s = time.perf_counter()-wall_start
+    rover.stop()
+    thread.join()
+    return {'fixes':rover.stats['lines'],'recv_calls':rover.stats['recv_calls'],'cpu_s':cpu_s,'wall_s':wall_s}
+
+def add_fixes(rover:reach_rover,start:float,seconds:int):
+    '''streams 5 Hz RTK fixed positions received 50 ms after their epoch'''
+    for i in range(5*seconds):
+        gps_time = time.strftime('%Y/%m/%d %H:%M:%S',time.gmtime(start+i//5)) + f'.{200*(i%5):03d}'
+        rover.parse_stream(f'{gps_time} 19.5{i:04d} -98.8460 2250.0 1 20 0.01 0.01 0.01 0 0 0 0.0 1.0',start+i*0.2+0.05)
+
+def check_stale_fixes() -> list[str]:
+    '''coordinates_at must return None (the loggers then fall back to the host time) once the fixes stop,
+    before the first fix and across a gap in the fixes, returns the failed checks'''
+    rover = reach_rover('127.0.0.1',0,Lock())
+    start = 1.7e9
+    add_fixes(rover,start,10)
+    last = start+49*0.2+0.05
+    failed = []
+    if rover.coordinates_at(start-60) is not None:
+        failed.append('position 60 s before the first fix')
+    if rover.coordinates_at(last+0.2) is None:
+        failed.append('no position 0.2 s after the last fix')
+    if rover.coordinates_at(last+120) is not None:
+        failed.append('position 120 s after the last fix')
+    rover._connected_fix = False #what spin() does when the connection drops
+    if rover.coordinates_at(last+0.2) is not None:
+        failed.append('position after the connection dropped')
+    add_fixes(rover,start+40,10) #reconnected after 30 s without fixes
+    if rover.coordinates_at(start+25.05) is not None:
+        failed.append('position interpolated across a 30 s gap')
+    if rover.coordinates_at(start+45.05) is None:
+        failed.append('no position after the reconnection')
+    return failed
+
+def print_result(name:str,result:dict):
+    per_1000 = 1000/result['fixes']
+    print(f"{name:>20}: {result['fixes']} fixes in {result['wall_s']:.1f} s, "
+          f"{result['recv_calls']*per_1000:.0f} recv calls and {result['cpu_s']*per_1000*1000:.1f} ms CPU per 1000 fixes")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RTK stream reader benchmark')
+    parser.add_argument('--fixes',type=int,default=2000,help='number of fixes read by each reader')
+    parser.add_argument('--rate',type=float,default=200,help='fixes per second streamed by the simulated rover')
+    args = parser.parse_args()
+    failed = check_stale_fixes()
+    print('stale fix check: ' + ('; '.join(failed) if failed else 'ok'))
+    if failed:
+        raise SystemExit(1)
+    for name,reader in [('byte at a time',byte_at_a_time_reader),('chunked',chunked_reader)]:
+        process,port = start_server(args.rate)
+        print_result(name,reader(port,args.fixes))
+        process.terminate()
@@ -0,0 +1,200 @@
+'''
+Binary columnar logs (HDF5 tables) for the temperature and NDVI/PRI streams
+columns are typed, sensor ids, positions and index types are stored as small integer codes
+(the code lists are kept as table attributes) and rows are appended in batches.
+datetime_iso is stored as datetime_s, the naive ISO date and time read as UTC seconds since epoch,
+so it converts back to exactly the same string.
+
+usage: python binary_logs.py to-h5 <csv files> | to-csv <h5 files>
+'''
+import argparse
+import time
+import numpy as np
+import tables
+from pathlib import Path
+from utils import SensorPosition,naive_seconds
+
+class TemperatureRecord(tables.IsDescription):
+    timestamp = tables.Float64Col(pos=0)
+    datetime_s = tables.Float64Col(pos=1)
+    quality_fix = tables.Int8Col(pos=2)
+    lat = tables.Float64Col(pos=3)
+    long = tables.Float64Col(pos=4)
+    alt = tables.Float64Col(pos=5)
+    sensor_id = tables.UInt8Col(pos=6)
+    sensor_position = tables.UInt8Col(pos=7)
+    sensorbody_temp_C = tables.Float64Col(pos=8)
+    target_temp_C = tables.Float64Col(pos=9)
+    thermistor_mV = tables.Float64Col(pos=10,dflt=np.nan)
+    thermopile_mV = tables.Float64Col(pos=11,dflt=np.nan)
+
+class IndexRecord(tables.IsDescription):
+    timestamp = tables.Float64Col(pos=0)
+    datetime_s = tables.Float64Col(pos=1)
+    quality_fix = tables.Int8Col(pos=2)
+    latitude = tables.Float64Col(pos=3)
+    longitude = tables.Float64Col(pos=4)
+    altitude = tables.Float64Col(pos=5)
+    sensor_id = tables.UInt8Col(pos=6)
+    sensor_position = tables.UInt8Col(pos=7)
+    type = tables.UInt8Col(pos=8)
+    index_value = tables.Float64Col(pos=9)
+
+#row dtypes of the tables, producers fill arrays of them and append them with BinaryLog.extend
+temperature_dtype = tables.dtype_from_descr(TemperatureRecord)
+index_dtype = tables.dtype_from_descr(IndexRecord)
+
+#csv header of each stream, same order as the records except datetime_iso/datetime_s
+temperature_columns = ['timestamp','datetime_iso','quality_fix','lat','long','alt','sensor_id','sensor_position','sensorbody_temp_C','target_temp_C','thermistor_mV','thermopile_mV']
+index_columns = ['timestamp','datetime_iso','quality_fix','latitude','longitude','altitude','sensor_id','sensor_position','type','index_value']
+index_types = ['NDVI','PRI']
+position_names = [p.name.upper() for p in SensorPosition]
+filters = tables.Filters(complevel=5,complib='blosc')
+
+def iso_to_seconds(datetime_iso:np.ndarray) -> np.ndarray:
+    import pandas as pd #only the csv conversions need pandas, the loggers import this module
+    values = pd.to_datetime(pd.Series(datetime_iso).replace('',None)).to_numpy(dtype='datetime64[ns]')
+    seconds = values.astype(np.int64)/1e9
+    seconds[np.isnat(values)] = np.nan
+    return seconds
+
+def seconds_to_iso(datetime_s:np.ndarray) -> np.ndarray:
+    valid = np.isfinite(datetime_s)
+    milliseconds = np.zeros(datetime_s.shape,dtype=np.int64)
+    milliseconds[valid] = np.round(datetime_s[valid]*1000)
+    iso = np.char.replace(np.datetime_as_string(milliseconds.astype('datetime64[ms]')),'T',' ')
+    iso[~valid] = ''
+    return iso
+
+class BinaryLog():
+    '''Appends rows to a compressed HDF5 table in batches
+    rows are buffered in a NumPy record array and appended every batch_rows rows or flush_interval_s seconds'''
+    def __init__(self,h5_path:Path,description:tables.IsDescription,title:str,codes:dict,batch_rows:int=256,flush_interval_s:float=5.0) -> None:
+        self.file = tables.open_file(h5_path,'w')
+        self.table = self.file.create_table(self.file.root,'log',description,title,filters=filters)
+        for name,values in codes.items(): #{column:[code 0 name,code 1 name,...]}
+            self.table.attrs[name] = list(values)
+        self.codes = {name:{value:code for code,value in enumerate(values)} for name,values in codes.items()}
+        self._batch = np.zeros(batch_rows,dtype=self.table.dtype)
+        self._rows = 0
+        self.flush_interval_s = flush_interval_s
+        self._last_flush = time.monotonic()
+
+    def code(self,column:str,value:str) -> int:
+        return self.codes[column][value]
+
+    def append(self,row:tuple):
+        self._batch[self._rows] = row
+        self._rows += 1
+        if self._rows == len(self._batch) or time.monotonic()-self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def extend(self,records:np.ndarray):
+        '''appends an array of rows of the table dtype, copied into the batch buffer'''
+        start = 0
+        while start < len(records):
+            n = min(len(records)-start,len(self._batch)-self._rows)
+            self._batch[self._rows:self._rows+n] = records[start:start+n]
+            self._rows += n
+            start += n
+            if self._rows == len(self._batch):
+                self.flush()
+        if time.monotonic()-self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self):
+        if self._rows > 0:
+            self.table.append(self._batch[:self._rows])
+            self.table.flush()
+            self._rows = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def temperature_log(h5_path:Path,sensor_ids:list[str]) -> BinaryLog:
+    return BinaryLog(h5_path,TemperatureRecord,'IRR temperature log',{'sensor_id':sensor_ids,'sensor_position':position_names})
+
+def index_log(h5_path:Path,sensor_ids:list[str]) -> BinaryLog:
+    return BinaryLog(h5_path,IndexRecord,'NDVI and PRI log',{'sensor_id':sensor_ids,'sensor_position':position_names,'type':index_types})
+
+def load_log(h5_path:Path) -> tuple[np.ndarray,dict]:
+    '''reads a whole binary log in one array read, returns (records,{column:code names})'''
+    with tables.open_file(h5_path,'r') as f:
+        table = f.root.log
+        codes = {name:list(table.attrs[name]) for name in table.attrs._v_attrnamesuser}
+        return table.read(),codes
+
+def _encode(values:np.ndarray,names:list) -> np.ndarray:
+    lookup = {name:code for code,name in enumerate(names)}
+    return np.array([lookup[v] for v in values],dtype=np.uint8)
+
+def csv_to_h5(csv_path:Path,h5_path:Path) -> int:
+    '''converts a temperature or NDVI/PRI csv log to the binary format, returns the number of rows'''
+    import pandas as pd
+    df = pd.read_csv(csv_path,dtype={'sensor_id':str,'datetime_iso':str},keep_default_na=False,na_values={'thermistor_mV':[''],'thermopile_mV':['']})
+    is_temperature = 'sensorbody_temp_C' in df.columns
+    sensor_ids = list(dict.fromkeys(df['sensor_id']))
+    log = temperature_log(h5_path,sensor_ids) if is_temperature else index_log(h5_path,sensor_ids)
+    with log:
+        records = np.zeros(len(df),dtype=log.table.dtype)
+        for name in records.dtype.names:
+            if name == 'datetime_s':
+                records[name] = iso_to_seconds(df['datetime_iso'].to_numpy())
+            elif name in log.codes:
+                records[name] = _encode(df[name].to_numpy(),list(log.table.attrs[name]))
+            elif name in df.columns:
+                records[name] = df[name].to_numpy()
+            else: #raw voltages are missing in older temperature logs
+                records[name] = np.nan
+        log.table.append(records)
+    return len(df)
+
+def h5_to_csv(h5_path:Path,csv_path:Path) -> int:
+    '''converts a binary log back to the csv schema written by the loggers, returns the number of rows'''
+    import pandas as pd
+    records,codes = load_log(h5_path)
+    is_temperature = 'sensorbody_temp_C' in records.dtype.names
+    columns = temperature_columns if is_temperature else index_columns
+    df = pd.DataFrame(index=range(len(records)))
+    for name in columns:
+        if name == 'datetime_iso':
+            df[name] = seconds_to_iso(records['datetime_s'])
+        elif name in codes:
+            df[name] = np.array(codes[name],dtype=object)[records[name]]
+        elif name in ('lat','long','latitude','longitude'):
+            df[name] = np.char.mod('%.9f',records[name])
+        elif name in ('alt','altitude'):
+            df[name] = np.char.mod('%.4f',records[name])
+        elif name in ('thermistor_mV','thermopile_mV'):
+            df[name] = np.where(np.isnan(records[name]),'',np.char.mod('%.9f',records[name]))
+        elif name == 'index_value':
+            df[name] = [repr(v) for v in records[name].tolist()]
+        elif name == 'quality_fix':
+            df[name] = records[name]
+        else:
+            df[name] = np.char.mod('%.6f',records[name])
+    df.to_csv(csv_path,index=False,lineterminator='\n')
+    return len(df)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert temperature and NDVI/PRI logs between csv and binary (HDF5)')
+    parser.add_argument('direction',choices=['to-h5','to-csv'])
+    parser.add_argument('paths',type=Path,nargs='+')
+    args = parser.parse_args()
+    for path in args.paths:
+        start = time.perf_counter()
+        if args.direction == 'to-h5':
+            output_path = path.with_suffix('.h5')
+            rows = csv_to_h5(path,output_path)
+        else:
+            output_path = path.with_suffix('.txt')
+            rows = h5_to_csv(path,output_path)
+        print(f'{path.name}: {rows} rows in {time.perf_counter()-start:.2f} s -> {output_path.name}')
@@ -0,0 +1,98 @@
+'''
+Dark current model of a spectrometer
+dark counts grow linearly with the integration time (bias + thermal current), so dark spectra captured at a
+few integration times are fitted per pixel as offset + rate*t and the dark reference for any integration time
+is computed from the fit instead of covering the fiber again.
+The current is thermal, the model keeps the detector temperature of the capture (when the device reports it)
+and is only used while the detector stays within tolerance_C of it. Without a temperature the model is only
+used for max_age_s after its capture.
+
+models are cached per serial number for the process and saved in the calibration group of every session
+(calibration/<POSITION>/<uplooking|downlooking>_dark_model), load_dark_models() restores them from a session
+'''
+import numpy as np
+import tables
+from pathlib import Path
+from time import time
+
+tolerance_C = 2.0
+max_age_s = 1800.0 #used instead of the temperature when the device does not report one
+dark_models = {} #{serial number:DarkCurrentModel} of this process
+
+class DarkCurrentModel():
+    def __init__(self,integration_times_ms:np.ndarray,offset:np.ndarray,rate:np.ndarray,detector_temperature_C:float=None,
+                 serial_number:str=None,residual_counts:float=None,captured_at:float=None) -> None:
+        self.integration_times_ms = np.asarray(integration_times_ms,dtype=np.float64)
+        self.offset = np.asarray(offset,dtype=np.float64)
+        self.rate = np.asarray(rate,dtype=np.float64) #counts/ms
+        self.detector_temperature_C = detector_temperature_C
+        self.serial_number = serial_number
+        self.residual_counts = residual_counts #rms of the fit
+        self.captured_at = captured_at #epoch seconds of the dark captures
+
+    @classmethod
+    def fit(cls,integration_times_ms:list[float],dark_spectra:np.ndarray,detector_temperature_C:float=None,serial_number:str=None) -> 'DarkCurrentModel':
+        '''least squares line per pixel, dark_spectra: one row per integration time'''
+        t = np.asarray(integration_times_ms,dtype=np.float64)
+        dark_spectra = np.asarray(dark_spectra,dtype=np.float64)
+        if len(np.unique(t)) < 2:
+            raise ValueError('the dark current model needs dark spectra at two or more integration times')
+        rate,offset = np.polyfit(t,dark_spectra,1)
+        residual = dark_spectra-(offset+rate*t[:,None])
+        return cls(t,offset,rate,detector_temperature_C,serial_number,float(np.sqrt(np.mean(residual**2))),time())
+
+    def dark(self,integration_time_ms) -> np.ndarray:
+        '''dark spectrum at an integration time, or one row per integration time for an array of them'''
+        t = np.asarray(integration_time_ms,dtype=np.float64)
+        return self.offset+self.rate*t[...,None] if t.ndim > 0 else self.offset+self.rate*float(t)
+
+    def valid_for(self,detector_temperature_C:float=None,now:float=None) -> bool:
+        '''False if the detector temperature moved more than tolerance_C since the capture,
+        if either temperature is unknown False once the model is older than max_age_s (or its age is unknown)'''
+        if detector_temperature_C is None or self.detector_temperature_C is None:
+            if self.captured_at is None:
+                return False
+            return (time() if now is None else now)-self.captured_at <= max_age_s
+        return abs(detector_temperature_C-self.detector_temperature_C) <= tolerance_C
+
+    def save(self,h5_file:tables.File,parent_group:tables.Group,name:str) -> tables.Group:
+        group = h5_file.create_group(parent_group,name,'Dark counts = offset + rate*integration time (ms) per pixel')
+        h5_file.create_array(group,'integration_times_ms',self.integration_times_ms,'integration times of the dark captures')
+        h5_file.create_array(group,'offset',self.offset)
+        h5_file.create_array(group,'rate',self.rate,'counts/ms')
+        group._v_attrs.detector_temperature_C = np.nan if self.detector_temperature_C is None else self.detector_temperature_C
+        group._v_attrs.serial_number = self.serial_number or ''
+        group._v_attrs.residual_counts = np.nan if self.residual_counts is None else self.residual_counts
+        group._v_attrs.captured_at = np.nan if self.captured_at is None else self.captured_at
+        return group
+
+    @classmethod
+    def load(cls,group:tables.Group) -> 'DarkCurrentModel':
+        attrs = group._v_attrs
+        temperature = float(attrs.detector_temperature_C)
+        residual = float(attrs.residual_counts)
+        captured_at = float(getattr(attrs,'captured_at',np.nan)) #not saved by older sessions
+        return cls(group.integration_times_ms.read(),group.offset.read(),group.rate.read(),
+                   None if np.isnan(temperature) else temperature,str(attrs.serial_number) or None,None if np.isnan(residual) else residual,
+                   None if np.isnan(captured_at) else captured_at)
+
+def detector_temperature_C(spec) -> float|None:
+    '''first temperature sensor of the seabreeze temperature feature, None if the device does not report one'''
+    try:
+        return float(spec.f.temperature.temperature_get_all()[0])
+    except Exception: #no temperature feature (backend, model or simulator)
+        return None
+
+def load_dark_models(h5_path:Path) -> dict:
+    '''adds the dark models saved in a session to the cache, returns {serial number:model}'''
+    loaded = {}
+    with tables.open_file(h5_path,'r') as f:
+        if 'calibration' not in f.root:
+            return loaded
+        for node in f.walk_nodes(f.root.calibration,'Group'):
+            if node._v_name.endswith('_dark_model'):
+                model = DarkCurrentModel.load(node)
+                if model.serial_number:
+                    loaded[model.serial_number] = model
+    dark_models.update(loaded)
+    return loaded
@@ -0,0 +1,73 @@
+'''
+Import time report of the GUI and the acquisition modules
+every module is imported in a fresh interpreter with python -X importtime, the report shows its total
+import time (without the interpreter startup) and its most expensive dependencies, so startup
+regressions show up before they reach the field tablets.
+The GUI must not import the device drivers, they are loaded when a subsystem is first used.
+NumPy is the one heavy import allowed at GUI startup, the shared state the GUI creates before any logger
+starts (recent_data ring buffers, metrics histograms, the rtk_gps fix history) is made of NumPy arrays,
+so the GUI budget includes it.
+
+usage: python import_report.py [modules] [--top 10] [--budget-ms 300]
+'''
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+default_modules = ['GUI','HDX_spec','IRR_labjack','sdi12_sensors','rtk_gps']
+#loaded on demand by the GUI (see GUI.MainApp), importing one of them at startup is a regression
+driver_modules = ['seabreeze','u6','serial','tables','pandas','HDX_spec','IRR_labjack','sdi12_sensors']
+gui_budget_ms = 300 #about a third of it is NumPy
+
+def import_times(statement:str) -> list[tuple[str,int,int]]:
+    '''(module,self us,cumulative us) of every top level and nested import of statement, in import order'''
+    result = subprocess.run([sys.executable,'-X','importtime','-c',statement],capture_output=True,text=True,cwd=Path(__file__).parent)
+    if result.returncode != 0:
+        raise ImportError(f'{statement} failed: {result.stderr.strip().splitlines()[-1]}')
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line: #header and driver warnings
+            continue
+        self_us,cumulative_us,name = line[len('import time:'):].split('|')
+        times.append((name[1:].rstrip(),int(self_us),int(cumulative_us))) #nested imports keep their indentation
+    return times
+
+def module_report(module:str,baseline:set) -> dict:
+    '''total ms and {package:cumulative ms} of the imports not done by the bare interpreter,
+    submodules are left out of the dependencies since their time is part of their package'''
+    times = [(name,self_us,cumulative_us) for name,self_us,cumulative_us in import_times(f'import {module}') if name.strip() not in baseline]
+    top_level = [cumulative_us for name,_,cumulative_us in times if not name.startswith(' ')]
+    return {'module':module,
+            'total_ms':sum(top_level)/1000,
+            'imported':{name.strip() for name,_,_ in times},
+            'dependencies':{name.strip():cumulative_us/1000 for name,_,cumulative_us in times if name.strip() != module and '.' not in name}}
+
+def print_report(reports:list[dict],top:int):
+    for report in reports:
+        print(f"{report['module']}: {report['total_ms']:.1f} ms")
+        dependencies = sorted(report['dependencies'].items(),key=lambda item: item[1],reverse=True)[:top]
+        for name,ms in dependencies:
+            print(f'    {name:<40} {ms:>8.1f} ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per module import time report')
+    parser.add_argument('modules',nargs='*',default=default_modules)
+    parser.add_argument('--top',type=int,default=10,help='dependencies listed per module')
+    parser.add_argument('--budget-ms',type=float,default=gui_budget_ms,help='exit with an error if the GUI import (including NumPy) takes longer')
+    args = parser.parse_args()
+    baseline = {name.strip() for name,_,_ in import_times('pass')}
+    reports = [module_report(module,baseline) for module in args.modules]
+    print_report(reports,args.top)
+    failed = False
+    for report in reports:
+        if report['module'] != 'GUI':
+            continue
+        drivers = [name for name in driver_modules if name in report['imported']]
+        if drivers:
+            print(f"GUI imports device drivers at startup: {', '.join(drivers)}")
+            failed = True
+        if report['total_ms'] > args.budget_ms:
+            print(f"GUI import takes {report['total_ms']:.1f} ms, budget {args.budget_ms:.0f} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
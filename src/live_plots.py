@@ -0,0 +1,65 @@
+'''
+Lightweight live plots for the GUI drawn on Tk canvases
+every series is min-max reduced to the canvas width before drawing, so the redraw cost
+depends on the plot size and not on how many samples are in the plotted window
+'''
+import tkinter as tk
+import numpy as np
+
+line_colors = ['#1f77b4','#d62728','#2ca02c','#ff7f0e','#9467bd','#8c564b']
+
+def minmax_decimate(x:np.ndarray,y:np.ndarray,buckets:int) -> tuple[np.ndarray,np.ndarray]:
+    '''reduces a series sorted by x to the min and max of y in each of buckets equal x intervals
+    (2 points per bucket), keeps the peaks that plain subsampling would drop, non finite values are removed'''
+    finite = np.isfinite(x) & np.isfinite(y)
+    x,y = x[finite],y[finite]
+    if len(x) <= 2*buckets or x[-1] <= x[0]:
+        return x,y
+    edges = np.linspace(x[0],x[-1],buckets+1)
+    bucket = np.clip(np.searchsorted(edges,x,side='right')-1,0,buckets-1)
+    starts = np.flatnonzero(np.r_[True,bucket[1:] != bucket[:-1]])
+    y_pairs = np.column_stack([np.minimum.reduceat(y,starts),np.maximum.reduceat(y,starts)])
+    return np.repeat(x[starts],2),y_pairs.ravel()
+
+class LivePlot(tk.Canvas):
+    '''line plot of a few series with autoscaled y axis, plot() redraws everything'''
+    margin = 36
+
+    def __init__(self,master,title:str,width:int=360,height:int=150,**kwargs) -> None:
+        super().__init__(master,width=width,height=height,background='white',highlightthickness=0,**kwargs)
+        self.title = title
+        self.width = width
+        self.height = height
+
+    def plot(self,series:dict,x_range:tuple[float,float]=None,x_label:str=''):
+        '''series: {label:(x,y)}, x_range: fixed x limits, by default the limits of the data'''
+        self.delete('all')
+        self.create_text(self.width/2,8,text=self.title,font=('TkDefaultFont',8,'bold'))
+        plot_width = self.width-self.margin-6
+        reduced = {label:minmax_decimate(np.asarray(x,dtype=np.float64),np.asarray(y,dtype=np.float64),plot_width)
+                   for label,(x,y) in series.items()}
+        reduced = {label:xy for label,xy in reduced.items() if len(xy[0]) > 0}
+        if not reduced:
+            self.create_text(self.width/2,self.height/2,text='sin datos',fill='grey')
+            return
+        all_x = np.concatenate([x for x,_ in reduced.values()])
+        all_y = np.concatenate([y for _,y in reduced.values()])
+        x0,x1 = (all_x.min(),all_x.max()) if x_range is None else x_range
+        y0,y1 = all_y.min(),all_y.max()
+        padding = 0.05*(y1-y0) if y1 > y0 else 0.5*max(abs(y0),1e-3)
+        y0,y1 = y0-padding,y1+padding
+        x1 = x1 if x1 > x0 else x0+1
+        left,top,bottom = self.margin,18,self.height-16
+        self.create_rectangle(left,top,left+plot_width,bottom,outline='grey')
+        self.create_text(left-2,top,text=f'{y1:.3g}',anchor='ne',font=('TkDefaultFont',7))
+        self.create_text(left-2,bottom,text=f'{y0:.3g}',anchor='se',font=('TkDefaultFont',7))
+        self.create_text(left+plot_width,bottom+2,text=x_label,anchor='ne',font=('TkDefaultFont',7))
+        for i,(label,(x,y)) in enumerate(reduced.items()):
+            color = line_colors[i % len(line_colors)]
+            px = left+(x-x0)/(x1-x0)*plot_width
+            py = bottom-(y-y0)/(y1-y0)*(bottom-top)
+            if len(px) > 1:
+                self.create_line(*np.column_stack([px,py]).ravel().tolist(),fill=color)
+            else:
+                self.create_oval(px[0]-2,py[0]-2,px[0]+2,py[0]+2,fill=color,outline=color)
+            self.create_text(left+4+60*i,top+2,text=label,anchor='nw',fill=color,font=('TkDefaultFont',7))
@@ -0,0 +1,228 @@
+'''
+As-of join of the temperature, NDVI/PRI and spectra logs of a session onto one timeline
+the temperature log is the timeline: every temperature row gets the NDVI, PRI and spectra frame of the
+same sensor position closest in time (nearest) or the last one before it (backward), within a tolerance.
+
+only the timestamp and key columns of the other streams are loaded, as sorted arrays per position,
+the temperature log is read and written in chunks and only the timestamp and frame index columns of
+the spectra tables are kept (the output has the frame index to fetch the spectra), so a full day
+merges in seconds and the spectra never have to fit in memory.
+Every row already carries the rover position of its logger, the GPS columns come from the temperature rows.
+
+a session is a temperature log, the NDVI/PRI and spectra files are the ones of the same day and trial
+(YYYYMMdd_<trial>_SDI12, YYYYMMdd_<trial>_spec folders) whose time range overlaps it
+
+usage: python merge_sessions.py <temp files or folders> [--tolerance 1.0] [--direction nearest]
+'''
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import tables
+from pathlib import Path
+from typing import Iterator
+from binary_logs import temperature_columns,seconds_to_iso
+from utils import temperature_suffix,merged_suffix
+
+index_types = ['NDVI','PRI']
+
+def asof_indices(times:np.ndarray,keys:np.ndarray,tolerance_s:float,direction:str='nearest') -> np.ndarray:
+    '''index of the key matched to every time, -1 if there is none within tolerance_s
+    keys must be sorted, backward: last key <= time, nearest: closest key on either side'''
+    match = np.full(len(times),-1,dtype=np.int64)
+    if len(keys) == 0:
+        return match
+    before = np.searchsorted(keys,times,side='right')-1
+    candidate = before
+    if direction == 'nearest':
+        after = np.minimum(before+1,len(keys)-1)
+        use_after = (before < 0) | (keys[after]-times < times-keys[np.maximum(before,0)])
+        candidate = np.where(use_after,after,before)
+    valid = candidate >= 0
+    valid[valid] = np.abs(keys[candidate[valid]]-times[valid]) <= tolerance_s
+    match[valid] = candidate[valid]
+    return match
+
+class Timeline():
+    '''timestamps of one stream sorted per key, with the values returned for the matched rows
+    parts: [(key,timestamps,{name:values})], the parts of the same key (e.g. one per file) are merged'''
+    def __init__(self,parts:list[tuple[str,np.ndarray,dict[str,np.ndarray]]],names:list[str]) -> None:
+        grouped = {}
+        for key,timestamps,values in parts:
+            grouped.setdefault(key,[]).append((timestamps,values))
+        timestamps,values,self.slices = [],{name:[] for name in names},{}
+        start = 0
+        for key,key_parts in grouped.items():
+            key_timestamps = np.concatenate([t for t,_ in key_parts])
+            order = np.argsort(key_timestamps,kind='stable')
+            timestamps.append(key_timestamps[order])
+            for name in names:
+                values[name].append(np.concatenate([v[name] for _,v in key_parts])[order])
+            self.slices[key] = slice(start,start+len(order))
+            start += len(order)
+        self.timestamps = np.concatenate(timestamps) if timestamps else np.array([])
+        self.values = {name:np.concatenate(columns) if columns else np.array([]) for name,columns in values.items()}
+
+    def join(self,keys:np.ndarray,times:np.ndarray,tolerance_s:float,direction:str) -> tuple[np.ndarray,np.ndarray]:
+        '''row of the timeline matched to every (key,time), -1 if there is none, and its time offset in seconds'''
+        match = np.full(len(times),-1,dtype=np.int64)
+        for key in np.unique(keys):
+            if key not in self.slices:
+                continue
+            rows = keys == key
+            part = self.slices[key]
+            found = asof_indices(times[rows],self.timestamps[part],tolerance_s,direction)
+            match[rows] = np.where(found >= 0,found+part.start,-1)
+        offset = np.full(len(times),np.nan)
+        matched = match >= 0
+        offset[matched] = self.timestamps[match[matched]]-times[matched]
+        return match,offset
+
+    def take(self,name:str,match:np.ndarray,fill) -> np.ndarray:
+        '''values of the matched rows, fill where there is no match'''
+        values = np.full(len(match),fill,dtype=np.result_type(self.values[name],type(fill)))
+        matched = match >= 0
+        values[matched] = self.values[name][match[matched]]
+        return values
+
+def _sibling_files(temp_path:Path,content:str,pattern:str) -> list[Path]:
+    '''files of another stream of the same day and trial, YYYYMMdd_<trial>_temp -> YYYYMMdd_<trial>_<content>'''
+    folder = temp_path.parent
+    sibling = folder.with_name(folder.name[:-len('temp')] + content)
+    return sorted(sibling.glob(pattern)) if sibling.is_dir() else []
+
+def load_index_timeline(paths:list[Path]) -> Timeline:
+    '''NDVI/PRI rows of csv or binary logs, keyed by (position,type)'''
+    frames = []
+    for path in paths:
+        if path.suffix == '.h5':
+            with tables.open_file(path,'r') as f:
+                table = f.root.log
+                records = table.read()
+                frames.append(pd.DataFrame({'timestamp':records['timestamp'],
+                                            'sensor_position':np.array(table.attrs['sensor_position'],dtype=object)[records['sensor_position']],
+                                            'type':np.array(table.attrs['type'],dtype=object)[records['type']],
+                                            'index_value':records['index_value']}))
+        else:
+            frames.append(pd.read_csv(path,usecols=['timestamp','sensor_position','type','index_value']))
+    parts = [(f'{position}/{index_type}',group['timestamp'].to_numpy(dtype=np.float64),{'index_value':group['index_value'].to_numpy(dtype=np.float64)})
+             for df in frames for (position,index_type),group in df.groupby(['sensor_position','type'])]
+    return Timeline(parts,['index_value'])
+
+def load_spectra_timeline(paths:list[Path]) -> Timeline:
+    '''frame timestamps of raw spectra sessions keyed by position, only the timestamp and index columns are read'''
+    parts = []
+    for file_number,path in enumerate(paths):
+        with tables.open_file(path,'r') as f:
+            for group in f.root.spectrometers._f_iter_nodes('Group'):
+                if 'raw' not in group:
+                    continue
+                table = group.raw
+                parts.append((group._v_name,table.col('timestamp'),{'index':table.col('index').astype(np.int64),
+                                                                    'file':np.full(table.nrows,file_number,dtype=np.int64)}))
+    return Timeline(parts,['index','file'])
+
+def time_range(path:Path) -> tuple[float,float]:
+    '''first and last timestamp of a log, only the first and last rows of the binary tables are read (rows are
+    appended in time order), the csv logs are read for the timestamp column. (inf,-inf) for an empty log'''
+    if path.stat().st_size == 0: #created when the session started but never written
+        return (np.inf,-np.inf)
+    if path.suffix == '.h5':
+        with tables.open_file(path,'r') as f:
+            times = [table.read(row,row+1,field='timestamp') for table in f.walk_nodes('/','Table') for row in {0,max(table.nrows-1,0)}]
+        times = np.concatenate(times) if times else np.array([])
+    else:
+        times = pd.read_csv(path,usecols=['timestamp'])['timestamp'].to_numpy()
+    return (float(times.min()),float(times.max())) if len(times) else (np.inf,-np.inf)
+
+def overlapping(paths:list[Path],start:float,end:float,tolerance_s:float) -> list[Path]:
+    result = []
+    for path in paths:
+        first,last = time_range(path)
+        if first <= end+tolerance_s and last >= start-tolerance_s:
+            result.append(path)
+    return result
+
+def temperature_chunks(path:Path,chunk_rows:int) -> Iterator[pd.DataFrame]:
+    '''temperature log in blocks of chunk_rows rows with the csv columns, from a csv or a binary log'''
+    if path.suffix != '.h5':
+        yield from pd.read_csv(path,chunksize=chunk_rows,dtype={'sensor_id':str,'datetime_iso':str},keep_default_na=False,
+                               na_values={'thermistor_mV':[''],'thermopile_mV':['']})
+        return
+    with tables.open_file(path,'r') as f:
+        table = f.root.log
+        codes = {name:np.array(table.attrs[name],dtype=object) for name in table.attrs._v_attrnamesuser}
+        for start in range(0,table.nrows,chunk_rows):
+            records = table.read(start,min(start+chunk_rows,table.nrows))
+            df = pd.DataFrame(index=range(len(records)))
+            for name in temperature_columns:
+                if name == 'datetime_iso':
+                    df[name] = seconds_to_iso(records['datetime_s'])
+                elif name in codes:
+                    df[name] = codes[name][records[name]]
+                else:
+                    df[name] = records[name]
+            yield df
+
+def merged_output(temp_path:Path) -> Path:
+    return temp_path.with_name(temp_path.stem + merged_suffix + '.txt')
+
+def session_inputs(temp_path:Path,tolerance_s:float=1.0) -> tuple[list[Path],list[Path]]:
+    '''(NDVI/PRI files,spectra files) overlapping the temperature log'''
+    start,end = time_range(temp_path)
+    sdi12_files = overlapping(_sibling_files(temp_path,'SDI12','*_SDI12_*.txt')+_sibling_files(temp_path,'SDI12','*_SDI12_*.h5'),start,end,tolerance_s)
+    spec_files = overlapping(_sibling_files(temp_path,'spec','*_spec_*.h5'),start,end,tolerance_s)
+    return sdi12_files,spec_files
+
+def merge_session(temp_path:Path,output_path:Path=None,tolerance_s:float=1.0,direction:str='nearest',chunk_rows:int=65536) -> int:
+    '''Writes the temperature log with the joined NDVI, PRI and spectra frame columns, returns the number of rows
+    <type> and <type>_dt_s: index value and its time offset from the temperature row,
+    spectra_file, spectra_index and spectra_dt_s: raw spectra session and frame of the same position
+    unmatched rows get empty values'''
+    output_path = output_path or merged_output(temp_path)
+    sdi12_files,spec_files = session_inputs(temp_path,tolerance_s)
+    indices = load_index_timeline(sdi12_files)
+    spectra = load_spectra_timeline(spec_files)
+    spec_names = np.array([path.name for path in spec_files]+[''],dtype=object) #-1 picks ''
+    rows = 0
+    try:
+        with output_path.open('w',encoding='utf-8',newline='') as f:
+            for df in temperature_chunks(temp_path,chunk_rows):
+                times = df['timestamp'].to_numpy(dtype=np.float64)
+                positions = df['sensor_position'].to_numpy(dtype=str)
+                for index_type in index_types:
+                    match,offset = indices.join(np.char.add(positions,'/'+index_type),times,tolerance_s,direction)
+                    df[index_type.lower()] = indices.take('index_value',match,np.nan)
+                    df[f'{index_type.lower()}_dt_s'] = offset
+                match,offset = spectra.join(positions,times,tolerance_s,direction)
+                frame_index = pd.array(spectra.take('index',match,-1),dtype='Int64')
+                frame_index[match < 0] = pd.NA
+                df['spectra_file'] = spec_names[spectra.take('file',match,-1)]
+                df['spectra_index'] = frame_index
+                df['spectra_dt_s'] = offset
+                df.to_csv(f,index=False,header=rows == 0,lineterminator='\n')
+                rows += len(df)
+    except Exception: #no partial output, it would look up to date to reprocess_sessions
+        output_path.unlink(missing_ok=True)
+        raise
+    return rows
+
+def find_temperature_logs(paths:list[Path]) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(f for f in path.rglob('*_temp_*.*') if f.suffix in ('.txt','.h5') and not f.stem.endswith((temperature_suffix,merged_suffix))))
+        else:
+            files.append(path)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Join the NDVI/PRI and spectra logs onto the timeline of the temperature logs')
+    parser.add_argument('paths',type=Path,nargs='+',help='temperature logs or folders to search for them')
+    parser.add_argument('--tolerance',type=float,default=1.0,help='largest time offset of a match in seconds')
+    parser.add_argument('--direction',choices=['nearest','backward'],default='nearest',help='backward only matches earlier or simultaneous rows')
+    args = parser.parse_args()
+    for path in find_temperature_logs(args.paths):
+        start = time.perf_counter()
+        rows = merge_session(path,tolerance_s=args.tolerance,direction=args.direction)
+        print(f'{path.name} -> {merged_output(path).name}: {rows} rows in {time.perf_counter()-start:.2f} s')
@@ -0,0 +1,147 @@
+'''
+Lightweight instrumentation of the acquisition loops
+fixed bucket latency histograms per sensor and stage (device_read, compute, write) and counters
+(samples, parse failures, timeouts, reconnects), exposed in Prometheus text format on a localhost
+HTTP endpoint and as a periodic summary line in the log
+
+    with stage_timer('irr','device_read'):
+        read()
+    count('samples','irr',3)
+    serve_metrics(9108)            #http://127.0.0.1:9108/metrics
+'''
+import logging
+import time
+import numpy as np
+from threading import Event,Lock,Thread
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+#seconds, upper bounds of the histogram buckets (+Inf is implicit)
+latency_buckets = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+stage_metric = 'phenocart_stage_seconds'
+counter_help = {'samples':'Samples acquired',
+                'parse_failures':'Device responses that could not be parsed',
+                'timeouts':'Device reads that timed out or got no answer',
+                'reconnects':'Connections opened again after a failure',
+                'missed_samples':'Stream samples lost by the device'}
+
+class Histogram():
+    def __init__(self,buckets:tuple=latency_buckets) -> None:
+        self.buckets = np.array(buckets)
+        self.counts = np.zeros(len(buckets)+1,dtype=np.int64) #last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self,value:float):
+        i = int(np.searchsorted(self.buckets,value,side='left')) #value <= upper bound
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self,q:float) -> float:
+        '''upper bound of the bucket holding the q quantile, inf if it is the +Inf bucket'''
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts),q*self.count,side='left'))
+        return float(self.buckets[i]) if i < len(self.buckets) else float('inf')
+
+class Registry():
+    '''histograms {(sensor,stage):Histogram} and counters {(name,sensor):int} of the process'''
+    def __init__(self) -> None:
+        self.histograms = {}
+        self.counters = {}
+        self._lock = Lock()
+
+    def histogram(self,sensor:str,stage:str) -> Histogram:
+        key = (sensor,stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key,Histogram())
+        return histogram
+
+    def count(self,name:str,sensor:str,n:int=1):
+        with self._lock:
+            self.counters[(name,sensor)] = self.counters.get((name,sensor),0) + n
+
+    def render(self) -> str:
+        '''Prometheus text exposition format'''
+        lines = [f'# HELP {stage_metric} Duration of every acquisition stage',f'# TYPE {stage_metric} histogram']
+        for (sensor,stage),histogram in sorted(self.histograms.items()):
+            labels = f'sensor="{sensor}",stage="{stage}"'
+            cumulative = np.cumsum(histogram.counts)
+            for bound,n in zip(list(histogram.buckets)+['+Inf'],cumulative):
+                lines.append(f'{stage_metric}_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'{stage_metric}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{stage_metric}_count{{{labels}}} {histogram.count}')
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name in dict.fromkeys(name for (name,_),_ in counters):
+            metric = f'phenocart_{name}_total'
+            lines += [f'# HELP {metric} {counter_help.get(name,name)}',f'# TYPE {metric} counter']
+            lines += [f'{metric}{{sensor="{sensor}"}} {n}' for (counter,sensor),n in counters if counter == name]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        '''one line with the mean and p95 bucket of every stage and the counters'''
+        stages = [f'{sensor}.{stage} {1000*h.sum/h.count:.1f}/{1000*h.quantile(0.95):.1f} ms'
+                  for (sensor,stage),h in sorted(self.histograms.items()) if h.count > 0]
+        with self._lock:
+            counters = [f'{sensor} {name} {n}' for (name,sensor),n in sorted(self.counters.items())]
+        return 'stages (mean/p95): ' + ', '.join(stages) + ' | ' + ', '.join(counters)
+
+registry = Registry()
+
+class stage_timer():
+    '''context manager observing the duration of a stage in the registry'''
+    __slots__ = ('histogram','start')
+
+    def __init__(self,sensor:str,stage:str) -> None:
+        self.histogram = registry.histogram(sensor,stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.histogram.observe(time.perf_counter()-self.start)
+
+def observe(sensor:str,stage:str,seconds:float):
+    registry.histogram(sensor,stage).observe(seconds)
+
+def count(name:str,sensor:str,n:int=1):
+    registry.count(name,sensor,n)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('','/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args): #no access log on every scrape
+        pass
+
+def serve_metrics(port:int=9108,host:str='127.0.0.1') -> ThreadingHTTPServer:
+    '''serves /metrics from a daemon thread, call shutdown() on the returned server to stop it'''
+    server = ThreadingHTTPServer((host,port),_MetricsHandler)
+    Thread(target=server.serve_forever,daemon=True,name='metrics').start()
+    log.info('metrics at http://%s:%d/metrics',host,server.server_address[1])
+    return server
+
+def log_summary_every(interval_s:float,stop_event:Event) -> Thread:
+    '''logs registry.summary() every interval_s seconds until stop_event is set'''
+    def run():
+        while not stop_event.wait(interval_s):
+            log.info(registry.summary())
+    thread = Thread(target=run,daemon=True,name='metrics-summary')
+    thread.start()
+    return thread
@@ -0,0 +1,309 @@
+'''
+Per plot statistics of the logged measurements
+the trial plots (GeoJSON polygons or a regular grid) are projected once to local metres and indexed in
+uniform grid buckets, points are assigned to plots in vectorized batches: every point is only tested
+against the polygons of its bucket (crossing number test on all the candidate edges at once).
+per plot count, mean, standard deviation, min and max are kept incrementally, so the logs are streamed
+in chunks and a day of millions of rows is aggregated with constant memory.
+
+points are the rover positions logged with every row, rows without a GPS fix (0,0) fall outside the plots
+
+usage: python plot_index.py <plots.geojson> <logs or folders> [-o plot_stats.csv] [--id-property plot]
+       python plot_index.py --grid <lat>,<lon>,<rows>,<columns>,<length m>,<width m>[,<heading deg>] <logs or folders>
+'''
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+import tables
+from pathlib import Path
+from merge_sessions import temperature_chunks
+from utils import temperature_suffix,merged_suffix
+
+earth_radius_m = 6371008.8
+
+class PlotIndex():
+    '''Plot polygons in local metres indexed by uniform grid buckets
+    plots: plot ids, polygons: [(plot number,[(lon,lat),...])], a plot can have several polygons
+    cell_m: bucket size in metres, half the median plot width by default'''
+    def __init__(self,plots:list[str],polygons:list[tuple[int,list]],cell_m:float=None) -> None:
+        self.plots = list(plots)
+        vertices = np.concatenate([np.asarray(ring,dtype=np.float64)[:,:2] for _,ring in polygons])
+        self.origin = (float(vertices[:,1].mean()),float(vertices[:,0].mean())) #(lat,lon)
+        rings = [self.project(np.asarray(ring)[:,1],np.asarray(ring)[:,0]) for _,ring in polygons]
+        self.polygon_plot = np.array([plot for plot,_ in polygons],dtype=np.int64)
+        #edges of every polygon as flat arrays, polygon i owns edges edge_start[i]:edge_start[i+1]
+        x0,y0,x1,y1,counts = [],[],[],[],[]
+        for x,y in rings:
+            x0.append(x)
+            y0.append(y)
+            x1.append(np.roll(x,-1))
+            y1.append(np.roll(y,-1))
+            counts.append(len(x))
+        self.edges = tuple(np.concatenate(e) for e in (x0,y0,x1,y1))
+        self.edge_start = np.concatenate([[0],np.cumsum(counts)])
+        boxes = np.array([(x.min(),y.min(),x.max(),y.max()) for x,y in rings])
+        #half the usual plot width, a point then has a couple of candidate polygons
+        self.cell_m = cell_m or 0.5*float(np.median(np.minimum(boxes[:,2]-boxes[:,0],boxes[:,3]-boxes[:,1])))
+        self.x_min,self.y_min = boxes[:,0].min(),boxes[:,1].min()
+        self.nx = int((boxes[:,2].max()-self.x_min)//self.cell_m)+1
+        self.ny = int((boxes[:,3].max()-self.y_min)//self.cell_m)+1
+        #polygons of every bucket as CSR arrays, bucket c holds cell_polygons[cell_start[c]:cell_start[c+1]]
+        cells,members = [],[]
+        for i,(x_low,y_low,x_high,y_high) in enumerate(boxes):
+            cx = np.arange(int((x_low-self.x_min)//self.cell_m),int((x_high-self.x_min)//self.cell_m)+1)
+            cy = np.arange(int((y_low-self.y_min)//self.cell_m),int((y_high-self.y_min)//self.cell_m)+1)
+            covered = (cy[:,None]*self.nx+cx[None,:]).ravel()
+            cells.append(covered)
+            members.append(np.full(len(covered),i))
+        cells,members = np.concatenate(cells),np.concatenate(members)
+        order = np.argsort(cells,kind='stable')
+        self.cell_polygons = members[order]
+        self.cell_start = np.searchsorted(cells[order],np.arange(self.nx*self.ny+1))
+
+    @classmethod
+    def from_geojson(cls,path:Path,id_property:str='plot',cell_m:float=None) -> 'PlotIndex':
+        '''Polygon and MultiPolygon features (outer rings only), the plot id is the id_property of the feature
+        or its position in the file'''
+        with open(path,encoding='utf-8') as f:
+            features = json.load(f)['features']
+        plots,polygons = [],[]
+        for i,feature in enumerate(features):
+            geometry = feature['geometry']
+            if geometry['type'] == 'Polygon':
+                parts = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                parts = geometry['coordinates']
+            else:
+                continue
+            plots.append(str((feature.get('properties') or {}).get(id_property,i)))
+            polygons.extend((len(plots)-1,part[0]) for part in parts)
+        if not polygons:
+            raise ValueError(f'{Path(path).name} has no polygon features')
+        return cls(plots,polygons,cell_m)
+
+    @classmethod
+    def grid(cls,latitude:float,longitude:float,rows:int,columns:int,length_m:float,width_m:float,heading_deg:float=0.0) -> 'PlotIndex':
+        '''regular grid of rows x columns plots of length_m (along the heading) by width_m, with the first corner of
+        plot "1-1" at (latitude,longitude), columns are to the right of the heading, plot ids are "<row>-<column>"'''
+        heading = np.radians(heading_deg)
+        forward = np.array([np.sin(heading),np.cos(heading)]) #(east,north)
+        right = np.array([np.cos(heading),-np.sin(heading)])
+        m_per_deg_lat = np.radians(1)*earth_radius_m
+        m_per_deg_lon = m_per_deg_lat*np.cos(np.radians(latitude))
+        plots,polygons = [],[]
+        for row in range(rows):
+            for column in range(columns):
+                corners = [(row+dr)*length_m*forward+(column+dc)*width_m*right for dr,dc in ((0,0),(1,0),(1,1),(0,1))]
+                plots.append(f'{row+1}-{column+1}')
+                polygons.append((len(plots)-1,[(longitude+e/m_per_deg_lon,latitude+n/m_per_deg_lat) for e,n in corners]))
+        return cls(plots,polygons)
+
+    def project(self,latitude:np.ndarray,longitude:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+        '''local east,north metres around the plots (equirectangular, fine at field scale)'''
+        lat0,lon0 = self.origin
+        x = np.radians(np.asarray(longitude,dtype=np.float64)-lon0)*earth_radius_m*np.cos(np.radians(lat0))
+        y = np.radians(np.asarray(latitude,dtype=np.float64)-lat0)*earth_radius_m
+        return x,y
+
+    def assign(self,latitude:np.ndarray,longitude:np.ndarray) -> np.ndarray:
+        '''plot number of every point, -1 outside the plots'''
+        x,y = self.project(latitude,longitude)
+        result = np.full(len(x),-1,dtype=np.int64)
+        cx = np.floor((x-self.x_min)/self.cell_m)
+        cy = np.floor((y-self.y_min)/self.cell_m)
+        in_grid = np.flatnonzero((cx >= 0) & (cx < self.nx) & (cy >= 0) & (cy < self.ny))
+        cell = (cy[in_grid]*self.nx+cx[in_grid]).astype(np.int64)
+        #(point,candidate polygon) pairs
+        starts = self.cell_start[cell]
+        counts = self.cell_start[cell+1]-starts
+        point = np.repeat(in_grid,counts)
+        candidate = self.cell_polygons[np.repeat(starts,counts)+_ranks(counts)]
+        #(pair,edge) crossing number test
+        edge_counts = self.edge_start[candidate+1]-self.edge_start[candidate]
+        pair = np.repeat(np.arange(len(candidate)),edge_counts)
+        edge = np.repeat(self.edge_start[candidate],edge_counts)+_ranks(edge_counts)
+        px,py = x[point[pair]],y[point[pair]]
+        x0,y0,x1,y1 = (e[edge] for e in self.edges)
+        straddles = (y0 > py) != (y1 > py)
+        with np.errstate(divide='ignore',invalid='ignore'): #horizontal edges never straddle
+            crosses = straddles & (px < x0+(py-y0)*(x1-x0)/(y1-y0))
+        inside = np.bincount(pair,weights=crosses,minlength=len(candidate)) % 2 == 1
+        result[point[inside]] = self.polygon_plot[candidate[inside]]
+        return result
+
+def _ranks(counts:np.ndarray) -> np.ndarray:
+    '''0..count-1 for every count, concatenated'''
+    offsets = np.repeat(np.cumsum(counts)-counts,counts)
+    return np.arange(offsets.size)-offsets
+
+class PlotStatistics():
+    '''count, mean, M2 (sum of squared deviations), min and max of one variable per plot
+    batches are merged with the parallel update of Chan et al., values can be scalars or vectors (spectra)'''
+    def __init__(self,plots:int,width:int=None) -> None:
+        shape = (plots,) if width is None else (plots,width)
+        self.count = np.zeros(plots,dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape,np.inf)
+        self.max = np.full(shape,-np.inf)
+
+    def update(self,plot:np.ndarray,values:np.ndarray):
+        values = np.asarray(values,dtype=np.float64)
+        finite = np.isfinite(values) if values.ndim == 1 else np.isfinite(values).all(axis=1)
+        keep = (plot >= 0) & finite
+        if not keep.any():
+            return
+        order = np.argsort(plot[keep],kind='stable')
+        plot,values = plot[keep][order],values[keep][order]
+        starts = np.flatnonzero(np.r_[True,plot[1:] != plot[:-1]])
+        ids = plot[starts]
+        n = np.diff(np.append(starts,len(plot)))
+        n_shape = n if values.ndim == 1 else n[:,None]
+        batch_mean = np.add.reduceat(values,starts,axis=0)/n_shape
+        batch_m2 = np.add.reduceat((values-np.repeat(batch_mean,n,axis=0))**2,starts,axis=0)
+        previous = self.count[ids] if values.ndim == 1 else self.count[ids][:,None]
+        total = previous+n_shape
+        delta = batch_mean-self.mean[ids]
+        self.mean[ids] += delta*n_shape/total
+        self.m2[ids] += batch_m2+delta**2*previous*n_shape/total
+        self.count[ids] += n
+        self.min[ids] = np.minimum(self.min[ids],np.minimum.reduceat(values,starts,axis=0))
+        self.max[ids] = np.maximum(self.max[ids],np.maximum.reduceat(values,starts,axis=0))
+
+    def merge(self,other:'PlotStatistics'):
+        '''adds the statistics of other, kept for the same plots and width'''
+        n_a = self.count if self.mean.ndim == 1 else self.count[:,None]
+        n_b = other.count if other.mean.ndim == 1 else other.count[:,None]
+        total = n_a+n_b
+        w = np.divide(n_b,total,out=np.zeros(total.shape),where=total > 0)
+        delta = other.mean-self.mean
+        self.mean += delta*w
+        self.m2 += other.m2+delta**2*n_a*w
+        self.count += other.count
+        self.min = np.minimum(self.min,other.min)
+        self.max = np.maximum(self.max,other.max)
+
+    @property
+    def std(self) -> np.ndarray:
+        count = self.count if self.mean.ndim == 1 else self.count[:,None]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return np.where(count > 1,np.sqrt(self.m2/(count-1)),np.nan)
+
+def _index_chunks(path:Path,chunk_rows:int):
+    '''(latitude,longitude,type,index_value) blocks of an NDVI/PRI csv or binary log'''
+    if path.suffix == '.h5':
+        with tables.open_file(path,'r') as f:
+            table = f.root.log
+            types = np.array(table.attrs['type'],dtype=object)
+            for start in range(0,table.nrows,chunk_rows):
+                records = table.read(start,min(start+chunk_rows,table.nrows))
+                yield records['latitude'],records['longitude'],types[records['type']],records['index_value']
+    else:
+        for df in pd.read_csv(path,chunksize=chunk_rows,usecols=['latitude','longitude','type','index_value']):
+            yield df['latitude'].to_numpy(),df['longitude'].to_numpy(),df['type'].to_numpy(),df['index_value'].to_numpy(dtype=np.float64)
+
+def aggregate_log(plot_index:PlotIndex,path:Path,chunk_rows:int=65536,band_centers:np.ndarray=None) -> dict:
+    '''{variable:PlotStatistics} of one temperature, NDVI/PRI or spectra log, plus 'band_centers' if it has reflectance,
+    which must match band_centers (the ones of the other logs) if given'''
+    plots = len(plot_index.plots)
+    statistics = {}
+    def update(name,plot,values,width=None):
+        if name not in statistics:
+            statistics[name] = PlotStatistics(plots,width)
+        statistics[name].update(plot,values)
+    if '_temp_' in path.name:
+        for df in temperature_chunks(path,chunk_rows):
+            update('target_temp_C',plot_index.assign(df['lat'].to_numpy(),df['long'].to_numpy()),df['target_temp_C'].to_numpy(dtype=np.float64))
+    elif '_SDI12_' in path.name:
+        for latitude,longitude,types,values in _index_chunks(path,chunk_rows):
+            plot = plot_index.assign(latitude,longitude)
+            for index_type in np.unique(types):
+                rows = types == index_type
+                update(str(index_type),plot[rows],values[rows])
+    elif '_spec_' in path.name:
+        with tables.open_file(path,'r') as f:
+            if 'reflectance' not in f.root:
+                print(f'{path.name} has no reflectance group, run reprocess_reflectance first')
+                return statistics
+            for position_group in f.root.reflectance._f_iter_nodes('Group'):
+                table = position_group.reflectance
+                centers = position_group.band_centers.read()
+                if band_centers is None:
+                    band_centers = centers
+                elif not np.array_equal(band_centers,centers):
+                    raise ValueError(f'{path.name} {position_group._v_name}: band centers differ from the other sessions')
+                statistics['band_centers'] = band_centers
+                for start in range(0,table.nrows,chunk_rows):
+                    records = table.read(start,min(start+chunk_rows,table.nrows))
+                    update('reflectance',plot_index.assign(records['latitude'],records['longitude']),records['reflectance'],len(band_centers))
+    return statistics
+
+def aggregate_logs(plot_index:PlotIndex,paths:list[Path],chunk_rows:int=65536) -> dict[str,PlotStatistics]:
+    '''Per plot statistics of target_temp_C, NDVI, PRI and reflectance (spectra sessions with a reflectance group, see
+    reprocess_reflectance) over temperature, NDVI/PRI and spectra logs, returns {variable:PlotStatistics}
+    every log is merged once it has been read completely, a log that cannot be read is reported and skipped'''
+    statistics = {}
+    for path in paths:
+        try:
+            log_statistics = aggregate_log(plot_index,path,chunk_rows,statistics.get('band_centers'))
+        except Exception as e: #one bad log must not stop the rest of the day
+            print(f'Skipping {path.name}: {e}')
+            continue
+        for name,value in log_statistics.items():
+            if name not in statistics:
+                statistics[name] = value
+            elif name != 'band_centers':
+                statistics[name].merge(value)
+    return statistics
+
+def write_plot_statistics(output_path:Path,plot_index:PlotIndex,statistics:dict) -> int:
+    '''csv with <variable>_n, _mean, _std, _min and _max columns per plot, the mean reflectance of every plot
+    goes to <output>_reflectance.csv with one column per band center, returns the number of plots with data'''
+    df = pd.DataFrame({'plot':plot_index.plots})
+    with_data = np.zeros(len(plot_index.plots),dtype=bool)
+    for name,s in statistics.items():
+        if not isinstance(s,PlotStatistics):
+            continue
+        with_data |= s.count > 0
+        if s.mean.ndim == 1:
+            df[f'{name}_n'] = s.count
+            for stat,values in (('mean',s.mean),('std',s.std),('min',s.min),('max',s.max)):
+                df[f'{name}_{stat}'] = np.where(s.count > 0,values,np.nan)
+        else:
+            reflectance = pd.DataFrame(np.where(s.count[:,None] > 0,s.mean,np.nan),columns=[f'{b:.2f}' for b in statistics['band_centers']])
+            reflectance.insert(0,'n',s.count)
+            reflectance.insert(0,'plot',plot_index.plots)
+            reflectance[s.count > 0].to_csv(output_path.with_name(output_path.stem+'_reflectance.csv'),index=False,lineterminator='\n')
+    df[with_data].to_csv(output_path,index=False,lineterminator='\n')
+    return int(with_data.sum())
+
+def find_logs(paths:list[Path]) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(f for pattern in ('*_temp_*','*_SDI12_*','*_spec_*') for f in path.rglob(pattern)
+                                if f.suffix in ('.txt','.h5') and not f.stem.endswith((temperature_suffix,merged_suffix))))
+        else:
+            files.append(path)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per plot statistics of the temperature, NDVI/PRI and reflectance logs')
+    parser.add_argument('paths',type=Path,nargs='+',help='plots GeoJSON (unless --grid is given) followed by logs or folders')
+    parser.add_argument('--grid',type=lambda value: [float(v) for v in value.split(',')],help='lat,lon,rows,columns,length_m,width_m[,heading_deg] of a regular plot grid')
+    parser.add_argument('--id-property',default='plot',help='GeoJSON feature property with the plot id')
+    parser.add_argument('-o','--output',type=Path,default=Path('plot_stats.csv'))
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.grid:
+        latitude,longitude,rows,columns,length_m,width_m,*heading = args.grid
+        plot_index = PlotIndex.grid(latitude,longitude,int(rows),int(columns),length_m,width_m,*heading)
+        log_paths = args.paths
+    else:
+        plot_index = PlotIndex.from_geojson(args.paths[0],args.id_property)
+        log_paths = args.paths[1:]
+    statistics = aggregate_logs(plot_index,find_logs(log_paths))
+    plots = write_plot_statistics(args.output,plot_index,statistics)
+    print(f'{plots} of {len(plot_index.plots)} plots with data -> {args.output} in {time.perf_counter()-start:.2f} s')
@@ -0,0 +1,78 @@
+'''
+Process wide store of the recent measurements of every logger, kept in fixed size NumPy ring buffers
+so the GUI, QC and live index consumers can read recent data without reopening the log files.
+
+every stream has a single producer (the logger thread) that appends without locks, readers get
+zero-copy views of the last rows or of a time window. A view stays valid until the producer appends
+capacity - len(view) more rows, copy it to keep it longer.
+
+    from recent_data import recent
+    recent.temperatures.append((timestamp,'1141','RIGHT',body_t_C,target_t_C,latitude,longitude))
+    rows = recent.temperatures.window(time()-60) #last minute
+'''
+import numpy as np
+
+temperature_dtype = np.dtype([('timestamp','f8'),('sensor_id','U8'),('sensor_position','U8'),
+                              ('sensorbody_temp_C','f8'),('target_temp_C','f8'),('latitude','f8'),('longitude','f8')])
+index_dtype = np.dtype([('timestamp','f8'),('sensor_id','U8'),('sensor_position','U8'),('type','U4'),
+                        ('index_value','f8'),('latitude','f8'),('longitude','f8')])
+spectra_dtype = np.dtype([('timestamp','f8'),('index','i4'),('sensor_position','U10'),('integration_time_ms','f4'),
+                          ('max_count','f4'),('mean_count','f4'),('latitude','f8'),('longitude','f8')])
+gps_dtype = np.dtype([('timestamp','f8'),('gps_time','f8'),('latitude','f8'),('longitude','f8'),('altitude','f8'),('quality_fix','i1')])
+
+class RingBuffer():
+    '''Fixed size ring buffer of structured rows sorted by their timestamp field
+    rows are written twice (i and i+capacity) so the last capacity rows are always a contiguous slice,
+    the row count is only increased after the row is written so readers never see a partial row'''
+    def __init__(self,dtype:np.dtype,capacity:int) -> None:
+        self.capacity = capacity
+        self._data = np.zeros(2*capacity,dtype=dtype)
+        self._count = 0
+
+    def append(self,row:tuple):
+        '''single producer only, the timestamps must not decrease (window() bisects them)'''
+        i = self._count % self.capacity
+        self._data[i] = row
+        self._data[i+self.capacity] = row
+        self._count += 1
+
+    def __len__(self) -> int:
+        return min(self._count,self.capacity)
+
+    @property
+    def count(self) -> int:
+        '''rows appended since the start, including the ones already overwritten'''
+        return self._count
+
+    def last(self,n:int=None) -> np.ndarray:
+        '''read only view of the last n rows (all the buffered rows by default), oldest first'''
+        count = self._count
+        available = min(count,self.capacity)
+        n = available if n is None else min(n,available)
+        end = (count-1) % self.capacity + self.capacity + 1 if count > 0 else 0
+        view = self._data[end-n:end]
+        view.flags.writeable = False
+        return view
+
+    def window(self,start_time:float=None,end_time:float=None) -> np.ndarray:
+        '''read only view of the buffered rows with start_time <= timestamp < end_time'''
+        rows = self.last()
+        times = rows['timestamp']
+        start = 0 if start_time is None else np.searchsorted(times,start_time,side='left')
+        end = len(rows) if end_time is None else np.searchsorted(times,end_time,side='left')
+        return rows[start:end]
+
+class RecentData():
+    '''ring buffers of every stream plus the latest spectrum of each spectrometer
+    capacities are in rows, about 1 h of the cart at its usual rates by default'''
+    def __init__(self,temperature_rows:int=32768,index_rows:int=32768,spectra_rows:int=65536,gps_rows:int=65536) -> None:
+        self.temperatures = RingBuffer(temperature_dtype,temperature_rows)
+        self.indices = RingBuffer(index_dtype,index_rows)
+        self.spectra = RingBuffer(spectra_dtype,spectra_rows)
+        self.gps = RingBuffer(gps_dtype,gps_rows)
+        self.latest_spectra = {} #{position:(timestamp,spectrum)}, replaced as a whole on every frame
+
+    def set_spectrum(self,position:str,timestamp:float,spectrum:np.ndarray):
+        self.latest_spectra[position] = (timestamp,spectrum)
+
+recent = RecentData()
@@ -0,0 +1,136 @@
+'''
+Offline reflectance computation over the raw spectra sessions written by save_raw_spectra
+the wavelength resampling is built once per module as (index,weight) operators and whole blocks of rows
+are streamed through SpectraSession and processed as array operations, using the calibration stored in the session at capture time.
+Results are written back to the same file as a /reflectance group, one table per downlooking position.
+
+usage: python reprocess_reflectance.py <spec files or folders> [--chunk-rows 4096]
+'''
+import argparse
+import time
+import numpy as np
+import tables
+from pathlib import Path
+from spectra_reader import SpectraSession
+from dark_current import DarkCurrentModel
+
+uplooking_group = 'UPLOOKING'
+
+def reflectance_description(bands:int) -> dict:
+    return {'index':tables.Int32Col(pos=0),
+            'timestamp':tables.Float64Col(pos=1),
+            'datetimeiso':tables.StringCol(itemsize=64,dflt=" ",pos=2),
+            'latitude':tables.Float64Col(pos=3),
+            'longitude':tables.Float64Col(pos=4),
+            'altitude':tables.Float64Col(pos=5),
+            'quality_fix':tables.Int32Col(pos=6),
+            'reflectance':tables.Float32Col(shape=(bands,),pos=7)}
+
+def resampling_operator(source_wavelengths:np.ndarray,target_wavelengths:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    '''np.interp(target_wavelengths,source_wavelengths,values) as a (left index,weight) pair
+    so a whole block of spectra is resampled with two gathers'''
+    source_wavelengths = np.asarray(source_wavelengths,dtype=np.float64)
+    target_wavelengths = np.asarray(target_wavelengths,dtype=np.float64)
+    left = np.clip(np.searchsorted(source_wavelengths,target_wavelengths,side='right')-1,0,len(source_wavelengths)-2)
+    weight = (target_wavelengths-source_wavelengths[left])/(source_wavelengths[left+1]-source_wavelengths[left])
+    return left,np.clip(weight,0.0,1.0) #values outside the source range take the edge value, as np.interp
+
+def resample(values:np.ndarray,operator:tuple[np.ndarray,np.ndarray]) -> np.ndarray:
+    left,weight = operator
+    return values[...,left]*(1-weight)+values[...,left+1]*weight
+
+class ReflectanceModel():
+    '''Reflectance of one downlooking position, same computation as HDXXR_pair.reflectance_spectra
+    band centers are the downlooking spectrometer wavelengths, sessions with dark models (see dark_current)
+    get the dark reference of the integration time of every row'''
+    def __init__(self,calibration_group:tables.Group) -> None:
+        uplooking_wavelengths = calibration_group.uplooking_spec_wavelengths.read()
+        downlooking_wavelengths = calibration_group.downlooking_spec_wavelengths.read()
+        self.band_centers = np.asarray(downlooking_wavelengths,dtype=np.float64)
+        self.uplooking_operator = resampling_operator(uplooking_wavelengths,self.band_centers)
+        self.downlooking_operator = resampling_operator(downlooking_wavelengths,self.band_centers)
+        self.uplooking_dark_ref = np.asarray(calibration_group.uplooking_dark_reference.read(),dtype=np.float64)
+        self.downlooking_dark_ref = np.asarray(calibration_group.downlooking_dark_reference.read(),dtype=np.float64)
+        self.uplooking_dark_model = DarkCurrentModel.load(calibration_group.uplooking_dark_model) if 'uplooking_dark_model' in calibration_group else None
+        self.downlooking_dark_model = DarkCurrentModel.load(calibration_group.downlooking_dark_model) if 'downlooking_dark_model' in calibration_group else None
+        cal_incident_irradiance = resample(calibration_group.incident_irrandiance.read()-self.uplooking_dark_ref,self.uplooking_operator)
+        cal_upwelling_radiance = resample(calibration_group.calibration_panel_radiance.read()-self.downlooking_dark_ref,self.downlooking_operator)
+        self.correction_factors = cal_incident_irradiance/cal_upwelling_radiance
+
+    def reflectance(self,uplooking_spectra:np.ndarray,downlooking_spectra:np.ndarray,
+                    uplooking_integration_ms:np.ndarray=None,downlooking_integration_ms:np.ndarray=None) -> np.ndarray:
+        '''reflectance (%) of a block of rows, uplooking and downlooking spectra of the same frames
+        the integration times of the rows are only used with the dark models'''
+        uplooking_dark = self.uplooking_dark_ref
+        if self.uplooking_dark_model is not None and uplooking_integration_ms is not None:
+            uplooking_dark = self.uplooking_dark_model.dark(uplooking_integration_ms)
+        downlooking_dark = self.downlooking_dark_ref
+        if self.downlooking_dark_model is not None and downlooking_integration_ms is not None:
+            downlooking_dark = self.downlooking_dark_model.dark(downlooking_integration_ms)
+        incident_irradiance = resample(uplooking_spectra-uplooking_dark,self.uplooking_operator)
+        upwelling_radiance = resample(downlooking_spectra-downlooking_dark,self.downlooking_operator)
+        return (upwelling_radiance/incident_irradiance)*self.correction_factors*100
+
+def reprocess_reflectance_file(h5_path:Path,chunk_rows:int=4096,overwrite:bool=True) -> dict:
+    '''Computes the reflectance of every downlooking position of a session, returns {position:rows}
+    downlooking rows are matched to the uplooking row of the same frame (see SpectraSession), unmatched rows are skipped'''
+    rows = {}
+    with tables.open_file(h5_path,'a') as f:
+        if 'reflectance' in f.root:
+            if not overwrite:
+                raise FileExistsError(f'{h5_path.name} already has a reflectance group')
+            f.remove_node(f.root,'reflectance',recursive=True)
+        session = SpectraSession(f)
+        reflectance_group = f.create_group(f.root,'reflectance','Reflectance computed from the raw spectra')
+        for calibration_group in f.root.calibration._f_iter_nodes('Group'):
+            position = calibration_group._v_name
+            model = ReflectanceModel(calibration_group)
+            position_group = f.create_group(reflectance_group,position,f'{position} reflectance')
+            f.create_array(position_group,'band_centers',model.band_centers)
+            table = f.create_table(position_group,'reflectance',reflectance_description(len(model.band_centers)),
+                                   f'{position}_reflectance',expectedrows=session.nrows(position))
+            for _,frames in session.chunks([position,uplooking_group],chunk_rows):
+                downlooking_rows = frames[position]
+                records = np.empty(len(downlooking_rows),dtype=table.dtype)
+                for name in records.dtype.names:
+                    if name != 'reflectance':
+                        records[name] = downlooking_rows[name]
+                records['reflectance'] = model.reflectance(frames[uplooking_group]['spectrum'].astype(np.float64),downlooking_rows['spectrum'].astype(np.float64),
+                                                           frames[uplooking_group]['integration_time_ms'],downlooking_rows['integration_time_ms'])
+                table.append(records)
+            table.flush()
+            rows[position] = int(table.nrows)
+        reflectance_group._v_attrs.raw_rows = raw_rows(session) #marks the raw data this group was computed from
+    return rows
+
+def raw_rows(session:SpectraSession) -> dict:
+    return {position:int(session.nrows(position)) for position in session.positions}
+
+def reflectance_up_to_date(h5_path:Path) -> bool:
+    '''True if the session has a reflectance group computed from all its current raw rows'''
+    with SpectraSession(h5_path) as session:
+        if 'reflectance' not in session.file.root:
+            return False
+        return getattr(session.file.root.reflectance._v_attrs,'raw_rows',None) == raw_rows(session)
+
+def find_spectra_files(paths:list[Path]) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(path.rglob('*_spec_*.h5')))
+        else:
+            files.append(path)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute reflectance from raw spectra sessions')
+    parser.add_argument('paths',type=Path,nargs='+',help='spectra session files or folders to search for *_spec_*.h5 files')
+    parser.add_argument('--chunk-rows',type=int,default=4096,help='rows processed per block')
+    args = parser.parse_args()
+    for h5_path in find_spectra_files(args.paths):
+        start = time.perf_counter()
+        try:
+            rows = reprocess_reflectance_file(h5_path,args.chunk_rows)
+            print(f"{h5_path.name}: {', '.join(f'{k} {v} rows' for k,v in rows.items())} in {time.perf_counter()-start:.2f} s")
+        except (tables.NoSuchNodeError,KeyError) as e:
+            print(f'Skipping {h5_path.name}: {e}')
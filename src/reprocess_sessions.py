@@ -0,0 +1,114 @@
+'''
+Reprocesses every session of a field day in parallel
+finds the YYYYMMdd_<trial>_<temp|spec> folders under a root folder (see utils.get_unique_filepath_from_string),
+builds a work plan, skips the outputs that are already up to date (and the temperature logs without raw
+voltages, they cannot be reprocessed) and runs the rest on a process pool
+    spec: reflectance group of the raw spectra sessions (reprocess_reflectance)
+    temp: temperatures recomputed from the raw voltages (reprocess_temperatures)
+    merge: NDVI/PRI and spectra frames joined onto the temperature timeline (merge_sessions)
+
+usage: python reprocess_sessions.py <root folder> [--tasks spec temp merge] [--workers N] [--force]
+'''
+import argparse
+import os
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from reprocess_reflectance import reprocess_reflectance_file,reflectance_up_to_date
+from reprocess_temperatures import reprocess_temperature_file,has_voltage_columns
+from merge_sessions import merge_session,merged_output,session_inputs
+from utils import temperature_suffix,merged_suffix
+
+task_names = ['spec','temp','merge']
+
+def temperature_output(txt_path:Path) -> Path:
+    return txt_path.with_name(txt_path.stem + temperature_suffix + txt_path.suffix)
+
+def find_sessions(root:Path,task:str) -> list[Path]:
+    if task == 'spec':
+        return sorted(root.rglob('*_spec/*_spec_*.h5'))
+    temperature_logs = sorted(f for f in root.rglob('*_temp/*_temp_*.txt') if not f.stem.endswith((temperature_suffix,merged_suffix)))
+    if task == 'merge': #binary temperature logs can be merged too
+        temperature_logs += sorted(root.rglob('*_temp/*_temp_*.h5'))
+    return temperature_logs
+
+def up_to_date(task:str,path:Path) -> bool:
+    if task == 'spec':
+        return reflectance_up_to_date(path)
+    output_path = merged_output(path) if task == 'merge' else temperature_output(path)
+    if not output_path.exists():
+        return False
+    try:
+        #the spec task only adds the reflectance group to the spectra sessions, their frame timestamps do not change
+        inputs = [path]+session_inputs(path)[0] if task == 'merge' else [path]
+    except Exception: #unreadable input, the task runs and reports the error
+        return False
+    return all(output_path.stat().st_mtime >= f.stat().st_mtime for f in inputs)
+
+def work_plan(root:Path,tasks:list[str],force:bool=False) -> tuple[list[tuple[str,Path]],list[tuple[str,Path]],list[tuple[str,Path]]]:
+    '''returns (tasks to run,tasks skipped because their output is up to date,
+    temp tasks not applicable because the log has no raw voltages) as (task,path) lists'''
+    pending,skipped,not_applicable = [],[],[]
+    for task in tasks:
+        for path in find_sessions(root,task):
+            if task == 'temp' and not has_voltage_columns(path):
+                not_applicable.append((task,path))
+            elif not force and up_to_date(task,path):
+                skipped.append((task,path))
+            else:
+                pending.append((task,path))
+    #largest files first so the pool does not end waiting on a single long file
+    pending.sort(key=lambda item: item[1].stat().st_size,reverse=True)
+    return pending,skipped,not_applicable
+
+def run_task(task:str,path:Path) -> tuple[int,float]:
+    '''runs one task in a worker process, returns (rows,seconds)'''
+    start = time.perf_counter()
+    if task == 'spec':
+        rows = sum(reprocess_reflectance_file(path).values())
+    elif task == 'merge':
+        rows = merge_session(path)
+    else:
+        rows = reprocess_temperature_file(path,temperature_output(path))
+    return rows,time.perf_counter()-start
+
+def reprocess_sessions(root:Path,tasks:list[str]=task_names,workers:int=None,force:bool=False) -> list[dict]:
+    pending,skipped,not_applicable = work_plan(root,tasks,force)
+    print(f'{len(pending)} files to process, {len(skipped)} up to date, {len(not_applicable)} not applicable')
+    results = [{'task':task,'path':path,'status':'up to date','rows':0,'seconds':0.0} for task,path in skipped]
+    results += [{'task':task,'path':path,'status':'not applicable: no raw voltage columns','rows':0,'seconds':0.0} for task,path in not_applicable]
+    if not pending:
+        return results
+    #merges read the spectra sessions, they run once the spec task has finished writing them
+    phases = [[item for item in pending if item[0] != 'merge'],[item for item in pending if item[0] == 'merge']]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for phase in phases:
+            futures = {pool.submit(run_task,task,path):(task,path) for task,path in phase}
+            for future in as_completed(futures):
+                task,path = futures[future]
+                try:
+                    rows,seconds = future.result()
+                    results.append({'task':task,'path':path,'status':'done','rows':rows,'seconds':seconds})
+                    print(f'{task} {path.name}: {rows} rows in {seconds:.2f} s')
+                except Exception as e: #one bad file must not stop the rest of the day
+                    results.append({'task':task,'path':path,'status':f'failed: {e}','rows':0,'seconds':0.0})
+                    print(f'{task} {path.name} failed: {e}')
+    return results
+
+def print_summary(results:list[dict],wall_time_s:float):
+    print(f"\n{'task':<5} {'file':<40} {'rows':>8} {'seconds':>8}  status")
+    for r in sorted(results,key=lambda r: (r['task'],r['path'].name)):
+        print(f"{r['task']:<5} {r['path'].name:<40} {r['rows']:>8} {r['seconds']:>8.2f}  {r['status']}")
+    cpu_s = sum(r['seconds'] for r in results)
+    print(f'{len(results)} files, {cpu_s:.1f} s of processing in {wall_time_s:.1f} s wall time')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reprocess all the sessions of a field day in parallel")
+    parser.add_argument('root',type=Path,help='folder with the YYYYMMdd_<trial>_<sensor> folders')
+    parser.add_argument('--tasks',nargs='+',choices=task_names,default=task_names)
+    parser.add_argument('--workers',type=int,default=None,help='worker processes, all cores by default')
+    parser.add_argument('--force',action='store_true',help='reprocess files even if their output is up to date')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = reprocess_sessions(args.root,args.tasks,args.workers,args.force)
+    print_summary(results,time.perf_counter()-start)
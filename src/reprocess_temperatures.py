@@ -0,0 +1,74 @@
+'''
+Offline recomputation of IRR temperatures from the raw voltages stored by log_temperatures
+useful after a calibration coefficient fix, every file is processed as one array operation
+
+usage: python reprocess_temperatures.py <temp files or folders> [--coefficients cc.json] [--suffix _reprocessed]
+'''
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from IRR_labjack import get_temperatures,units_cc
+from utils import temperature_suffix,merged_suffix
+
+voltage_columns = ['thermistor_mV','thermopile_mV']
+
+def has_voltage_columns(txt_path:Path) -> bool:
+    '''False if the header of a temperature log has no raw voltage columns (logs written before they were stored),
+    an empty or unreadable file returns True so reprocessing it reports its own error'''
+    try:
+        with txt_path.open(encoding='utf-8') as f:
+            header = f.readline().rstrip('\r\n').split(',')
+    except (OSError,UnicodeDecodeError):
+        return True
+    return header == [''] or set(voltage_columns).issubset(header)
+
+def reprocess_temperature_file(txt_path:Path,output_path:Path,coefficients:dict=units_cc) -> int:
+    '''Recomputes sensorbody_temp_C and target_temp_C of a temperature log, returns the number of rows
+    every other column is copied verbatim'''
+    df = pd.read_csv(txt_path,dtype=str,keep_default_na=False)
+    if not set(voltage_columns).issubset(df.columns):
+        raise ValueError(f'{txt_path.name} has no raw voltage columns, it cannot be reprocessed')
+    units,unit_index = np.unique(df['sensor_id'].to_numpy(),return_inverse=True)
+    missing = [unit for unit in units if unit not in coefficients]
+    if missing:
+        raise KeyError(f'No calibration coefficients for units: {missing}')
+    cc = np.array([coefficients[unit] for unit in units],dtype=np.float64)[unit_index]
+    body_t_C,target_t_C = get_temperatures(cc,df['thermistor_mV'].to_numpy(dtype=np.float64),df['thermopile_mV'].to_numpy(dtype=np.float64))
+    df['sensorbody_temp_C'] = np.char.mod('%.6f',body_t_C)
+    df['target_temp_C'] = np.char.mod('%.6f',target_t_C)
+    df.to_csv(output_path,index=False,lineterminator='\n')
+    return len(df)
+
+def find_temperature_files(paths:list[Path]) -> list[Path]:
+    '''temperature logs in paths, the reprocessed and merged outputs in the folders are left out'''
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(f for f in path.rglob('*_temp_*.txt') if not f.stem.endswith((temperature_suffix,merged_suffix))))
+        else:
+            files.append(path)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute IRR temperatures from stored raw voltages')
+    parser.add_argument('paths',type=Path,nargs='+',help='temperature log files or folders to search for *_temp_*.txt files')
+    parser.add_argument('--coefficients',type=Path,default=None,help='json file {unit:[mc2,mc1,mc0,bc2,bc1,bc0]}, IRR_labjack.units_cc by default')
+    parser.add_argument('--suffix',default=temperature_suffix,help='suffix added to the output file names')
+    args = parser.parse_args()
+    coefficients = units_cc
+    if args.coefficients:
+        with args.coefficients.open(encoding='utf-8') as f:
+            coefficients = json.load(f)
+    for txt_path in find_temperature_files(args.paths):
+        if txt_path.stem.endswith((args.suffix,merged_suffix)):
+            continue
+        start = time.perf_counter()
+        output_path = txt_path.with_name(txt_path.stem + args.suffix + txt_path.suffix)
+        try:
+            rows = reprocess_temperature_file(txt_path,output_path,coefficients)
+            print(f'{txt_path.name}: {rows} rows in {time.perf_counter()-start:.2f} s -> {output_path.name}')
+        except (ValueError,KeyError) as e:
+            print(f'Skipping {txt_path.name}: {e}')
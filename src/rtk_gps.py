@@ -1,79 +1,218 @@
 import socket
-from io import BytesIO
+import logging
+import numpy as np
+from time import time
+from datetime import datetime,timezone
 from threading import Event,Lock
-from utils import threaded
+from utils import threaded,naive_seconds
+from recent_data import recent
+from metrics import count
+
+log = logging.getLogger(__name__)
+
+class Position():
+    '''GPS position of a sample, the datetime_s/quality_fix/latitude/longitude/altitude columns of the logs
+    producers keep one and fill it again for every sample (reach_rover.coordinates_at(t,out=position)),
+    datetime_iso is only formatted when a csv row needs it'''
+    __slots__ = ('gps_time','quality_fix','latitude','longitude','altitude')
+
+    def __init__(self,gps_time:float=0.0,quality_fix:int=0,latitude:float=0.0,longitude:float=0.0,altitude:float=0.0) -> None:
+        self.gps_time = gps_time #GPS time (UTC) as seconds since epoch, the datetime_s of the binary logs
+        self.quality_fix = quality_fix
+        self.latitude = latitude
+        self.longitude = longitude
+        self.altitude = altitude
+
+    def set_local(self,timestamp:float) -> 'Position':
+        '''no fix: zero coordinates and the local date and time of the host timestamp'''
+        self.gps_time = naive_seconds(timestamp)
+        self.quality_fix = 0
+        self.latitude = self.longitude = self.altitude = 0.0
+        return self
+
+    @property
+    def datetime_iso(self) -> str:
+        return datetime.fromtimestamp(self.gps_time,timezone.utc).replace(tzinfo=None).isoformat(' ','milliseconds')
 
 class reach_rover():
     '''This class is used to connect to a rtk rover and get the coordinates in a thread safe way'''
-    def __init__(self,ip:str,port:int,lock:Lock) -> None:
+    def __init__(self,ip:str,port:int,lock:Lock,history_size:int=1200) -> None:
         self.ip = ip
         self.port = port
         self.lock = lock 
         self.loop_event_ctrl = Event()
-        self.current_coordinates = {'coordinates':(None,None,None), #lat,long,alt
-                                    'metadata':(None,None)} #timestamp, quality_fix
-        self._coordinates = None
+        self._connected_fix = False #a fix was received on the current connection
+        self.buffer_size = 65536
+        self.min_backoff_s = 0.5
+        self.max_backoff_s = 30.0
+        self.stats = {'recv_calls':0,'lines':0,'parse_failures':0,'reconnects':0}
+        # fix history, a ring buffer written twice (i and i+history_size) so the last
+        # history_size fixes are always a contiguous, time sorted slice
+        self.history_size = history_size
+        self._fix_time = np.zeros(2*history_size) #GPS epoch seconds
+        self._fix_llh = np.zeros((2*history_size,3))
+        self._fix_quality = np.zeros(2*history_size,dtype=np.int8)
+        self._fix_count = 0
+        self._clock_offset_s = None #host clock - GPS clock, including the stream latency
+        self.clock_offset_leak_s = 0.001 #lets the offset follow a host clock that steps forward
+        self.max_extrapolation_s = 0.5
+        self.max_gap_s = 2.0 #longest time between two fixes that is interpolated across
 
-    def parse_stream(self,line):
+    def parse_stream(self,line,received_at:float=None):
+        '''parses a 'date time lat long alt quality_fix ...' line into the fix history, the latest fix is read
+        back from the history (coordinates_with_meta) so no per line record is built'''
         if len(line) > 0:
-            line_elements = line.split()
-            coordinates = tuple(line_elements[2:5])
-            date = line_elements[0].replace('/','-')
-            time = line_elements[1]
-            date_time_iso = date + ' ' + time
-            metadata = (date_time_iso,line_elements[5]) #timestamp, quality_fix
-            output_dict = {'coordinates':coordinates,'metadata':metadata}
-            self.coordinates = output_dict
-            self.coordinates_with_meta = {'latitude':coordinates[0],
-                                          'longitude':coordinates[1],
-                                          'altitude':coordinates[2],
-                                          'datetime_iso':metadata[0],
-                                          'quality_fix':metadata[1]}
+            date,time_of_day,latitude,longitude,altitude,quality_fix = line.split(maxsplit=6)[:6]
+            gps_time = datetime.fromisoformat(date.replace('/','-') + ' ' + time_of_day).replace(tzinfo=timezone.utc).timestamp()
+            self.add_fix(gps_time,(float(latitude),float(longitude),float(altitude)),int(quality_fix),time() if received_at is None else received_at)
+
+    def add_fix(self,gps_time:float,llh:tuple,quality_fix:int,received_at:float):
+        '''appends a fix to the history and updates the host/GPS clock offset
+        the offset is the smallest observed delay (a leaky minimum), which filters out network jitter'''
+        with self.lock:
+            delay = received_at - gps_time
+            if self._clock_offset_s is None:
+                self._clock_offset_s = delay
+            else:
+                self._clock_offset_s = min(self._clock_offset_s + self.clock_offset_leak_s,delay)
+            if self._fix_count > 0 and gps_time <= self._fix_time[(self._fix_count-1) % self.history_size]:
+                return #repeated or out of order epoch
+            i = self._fix_count % self.history_size
+            for j in (i,i+self.history_size):
+                self._fix_time[j] = gps_time
+                self._fix_llh[j] = llh
+                self._fix_quality[j] = quality_fix
+            self._fix_count += 1
+            self._connected_fix = True
+            recent.gps.append((received_at,gps_time,*llh,quality_fix))
+
+    def coordinates_at(self,timestamp:float,out:Position=None) -> Position|None:
+        '''Position interpolated at a host timestamp (time.time()) using the fix history, O(log n)
+        fills out (a new Position if it is None) and returns it, timestamps after the last fix are extrapolated
+        up to max_extrapolation_s. None if there are no fixes, the connection dropped, the last fix is older
+        than that, the timestamp is that much before the history or falls in a gap of more than max_gap_s
+        between fixes (the callers then log the host time without coordinates)'''
+        with self.lock:
+            n = min(self._fix_count,self.history_size)
+            if n == 0 or not self._connected_fix:
+                return None
+            end = (self._fix_count-1) % self.history_size + self.history_size + 1
+            times = self._fix_time[end-n:end]
+            t = timestamp - self._clock_offset_s
+            if t - times[-1] > self.max_extrapolation_s: #stale, no fix for a while
+                return None
+            k = int(np.searchsorted(times,t))
+            if n == 1 or k == 0: #before the history, first fix
+                if times[0] - t > self.max_extrapolation_s:
+                    return None
+                i0 = i1 = end-n
+                t0 = t1 = t
+            else:
+                k = min(k,n-1)
+                i0,i1 = end-n+k-1,end-n+k
+                t0,t1 = float(times[k-1]),float(times[k])
+                if t1 - t0 > self.max_gap_s: #the rover lost the fix or the connection in between
+                    return None
+            lat0,long0,alt0 = self._fix_llh[i0].tolist()
+            lat1,long1,alt1 = self._fix_llh[i1].tolist()
+            quality_fix = int(self._fix_quality[i0] if t-t0 < t1-t else self._fix_quality[i1])
+        w = (t-t0)/(t1-t0) if t1 != t0 else 0.0
+        out = Position() if out is None else out
+        out.gps_time = t
+        out.quality_fix = quality_fix
+        out.latitude = lat0 + w*(lat1-lat0)
+        out.longitude = long0 + w*(long1-long0)
+        out.altitude = alt0 + w*(alt1-alt0)
+        return out
+
+    def position_at(self,timestamp:float):
+        '''(gps_time,(lat,long,alt),quality_fix) interpolated at timestamp, None when coordinates_at is None'''
+        position = self.coordinates_at(timestamp)
+        if position is None:
+            return None
+        return (position.gps_time,(position.latitude,position.longitude,position.altitude),position.quality_fix)
 
     @threaded
     def spin(self):
-        '''This method is used to connect to the rtk rover and start a loop that will poll the socket byte per byte and parse the stream'''
-        bytes_buffer = BytesIO()
+        '''This method is used to connect to the rtk rover and start a loop that will read the socket in chunks and parse the stream line by line
+        if the connection drops or times out it reconnects with an exponential backoff until stop() is called'''
         self.loop_event_ctrl.clear()
-        try:
-            with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as sock:
-                    sock.connect((self.ip,self.port))
+        backoff_s = self.min_backoff_s
+        while not self.loop_event_ctrl.is_set():
+            try:
+                with socket.socket(socket.AF_INET,socket.SOCK_STREAM) as sock:
                     sock.settimeout(5)
-                    while not self.loop_event_ctrl.is_set():
-                        c = sock.recv(1)
-                        if (c == b'\n' or c == b'\r'):
-                            self.parse_stream(bytes_buffer.getvalue().strip().decode('ascii'))
-                            bytes_buffer.close()
-                            bytes_buffer = BytesIO()
-                        else:
-                            bytes_buffer.write(c)
-        except ConnectionRefusedError:
-            print('target machine refused connection')
-            self.stop()
-        except TimeoutError:
-            print('Timeout')
-            self.stop()
-        print('Closing socket')
-    @property  
-    def coordinates(self): #{'coordinates':(lat,long,alt),'metadata':(iso timestamp,quality fix)}
-        with self.lock:
-            result = self.current_coordinates
-        return(result)
-    
-    @coordinates.setter
-    def coordinates(self,value):
-        with self.lock:
-            self.current_coordinates = value
+                    sock.connect((self.ip,self.port))
+                    backoff_s = self.min_backoff_s
+                    self.read_stream(sock)
+            except ConnectionRefusedError:
+                log.error('target machine refused connection')
+            except TimeoutError:
+                log.warning('timeout')
+                count('timeouts','gps')
+            except OSError as e:
+                log.warning('connection lost: %s',e)
+            if self.loop_event_ctrl.is_set():
+                break
+            self._connected_fix = False
+            self.stats['reconnects'] += 1
+            count('reconnects','gps')
+            log.info('reconnecting in %s s',backoff_s)
+            self.loop_event_ctrl.wait(backoff_s)
+            backoff_s = min(2*backoff_s,self.max_backoff_s)
+        log.info('closing socket')
+
+    def read_stream(self,sock:socket.socket):
+        '''Reads large chunks into a reusable buffer and parses every complete line,
+        a partial line is kept at the start of the buffer until the rest of it arrives'''
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        end = 0 #number of valid bytes in the buffer
+        while not self.loop_event_ctrl.is_set():
+            if end == len(buffer): #no line terminator in a full buffer, drop the garbage
+                end = 0
+            n = sock.recv_into(view[end:])
+            received_at = time()
+            self.stats['recv_calls'] += 1
+            if n == 0:
+                raise ConnectionError('connection closed by the rover')
+            search_from = end
+            end += n
+            start = 0
+            while True:
+                line_end = buffer.find(b'\n',search_from,end)
+                if line_end < 0:
+                    break
+                line = buffer[start:line_end].strip()
+                if len(line) > 0:
+                    try:
+                        self.parse_stream(line.decode('ascii'),received_at)
+                        self.stats['lines'] += 1
+                        count('samples','gps')
+                    except (IndexError,ValueError):
+                        self.stats['parse_failures'] += 1
+                        count('parse_failures','gps')
+                start = search_from = line_end + 1
+            if start > 0: #move the partial line to the start of the buffer
+                buffer[:end-start] = buffer[start:end]
+                end -= start
 
     @property
-    def coordinates_with_meta(self):
-        with self.lock:
-                return self._coordinates
-        
-    @coordinates_with_meta.setter
-    def coordinates_with_meta(self,value):
+    def coordinates_with_meta(self) -> Position|None:
+        '''latest fix of the current connection, None before the first one'''
         with self.lock:
-            self._coordinates = value
+            if not self._connected_fix:
+                return None
+            i = (self._fix_count-1) % self.history_size
+            return Position(float(self._fix_time[i]),int(self._fix_quality[i]),*self._fix_llh[i].tolist())
+
+    @property
+    def coordinates(self): #{'coordinates':(lat,long,alt),'metadata':(iso timestamp,quality fix)}
+        '''latest fix in the original layout, built when it is read'''
+        position = self.coordinates_with_meta
+        if position is None:
+            return {'coordinates':(None,None,None),'metadata':(None,None)}
+        return {'coordinates':(position.latitude,position.longitude,position.altitude),'metadata':(position.datetime_iso,position.quality_fix)}
     
     def stop(self):
         self.loop_event_ctrl.set()
@@ -2,13 +2,21 @@ from abc import ABC, abstractmethod
 import serial
 import time
 import re
+import heapq
+import logging
+import numpy as np
 from enum import Enum,auto
-from rtk_gps import reach_rover
+from rtk_gps import reach_rover,Position
 from threading import Event
 from utils import threaded
 from pathlib import Path
 from utils import SensorOrientation,SensorPosition
-from datetime import datetime
+from binary_logs import index_log,index_dtype,position_names,index_types
+from recent_data import recent
+from acquisition_clock import acquisition_clock
+from metrics import stage_timer,count
+
+log = logging.getLogger(__name__)
 
 class SDI12_sensor(ABC):
     '''	abstract class for all sdi12 sensors '''
@@ -60,7 +68,8 @@ class Dualband_sensor(SDI12_sensor):
             assert self.id == id, f'Error: sensor id {self.id} does not match response id'
             return(True)
         else:
-            print(f'Error: could not parse response: {response.decode("ascii")}')
+            log.error('could not parse response of sensor %s: %s',self.id,response.decode('ascii',errors='replace'))
+            count('parse_failures','sdi12')
             return(False)
     @property
     def last_update(self):
@@ -82,32 +91,41 @@ class Dualband_sensor_pair():
         self.lower_band_reflectance = 0.0
         self.upper_band_reflectance = 0.0
         self.GPS_receiver = GPS_receiver
-        self.coordinates_with_meta = None#{'coordinates':(0,0,0),'metadata':(0,0)}
+        self.coordinates_with_meta = Position() #filled again by every measurement
 
     def update_reflectance_values(self):
+        measurement_start = time.time()
         self.downlooking_sensor.call_concurrent_measurement()
-        self.timestamp = time.time()
-        if self.GPS_receiver:
-            self.coordinates_with_meta = self.GPS_receiver.coordinates_with_meta
-        else:
-            datetime_iso = datetime.fromtimestamp(self.timestamp).isoformat(' ','milliseconds')
-            self.coordinates_with_meta = {'latitude':0.0,'longitude':0.0,'altitude':0.0,'datetime_iso':datetime_iso,'quality_fix':0}
+        measurement_end = time.time()
         downlooking_success = self.downlooking_sensor.parse_response()
-        elapsed_time = self.timestamp - self.uplooking_sensor.last_update
-        if ((elapsed_time) > self.wait_for_update) or (self.uplooking_sensor.lower_band is None):
+        if self.uplooking_needs_update(measurement_end):
+            elapsed_time = measurement_end - self.uplooking_sensor.last_update
             self.uplooking_sensor.call_concurrent_measurement()
-            print(f"updating uplooking values: {elapsed_time} s")
+            log.debug('updating uplooking values: %s s',elapsed_time)
             uplooking_success = self.uplooking_sensor.parse_response()
-            self.uplooking_sensor.last_update = self.timestamp
+            self.uplooking_sensor.last_update = measurement_end
             if not uplooking_success:
-                print('Warning: uplooking values cannot be updated') 
+                log.warning('uplooking values cannot be updated')
+        return(self.set_reflectance_values(downlooking_success,measurement_start,measurement_end))
+
+    def uplooking_needs_update(self,timestamp:float) -> bool:
+        elapsed_time = timestamp - self.uplooking_sensor.last_update
+        return ((elapsed_time) > self.wait_for_update) or (self.uplooking_sensor.lower_band is None)
+
+    def set_reflectance_values(self,downlooking_success:bool,measurement_start:float,measurement_end:float):
+        '''computes reflectances from the last downlooking and uplooking values,
+        the measurement is tagged with the position at its midpoint'''
+        self.timestamp = measurement_end
+        #position at the middle of the measurement
+        if not (self.GPS_receiver and self.GPS_receiver.coordinates_at((measurement_start+self.timestamp)/2,out=self.coordinates_with_meta)):
+            self.coordinates_with_meta.set_local(self.timestamp)
         valid_data_is_available = downlooking_success and self.uplooking_sensor.lower_band
         if valid_data_is_available:
             try:
                 self.lower_band_reflectance = self.downlooking_sensor.lower_band/self.uplooking_sensor.lower_band
                 self.upper_band_reflectance = self.downlooking_sensor.upper_band/self.uplooking_sensor.upper_band
             except ZeroDivisionError:
-                print('Invalid reflectance')
+                log.warning('invalid reflectance of sensor %s',self.downlooking_sensor.id)
                 self.lower_band_reflectance = 0.0
                 self.upper_band_reflectance = 0.0
         return(valid_data_is_available)
@@ -115,71 +133,125 @@ class Dualband_sensor_pair():
 
 class NDVI_pair(Dualband_sensor_pair):
     def get_NDVI(self):
-        ''' compute ndvi from lower and upper band values '''
-        if self.update_reflectance_values():
+        ''' measure and compute ndvi from lower and upper band values '''
+        return(self.compute_NDVI(self.update_reflectance_values()))
+
+    def compute_NDVI(self,valid_data_is_available:bool):
+        ''' compute ndvi from the current lower and upper band reflectances '''
+        if valid_data_is_available:
             p_650 = self.lower_band_reflectance# pRED
             p_810 = self.upper_band_reflectance # pNIR
             try:
                 ndvi = (p_810 - p_650)/(p_810 + p_650)
             except ZeroDivisionError as e:
-                print(e)
+                log.error(e)
                 ndvi = 0.0
         else:
-            print('Warning: No succesful measurement')
+            log.warning('no succesful measurement of sensor %s',self.downlooking_sensor.id)
             ndvi = 0.0
         return (ndvi)        
 
 class PRI_pair(Dualband_sensor_pair):
     def get_PRI(self):
-        ''' compute pri from lower and upper band values '''
-        if self.update_reflectance_values():
+        ''' measure and compute pri from lower and upper band values '''
+        return(self.compute_PRI(self.update_reflectance_values()))
+
+    def compute_PRI(self,valid_data_is_available:bool):
+        ''' compute pri from the current lower and upper band reflectances '''
+        if valid_data_is_available:
             p_532 = self.lower_band_reflectance# pGREEN
             p_570 = self.upper_band_reflectance # pYELLOW
             try:
                 pri = (p_532 - p_570)/(p_532 + p_570)
             except ZeroDivisionError as e:
-                print(e)
+                log.error(e)
                 pri = 0.0
         else:
-            print('Warning: No succesful measurement')
+            log.warning('no succesful measurement of sensor %s',self.downlooking_sensor.id)
             pri = 0.0
         return (pri)
     
+class SDI12_bus():
+    '''Concurrent measurement scheduler for all the sensors sharing one SDI-12 interface
+    sends aC! to every sensor, reads the ready time (atttnn) from each reply and then
+    collects aD0! from each sensor as soon as it is ready, so a full pass takes about as long
+    as the slowest sensor plus the bus time of the commands'''
+    def __init__(self,com_interface:serial.Serial,default_wait_s:float=0.84):
+        self.com_interface = com_interface
+        self.default_wait_s = default_wait_s #used when the ready time cannot be parsed
+        self.re_exp = re.compile('([a-zA-Z0-9])([0-9]{3})([0-9]{1,2})')
+
+    def start_measurement(self,sensor:Dualband_sensor):
+        '''sends aC! and returns the seconds until the measurement is ready, None if the sensor does not answer'''
+        self.com_interface.write(f'{sensor.id}C!\r\n'.encode('ascii'))
+        response = self.com_interface.read_until(b'\n').replace(b'\x00',b'').decode('ascii',errors='replace').strip()
+        m = self.re_exp.match(response)
+        if m and m.groups()[0] == sensor.id:
+            return float(m.groups()[1])
+        if len(response) == 0:
+            log.error('sensor %s does not answer',sensor.id)
+            count('timeouts','sdi12')
+            return None
+        log.warning('unexpected concurrent measurement response: %s',response)
+        return self.default_wait_s
+
+    def measure(self,sensors:list[Dualband_sensor]) -> dict:
+        '''concurrent measurement of every sensor, returns {sensor:(success,measurement start,measurement end)}'''
+        results = {}
+        ready_queue = []
+        for i,sensor in enumerate(dict.fromkeys(sensors)): #one measurement per address
+            start = time.time()
+            wait_s = self.start_measurement(sensor)
+            if wait_s is None:
+                results[sensor] = (False,start,start)
+            else:
+                heapq.heappush(ready_queue,(time.monotonic()+wait_s,i,sensor,start,start+wait_s))
+        while ready_queue:
+            ready_at,_,sensor,start,end = heapq.heappop(ready_queue)
+            wait_s = ready_at - time.monotonic()
+            if wait_s > 0:
+                time.sleep(wait_s)
+            results[sensor] = (sensor.parse_response(),start,end)
+        return(results)
+
 class MultisensorCart_SDI12():
     def __init__(self,serial_port:'serial.Serial',ndvi_units:list[dict],pri_units:list[dict],rover:reach_rover) -> None:
         self.uplooking_ndvi_sensor = Dualband_sensor(ndvi_units[0]['id'],ndvi_units[0]['position'],ndvi_units[0]['orientation'],serial_port)
         self.uplooking_pri_sensor = Dualband_sensor(pri_units[0]['id'],pri_units[0]['position'],pri_units[0]['orientation'],serial_port)
         self.ndvi_pair_array = [NDVI_pair(Dualband_sensor(unit['id'],unit['position'],unit['orientation'],serial_port),self.uplooking_ndvi_sensor,GPS_receiver=rover) for unit in ndvi_units[1:]]
         self.pri_pair_array = [PRI_pair(Dualband_sensor(unit['id'],unit['position'],unit['orientation'],serial_port),self.uplooking_pri_sensor,GPS_receiver=rover) for unit in pri_units[1:]]
+        pairs = self.ndvi_pair_array + self.pri_pair_array
+        self.sensor_ids = index_sensor_ids(pairs) #sensor_id codes of the values
+        self.values = index_rows(pairs,self.sensor_ids)
 
+    def get_values(self) -> np.ndarray:
+        '''measures every pair and returns self.values, rows of the binary log (index_log(path,self.sensor_ids).extend(values))
+        the same array is filled again by the next call, copy it to keep it'''
+        index_values = [ndvi_pair.get_NDVI() for ndvi_pair in self.ndvi_pair_array] + [pri_pair.get_PRI() for pri_pair in self.pri_pair_array]
+        return(fill_index_rows(self.values,self.ndvi_pair_array+self.pri_pair_array,index_values))
 
-    def get_values(self):
-        ndvi_values = [ndvi_pair.get_NDVI() for ndvi_pair in self.ndvi_pair_array]
-        pri_values = [pri_pair.get_PRI() for pri_pair in self.pri_pair_array]
-
-        ndvi_values = [{'timestamp':ndvi_pair[0].timestamp,
-                        'datetime_iso':ndvi_pair[0].coordinates_with_meta['metadata'][0],
-                        'quality_fix':ndvi_pair[0].coordinates_with_meta['metadata'][1],
-                        'lat':ndvi_pair[0].coordinates_with_meta['coordinates'][0],
-                        'long':ndvi_pair[0].coordinates_with_meta['coordinates'][1],
-                        'alt':ndvi_pair[0].coordinates_with_meta['coordinates'][2],
-                        'position':ndvi_pair[0].downlooking_sensor.position.name.upper(),
-                        'sensor_id':ndvi_pair[0].downlooking_sensor.id,
-                        'type': 'NDVI',	
-                        'index_value': ndvi_pair[1]}
-                        for ndvi_pair in zip(self.ndvi_pair_array,ndvi_values)]
-        pri_values = [{'timestamp':pri_pair[0].timestamp,
-                        'datetime_iso':pri_pair[0].coordinates_with_meta['metadata'][0],
-                        'quality_fix':pri_pair[0].coordinates_with_meta['metadata'][1],
-                        'lat':pri_pair[0].coordinates_with_meta['coordinates'][0],
-                        'long':pri_pair[0].coordinates_with_meta['coordinates'][1],
-                        'alt':pri_pair[0].coordinates_with_meta['coordinates'][2],
-                        'position':pri_pair[0].downlooking_sensor.position.name.upper(),
-                        'sensor_id':pri_pair[0].downlooking_sensor.id,
-                        'type': 'PRI',
-                        'index_value': pri_pair[1]}
-                        for pri_pair in zip(self.pri_pair_array,pri_values)]
-        return(ndvi_values+pri_values)
+def index_sensor_ids(pairs:list[Dualband_sensor_pair]) -> list[str]:
+    '''sensor_id code list of the binary log of pairs'''
+    return list(dict.fromkeys(pair.downlooking_sensor.id for pair in pairs))
+
+def index_rows(pairs:list[Dualband_sensor_pair],sensor_ids:list[str]) -> np.ndarray:
+    '''one IndexRecord row per pair with the sensor_id, sensor_position and type codes filled'''
+    rows = np.zeros(len(pairs),dtype=index_dtype)
+    rows['sensor_id'] = [sensor_ids.index(pair.downlooking_sensor.id) for pair in pairs]
+    rows['sensor_position'] = [position_names.index(pair.downlooking_sensor.position.name.upper()) for pair in pairs]
+    rows['type'] = [index_types.index('PRI' if isinstance(pair,PRI_pair) else 'NDVI') for pair in pairs]
+    return rows
+
+def fill_index_rows(rows:np.ndarray,pairs:list[Dualband_sensor_pair],index_values:list[float]) -> np.ndarray:
+    '''fills the measured columns of index_rows() in place from the last measurement of every pair'''
+    rows['timestamp'] = [pair.timestamp for pair in pairs]
+    rows['datetime_s'] = [pair.coordinates_with_meta.gps_time for pair in pairs]
+    rows['quality_fix'] = [pair.coordinates_with_meta.quality_fix for pair in pairs]
+    rows['latitude'] = [pair.coordinates_with_meta.latitude for pair in pairs]
+    rows['longitude'] = [pair.coordinates_with_meta.longitude for pair in pairs]
+    rows['altitude'] = [pair.coordinates_with_meta.altitude for pair in pairs]
+    rows['index_value'] = index_values
+    return rows
 
 def make_ndvi_pairs(uplooking_sensor:dict,downlooking_sensors:list[dict],serial_if:serial.Serial,gps:reach_rover=None) -> list[NDVI_pair]:
     uplooking = Dualband_sensor(uplooking_sensor['id'],uplooking_sensor['position'],uplooking_sensor['orientation'],serial_if)
@@ -194,23 +266,64 @@ def make_pri_pairs(uplooking_sensor:dict,downlooking_sensors:list[dict],serial_i
     return pri_modules
 
 @threaded
-def log_ndvi_pri(txt_path:Path,ndvi_units:'list[NDVI_pair]',pri_units:list[PRI_pair],stop_event:Event):
+def log_ndvi_pri(txt_path:Path,ndvi_units:'list[NDVI_pair]',pri_units:list[PRI_pair],stop_event:Event,use_bus_scheduler:bool=True,period_s:float=0.0):
+    '''logs ndvi and pri values, with use_bus_scheduler all the sensors measure at the same time (SDI12_bus)
+    otherwise every pair is measured one after the other
+    period_s: measurement period on the acquisition clock, 0 measures again as soon as the sensors answer'''
     stop = stop_event
-    with txt_path.open('w',encoding='utf-8') as f:
-        header = "timestamp,datetime_iso,quality_fix,latitude,longitude,altitude,sensor_id,sensor_position,type,index_value\n"
-        f.write(header)
-        while not stop.is_set():
-            ndvi_values = [ndvi_pair.get_NDVI() for ndvi_pair in ndvi_units]
-            for sensor_pair,ndvi in zip(ndvi_units,ndvi_values):
-                print(f"ID: {sensor_pair.downlooking_sensor.id}, {ndvi}")
-                line = ','.join([f"{sensor_pair.timestamp:.6f},{sensor_pair.coordinates_with_meta['datetime_iso']},{sensor_pair.coordinates_with_meta['quality_fix']}",
-                                    f"{sensor_pair.coordinates_with_meta['latitude']},{sensor_pair.coordinates_with_meta['longitude']},{sensor_pair.coordinates_with_meta['altitude']}",
-                                    f"{sensor_pair.downlooking_sensor.id},{sensor_pair.downlooking_sensor.position.name.upper()},NDVI,{ndvi}"]) + '\n'
-                f.write(line)
-            pri_values = [pri_pair.get_PRI() for pri_pair in pri_units]
-            for sensor_pair,pri in zip(pri_units,pri_values):
-                print(f"ID: {sensor_pair.downlooking_sensor.id}, {pri}")
-                line = ','.join([f"{sensor_pair.timestamp:.6f},{sensor_pair.coordinates_with_meta['datetime_iso']},{sensor_pair.coordinates_with_meta['quality_fix']}",
-                                    f"{sensor_pair.coordinates_with_meta['latitude']},{sensor_pair.coordinates_with_meta['longitude']},{sensor_pair.coordinates_with_meta['altitude']}",
-                                    f"{sensor_pair.downlooking_sensor.id},{sensor_pair.downlooking_sensor.position.name.upper()},PRI,{pri}"]) + '\n'
-                f.write(line)
+    task = acquisition_clock.task('sdi12',period_s)
+    pairs = ndvi_units + pri_units
+    bus = SDI12_bus(pairs[0].downlooking_sensor.com_interface) if use_bus_scheduler and len(pairs) > 0 else None
+    binary = txt_path.suffix == '.h5' #binary columnar log instead of csv
+    sensor_ids = index_sensor_ids(pairs)
+    rows = index_rows(pairs,sensor_ids) #filled again by every pass and copied to the binary log
+    with (index_log(txt_path,sensor_ids) if binary else txt_path.open('w',encoding='utf-8')) as f:
+        if not binary:
+            header = "timestamp,datetime_iso,quality_fix,latitude,longitude,altitude,sensor_id,sensor_position,type,index_value\n"
+            f.write(header)
+        while task.wait(stop):
+            if bus:
+                now = time.time()
+                uplooking = [pair.uplooking_sensor for pair in pairs if pair.uplooking_needs_update(now)]
+                with stage_timer('sdi12','device_read'):
+                    results = bus.measure([pair.downlooking_sensor for pair in pairs] + uplooking)
+                for sensor in dict.fromkeys(uplooking):
+                    success,_,end = results[sensor]
+                    sensor.last_update = end
+                    log.debug('updating uplooking values: %s',sensor.id)
+                    if not success:
+                        log.warning('uplooking values cannot be updated')
+                ndvi_values = [pair.compute_NDVI(pair.set_reflectance_values(*results[pair.downlooking_sensor])) for pair in ndvi_units]
+                pri_values = [pair.compute_PRI(pair.set_reflectance_values(*results[pair.downlooking_sensor])) for pair in pri_units]
+            else:
+                with stage_timer('sdi12','device_read'):
+                    ndvi_values = [ndvi_pair.get_NDVI() for ndvi_pair in ndvi_units]
+                    pri_values = [pri_pair.get_PRI() for pri_pair in pri_units]
+            pass_rows = [(pair,'NDVI',ndvi) for pair,ndvi in zip(ndvi_units,ndvi_values)] + [(pair,'PRI',pri) for pair,pri in zip(pri_units,pri_values)]
+            with stage_timer('sdi12','write'):
+                if binary:
+                    f.extend(fill_index_rows(rows,pairs,ndvi_values+pri_values))
+                for sensor_pair,index_type,index_value in pass_rows:
+                    log.debug('ID: %s, %s',sensor_pair.downlooking_sensor.id,index_value)
+                    if not binary:
+                        write_index_line(f,sensor_pair,index_type,index_value)
+            #the bus scheduler finishes the sensors out of order, the recent rows must be time sorted
+            for sensor_pair,index_type,index_value in sorted(pass_rows,key=lambda row: row[0].timestamp):
+                append_recent_index(sensor_pair,index_type,index_value)
+            count('samples','sdi12',len(ndvi_values)+len(pri_values))
+    log.info(task.summary())
+
+def append_recent_index(sensor_pair:Dualband_sensor_pair,index_type:str,index_value:float):
+    '''rows of a measurement pass must be appended in timestamp order'''
+    coordinates_with_meta = sensor_pair.coordinates_with_meta
+    recent.indices.append((sensor_pair.timestamp,sensor_pair.downlooking_sensor.id,sensor_pair.downlooking_sensor.position.name.upper(),
+                           index_type,index_value,coordinates_with_meta.latitude,coordinates_with_meta.longitude))
+
+def write_index_line(f,sensor_pair:Dualband_sensor_pair,index_type:str,index_value:float):
+    '''csv row of the last measurement of a pair, the binary logs take index_rows() arrays'''
+    coordinates_with_meta = sensor_pair.coordinates_with_meta
+    position = sensor_pair.downlooking_sensor.position.name.upper()
+    line = ','.join([f"{sensor_pair.timestamp:.6f},{coordinates_with_meta.datetime_iso},{coordinates_with_meta.quality_fix}",
+                        f"{coordinates_with_meta.latitude:.9f},{coordinates_with_meta.longitude:.9f},{coordinates_with_meta.altitude:.4f}",
+                        f"{sensor_pair.downlooking_sensor.id},{position},{index_type},{index_value}"]) + '\n'
+    f.write(line)
@@ -0,0 +1,313 @@
+'''
+Simulated devices used to run the acquisition code without the cart hardware.
+Every simulator mimics the subset of the driver API the loggers use and keeps
+the latency of each device call in self.latencies ({stage name: [seconds]}).
+'''
+import socket
+import time
+import numpy as np
+from math import exp
+from collections import defaultdict
+from datetime import datetime, timezone
+from threading import Event, Lock
+from IRR_labjack import units_cc
+from utils import threaded
+
+class _LatencyLog():
+    def __init__(self) -> None:
+        self.latencies = defaultdict(list)
+        self._latency_lock = Lock()
+
+    def _record(self,stage:str,start:float):
+        with self._latency_lock:
+            self.latencies[stage].append(time.perf_counter()-start)
+
+class SimulatedSpectrometer(_LatencyLog):
+    '''Stand-in for seabreeze.spectrometers.Spectrometer (HDX-XR)
+    counts and dark counts grow linearly with the integration time and saturate at 65535,
+    light_level 0 gives dark spectra,
+    intensities() blocks for the integration time like the real device'''
+    def __init__(self,serial_number:str='SIM00001',pixels:int=2068,counts_per_ms:float=800.0,
+                 dark_counts:float=1500.0,dark_counts_per_ms:float=1.5,noise_counts:float=20.0,vegetation:bool=False,time_scale:float=1.0) -> None:
+        super().__init__()
+        self.serial_number = serial_number
+        self.model = 'HDX'
+        self.pixels = pixels
+        self.max_intensity = 65535.0
+        self.integration_time_micros_limits = (6000,10000000)
+        self.light_level = 1.0 #relative illumination, lower it to simulate clouds
+        self.dark_counts = dark_counts
+        self.dark_counts_per_ms = dark_counts_per_ms
+        self.noise_counts = noise_counts
+        self.time_scale = time_scale
+        self._integration_time_us = 100000
+        self._rng = np.random.default_rng()
+        self._wavelengths = np.linspace(187.0,1117.0,pixels)
+        shape = np.exp(-0.5*((self._wavelengths-560.0)/180.0)**2)
+        if vegetation: #red edge, low reflectance in the visible and high in the NIR
+            shape = shape*(0.1 + 0.5/(1+np.exp(-(self._wavelengths-715.0)/12.0)))
+            shape = shape/shape.max()
+        self._counts_per_ms = counts_per_ms*shape
+
+    def wavelengths(self) -> np.ndarray:
+        return self._wavelengths.copy()
+
+    def integration_time_micros(self,integration_time_micros:int):
+        self._integration_time_us = int(integration_time_micros)
+
+    def intensities(self,correct_dark_counts:bool=False,correct_nonlinearity:bool=False) -> np.ndarray:
+        start = time.perf_counter()
+        time.sleep(self._integration_time_us/1e6*self.time_scale)
+        dark = self.dark_counts + self.dark_counts_per_ms*self._integration_time_us/1000
+        counts = dark + self._counts_per_ms*self.light_level*self._integration_time_us/1000
+        counts = counts + self._rng.normal(0.0,self.noise_counts,self.pixels)
+        counts = np.clip(counts,0.0,self.max_intensity)
+        if correct_dark_counts:
+            counts = counts - dark
+        self._record('spectrometer.intensities',start)
+        return counts
+
+    def close(self):
+        pass
+
+def _thermistor_resistance(t_C:float) -> float:
+    '''inverse of the Steinhart-Hart equation used in IRR_labjack.get_temp'''
+    A = 1.129241e-3
+    B = 2.341077e-4
+    C = 8.775468e-8
+    x = (A - 1/(t_C+273.15))/C
+    y = ((B/(3*C))**3 + x**2/4)**0.5
+    return exp(np.cbrt(y - x/2) - np.cbrt(y + x/2))
+
+class SimulatedU6(_LatencyLog):
+    '''Stand-in for u6.U6 wired to an array of Apogee IRR sensors
+    irr_units follows the same dict layout used by IRR_labjack, in the order of the
+    thermistor current loop, thermistor channels report the accumulated voltage of the chain'''
+    #approximate U6-Pro conversion time per channel (ms) for each resolution index
+    conversion_ms = {0:1.7,1:0.05,2:0.07,3:0.1,4:0.15,5:0.25,6:0.45,7:0.9,8:1.7,9:5.0,10:10.0,11:40.0,12:160.0}
+
+    def __init__(self,irr_units:list[dict],body_t_C:float=25.0,target_t_C:float=30.0,noise_mV:float=0.0,
+                 usb_latency_ms:float=1.0,time_scale:float=1.0) -> None:
+        super().__init__()
+        self.irr_units = irr_units
+        self.body_t_C = body_t_C
+        self.target_t_C = target_t_C
+        self.noise_mV = noise_mV
+        self.usb_latency_ms = usb_latency_ms
+        self.time_scale = time_scale
+        self._rng = np.random.default_rng()
+
+    def getCalibrationData(self):
+        return {}
+
+    def close(self):
+        pass
+
+    def channel_mV(self) -> dict:
+        '''voltage (mV) that each analog input would read right now'''
+        fix_resistor = 24900 #ohms
+        thermistor_mV = (_thermistor_resistance(self.body_t_C) + fix_resistor)*0.010
+        voltages = {}
+        for i,irr in enumerate(self.irr_units):
+            cc = units_cc[irr['unit']]
+            t = self.body_t_C
+            m = cc[0]*t**2 + cc[1]*t + cc[2]
+            b = cc[3]*t**2 + cc[4]*t + cc[5]
+            voltages[irr['thermopile_ain']] = ((self.target_t_C+273.5)**4 - (t+273.15)**4 - b)/m
+            voltages[irr['thermistor_ain']] = thermistor_mV*(len(self.irr_units)-i)
+        return voltages
+
+    def getAIN(self,positiveChannel:int,resolutionIndex:int=0,gainIndex:int=0,settlingFactor:int=0,differential:bool=False) -> float:
+        start = time.perf_counter()
+        time.sleep((self.usb_latency_ms + self.conversion_ms.get(resolutionIndex,1.7))/1000*self.time_scale)
+        mV = self.channel_mV().get(positiveChannel,0.0)
+        if self.noise_mV:
+            mV += self._rng.normal(0.0,self.noise_mV)
+        self._record('u6.getAIN',start)
+        return mV/1000
+
+    @staticmethod
+    def _range_V(gainIndex:int) -> float:
+        return 10.0/10**gainIndex #+-10 V at x1 ... +-0.01 V at x1000
+
+    def getFeedback(self,*commandlist) -> list:
+        '''AIN24 commands only, returns the 24 bit bipolar reading of each command in one USB transaction'''
+        commands = commandlist[0] if len(commandlist) == 1 and isinstance(commandlist[0],list) else list(commandlist)
+        if len(commands) > 14:
+            raise ValueError('Feedback packet larger than 64 bytes, split the commands')
+        start = time.perf_counter()
+        time.sleep((self.usb_latency_ms + sum(self.conversion_ms.get(c.resolutionIndex,1.7) for c in commands))/1000*self.time_scale)
+        voltages = self.channel_mV()
+        results = []
+        for command in commands:
+            mV = voltages.get(command.positiveChannel,0.0)
+            if self.noise_mV:
+                mV += self._rng.normal(0.0,self.noise_mV)
+            counts = (mV/1000/self._range_V(command.gainIndex) + 1)*2**23
+            results.append(int(min(max(round(counts),0),2**24-1)))
+        self._record('u6.getFeedback',start)
+        return results
+
+    def binaryToCalibratedAnalogVoltage(self,gainIndex:int,bytesVoltage:int,is16Bits:bool=False,resolutionIndex:int=0) -> float:
+        counts = bytesVoltage if is16Bits else bytesVoltage/256.0
+        return (counts-32768)/32768*self._range_V(gainIndex)
+
+    def streamConfig(self,NumChannels:int=1,ResolutionIndex:int=0,SettlingFactor:int=0,ChannelNumbers:list=[0],ChannelOptions:list=[0],
+                     ScanFrequency:float=None,SamplesPerPacket:int=25,**kwargs):
+        self.stream_channels = list(ChannelNumbers[:NumChannels])
+        self.stream_scan_rate_hz = ScanFrequency
+        self.samples_per_packet = SamplesPerPacket
+        self.packetsPerRequest = 10
+
+    def streamStart(self):
+        self.streamStarted = True
+        self._stream_start = time.perf_counter()
+
+    def streamStop(self):
+        self.streamStarted = False
+
+    def streamData(self,convert:bool=True):
+        '''yields one dict per USB read like u6.U6.streamData ({'AINn':[volts,...],'errors','missed',...}),
+        paced by the scan rate, whole scans only'''
+        scans_per_request = max(1,self.samples_per_packet*self.packetsPerRequest//len(self.stream_channels))
+        scans = 0
+        while self.streamStarted:
+            ready_at = self._stream_start + (scans+scans_per_request)/self.stream_scan_rate_hz*self.time_scale
+            time.sleep(max(0.0,ready_at-time.perf_counter()))
+            start = time.perf_counter()
+            voltages = self.channel_mV()
+            packet = {'errors':0,'missed':0,'numPackets':self.packetsPerRequest,'firstPacket':0,'result':None}
+            for channel in self.stream_channels:
+                mV = np.full(scans_per_request,voltages.get(channel,0.0))
+                if self.noise_mV:
+                    mV += self._rng.normal(0.0,self.noise_mV,scans_per_request)
+                packet[f'AIN{channel}'] = (mV/1000).tolist()
+            scans += scans_per_request
+            self._record('u6.streamData',start)
+            yield packet
+
+class SimulatedSDI12Serial(_LatencyLog):
+    '''Stand-in for the serial.Serial port of the Tekbox SDI-12 interface
+    answers aC! with atttnn and aD0! with the two band values of the addressed sensor,
+    each byte on the bus takes char_time_s (1200 baud, 10 bits per character)'''
+    def __init__(self,sensors:dict,measurement_time_s:float=0.8,char_time_s:float=1/120,timeout:float=5) -> None:
+        super().__init__()
+        self.sensors = sensors #{address:(lower_band,upper_band)}
+        self.measurement_time_s = measurement_time_s
+        self.char_time_s = char_time_s
+        self.timeout = timeout
+        self.baudrate = 19200
+        self.port = 'SIM'
+        self.is_open = True
+        self._ready_at = {}
+        self._pending = bytearray()
+        self._write_time = None
+        self._lock = Lock()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._pending.clear()
+
+    @property
+    def in_waiting(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _answer(self,command:str) -> str:
+        address = command[0]
+        if address not in self.sensors:
+            return ''
+        if command[1:] == 'C!':
+            self._ready_at[address] = time.monotonic() + self.measurement_time_s
+            ttt = int(np.ceil(self.measurement_time_s))
+            return f'{address}{ttt:03d}02\r\n'
+        if command[1:] == 'D0!':
+            ready_at = self._ready_at.pop(address,None)
+            if ready_at is None or time.monotonic() < ready_at: #measurement aborted or never started
+                return f'{address}\r\n'
+            lower,upper = self.sensors[address]
+            return f'{address}{lower:+.4f}{upper:+.4f}\r\n'
+        return ''
+
+    def write(self,data:bytes) -> int:
+        start = time.perf_counter()
+        time.sleep(len(data)*self.char_time_s)
+        with self._lock:
+            self._pending += self._answer(data.decode('ascii').strip()).encode('ascii')
+            self._write_time = start
+        return len(data)
+
+    def read_until(self,expected:bytes=b'\n',size:int=None) -> bytes:
+        with self._lock:
+            end = self._pending.find(expected)
+            if end < 0:
+                response = None
+            else:
+                response = bytes(self._pending[:end+len(expected)])
+                del self._pending[:end+len(expected)]
+        if response is None:
+            time.sleep(self.timeout)
+            with self._lock:
+                response = bytes(self._pending)
+                self._pending.clear()
+        time.sleep(len(response)*self.char_time_s)
+        if self._write_time is not None:
+            self._record('sdi12.transaction',self._write_time)
+            self._write_time = None
+        return response
+
+class SimulatedReachServer():
+    '''Local TCP server that streams LLH solution lines like the Emlid Reach rover'''
+    def __init__(self,host:str='127.0.0.1',port:int=0,rate_hz:float=10.0,latitude:float=19.531,longitude:float=-98.846,
+                 altitude:float=2250.0,speed_m_s:float=1.0,quality_fix:int=1) -> None:
+        self.rate_hz = rate_hz
+        self.latitude = latitude
+        self.longitude = longitude
+        self.altitude = altitude
+        self.speed_m_s = speed_m_s
+        self.quality_fix = quality_fix
+        self.lines_sent = 0
+        self.stop_event = Event()
+        self._server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self._server.bind((host,port))
+        self._server.listen(1)
+        self._server.settimeout(0.2)
+        self.ip,self.port = self._server.getsockname()
+
+    def llh_line(self,t:float) -> str:
+        '''LLH line for time t, the rover moves north at speed_m_s'''
+        timestamp = datetime.fromtimestamp(t,timezone.utc).strftime('%Y/%m/%d %H:%M:%S.%f')[:-3]
+        latitude = self.latitude + self.speed_m_s*t/111320 % 0.01
+        return (f'{timestamp} {latitude:14.9f} {self.longitude:14.9f} {self.altitude:10.4f} {self.quality_fix:3d} 12'
+                '   0.0120   0.0130   0.0250  -0.0010   0.0050  -0.0030   0.00    0.0\n')
+
+    @threaded
+    def serve(self):
+        self.stop_event.clear()
+        while not self.stop_event.is_set():
+            try:
+                client,_ = self._server.accept()
+            except socket.timeout:
+                continue
+            with client:
+                period = 1/self.rate_hz
+                next_t = time.monotonic()
+                while not self.stop_event.is_set():
+                    try:
+                        client.sendall(self.llh_line(time.time()).encode('ascii'))
+                    except OSError:
+                        break
+                    self.lines_sent += 1
+                    next_t += period
+                    time.sleep(max(0.0,next_t-time.monotonic()))
+        self._server.close()
+
+    def stop(self):
+        self.stop_event.set()
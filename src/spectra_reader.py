@@ -0,0 +1,121 @@
+'''
+Chunked reader for the raw spectra sessions written by save_raw_spectra (/spectrometers/<POSITION>/raw)
+yields blocks of frames aligned across spectrometers so files larger than RAM can be processed
+with constant memory. Frames can be filtered by frame index range or timestamp range.
+
+rows of the same frame share the same index since the spectrometers are acquired concurrently,
+sessions written before that used one counter for all the spectrometers and are aligned by row number
+'''
+import numpy as np
+import tables
+from pathlib import Path
+from typing import Iterator
+
+class _TableCursor():
+    '''sequential reader of a raw table sorted by frame index, keeps the rows read past the last request'''
+    def __init__(self,table:tables.Table,start_row:int,block_rows:int) -> None:
+        self.table = table
+        self.next_row = start_row
+        self.block_rows = block_rows
+        self.pending = None
+
+    def read_until(self,last_index:int) -> np.ndarray:
+        '''rows with frame index <= last_index not returned yet'''
+        blocks = []
+        while True:
+            if self.pending is None:
+                if self.next_row >= self.table.nrows:
+                    break
+                self.pending = self.table.read(self.next_row,self.next_row+self.block_rows)
+                self.next_row += len(self.pending)
+            split = np.searchsorted(self.pending['index'],last_index,side='right')
+            blocks.append(self.pending[:split])
+            if split < len(self.pending):
+                self.pending = self.pending[split:]
+                break
+            self.pending = None
+        return np.concatenate(blocks) if len(blocks) > 1 else (blocks[0] if blocks else self.table.read(0,0))
+
+def _first_row(table:tables.Table,field:str,value:float) -> int:
+    '''first row with table[field] >= value, by bisection on the row number (field must be non decreasing)'''
+    low,high = 0,table.nrows
+    while low < high:
+        middle = (low+high)//2
+        if table.read(middle,middle+1,field=field)[0] < value:
+            low = middle+1
+        else:
+            high = middle
+    return low
+
+class SpectraSession():
+    '''Read only view of a raw spectra session
+    positions: spectrometer group names, UPLOOKING first then the downlooking positions
+    h5_file: session path, or a file already open (it is not closed by the session)'''
+    def __init__(self,h5_file:Path|tables.File) -> None:
+        self._owns_file = not isinstance(h5_file,tables.File)
+        self.file = tables.open_file(h5_file,'r') if self._owns_file else h5_file
+        self.tables = {group._v_name:group.raw for group in self.file.root.spectrometers._f_iter_nodes('Group') if 'raw' in group}
+        self.positions = sorted(self.tables,key=lambda position: position != 'UPLOOKING')
+        first_indexes = {int(table.read(0,1,field='index')[0]) for table in self.tables.values() if table.nrows > 0}
+        self.aligned_by_index = len(first_indexes) <= 1
+
+    def wavelengths(self,position:str) -> np.ndarray:
+        return self.file.get_node(self.file.root.spectrometers,position).wavelengths.read()
+
+    def nrows(self,position:str) -> int:
+        return self.tables[position].nrows
+
+    def chunks(self,positions:list[str]=None,chunk_rows:int=1024,index_range:tuple[int,int]=None,time_range:tuple[float,float]=None) -> Iterator[tuple[np.ndarray,dict]]:
+        '''Yields (frame indexes,{position:rows}) blocks of at most chunk_rows frames present in every position
+        index_range: [start,stop) frame indexes, time_range: [start,stop) timestamps of the first position'''
+        positions = positions or self.positions
+        tables_list = [self.tables[position] for position in positions]
+        if self.aligned_by_index:
+            yield from self._index_chunks(positions,tables_list,chunk_rows,index_range,time_range)
+        else:
+            yield from self._row_chunks(positions,tables_list,chunk_rows,index_range,time_range)
+
+    def _index_chunks(self,positions,tables_list,chunk_rows,index_range,time_range):
+        reference = tables_list[0]
+        start_row,stop_row = 0,reference.nrows
+        if index_range is not None:
+            start_row = max(start_row,_first_row(reference,'index',index_range[0]))
+            stop_row = min(stop_row,_first_row(reference,'index',index_range[1]))
+        if time_range is not None:
+            start_row = max(start_row,_first_row(reference,'timestamp',time_range[0]))
+            stop_row = min(stop_row,_first_row(reference,'timestamp',time_range[1]))
+        if start_row >= stop_row:
+            return
+        first_index = reference.read(start_row,start_row+1,field='index')[0]
+        cursors = [_TableCursor(table,_first_row(table,'index',first_index),chunk_rows) for table in tables_list[1:]]
+        for start in range(start_row,stop_row,chunk_rows):
+            reference_rows = reference.read(start,min(start+chunk_rows,stop_row))
+            blocks = [reference_rows]+[cursor.read_until(reference_rows['index'][-1]) for cursor in cursors]
+            index = reference_rows['index']
+            for block in blocks[1:]:
+                index = np.intersect1d(index,block['index'])
+            if len(index) == 0:
+                continue
+            yield index,{position:block[np.isin(block['index'],index)] for position,block in zip(positions,blocks)}
+
+    def _row_chunks(self,positions,tables_list,chunk_rows,index_range,time_range):
+        reference = tables_list[0]
+        start_row,stop_row = 0,min(table.nrows for table in tables_list)
+        if index_range is not None:
+            start_row,stop_row = max(start_row,index_range[0]),min(stop_row,index_range[1])
+        if time_range is not None:
+            start_row = max(start_row,_first_row(reference,'timestamp',time_range[0]))
+            stop_row = min(stop_row,_first_row(reference,'timestamp',time_range[1]))
+        for start in range(start_row,stop_row,chunk_rows):
+            stop = min(start+chunk_rows,stop_row)
+            yield np.arange(start,stop),{position:table.read(start,stop) for position,table in zip(positions,tables_list)}
+
+    def close(self):
+        if self._owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
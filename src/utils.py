@@ -1,7 +1,8 @@
+import os
 from enum import Enum,auto
 from pathlib import Path
-from threading import Thread
-from datetime import datetime
+from threading import Thread,get_ident
+from datetime import datetime,timezone
 
 
 class SensorPosition(Enum):
@@ -15,6 +16,10 @@ class SensorOrientation(Enum):
     DOWNLOOKING = auto()
     UNDEFINED = auto()
 
+def naive_seconds(timestamp:float) -> float:
+    '''host timestamp as the seconds of its local date and time read as UTC, the datetime_s of a row without GPS'''
+    return datetime.fromtimestamp(timestamp).replace(tzinfo=timezone.utc).timestamp()
+
 def threaded(fn):
     def wrapper(*args, **kwargs):
         thread = Thread(target=fn,daemon=False, args=args, kwargs=kwargs)
@@ -22,27 +27,52 @@ def threaded(fn):
         return thread
     return wrapper
 
+counter_file_name = '.file_counter'
+#outputs written next to the temperature logs, by reprocess_temperatures and merge_sessions
+temperature_suffix = '_reprocessed'
+merged_suffix = '_merged'
+
+def _last_file_number(folder:Path) -> int:
+    """Highest consecutive number of the files in folder, only used once to seed the folder counter"""
+    prefix = folder.name + '_'
+    numbers = [int(f.stem[len(prefix):]) for f in folder.iterdir() if f.stem.startswith(prefix) and f.stem[len(prefix):].isdigit()]
+    return max(numbers,default=0)
+
+def _write_counter(counter_path:Path,number:int):
+    temporary_path = counter_path.with_name(f'{counter_path.name}.{os.getpid()}.{get_ident()}')
+    temporary_path.write_text(str(number))
+    os.replace(temporary_path,counter_path) #atomic, readers never see a partial value
+
 def get_unique_filepath_from_path(folder:Path,file_extension:str='.txt') -> Path:
-    """_summary_
+    """Allocates the next consecutive file path of the folder: [folder name] _ [number] [extension]
+
+    The last number is kept in a counter file in the folder so the allocation does not depend
+    on the number of files already there. The file is created empty (exclusive create) before
+    returning, so loggers starting at the same time, even from different processes, never get
+    the same path. Numbers use at least 3 digits and grow wider past 999.
 
     Args:
-        folder (Path): _description_
-        file_extension (str, optional): _description_. Defaults to '.txt'.
+        folder (Path): folder of the files, it must exist
+        file_extension (str, optional): Defaults to '.txt'.
 
     Returns:
         Path: Unique file path for the specified folder
     """
-    fill_zeros = 3 #1000 files per folder limitation
-    files  = [f for f in list(folder.glob('*'+file_extension)) if f.name.startswith(folder.name)]
-    if len(files) == 0:
-        new_file_name = folder.name + '_' + str(1).zfill(fill_zeros) + file_extension
-    else:
-        #to do:create a new folder if there are more than 1000 files in the folder
-        files = [f for f in files if f.stem[-fill_zeros:].isdigit()]
-        numbers = [int(f.stem[-fill_zeros:]) for f in files]
-        highest_number = max(numbers)
-        new_file_name = folder.name + '_' + str(highest_number+1).zfill(fill_zeros) + file_extension
-    return(folder / new_file_name)
+    fill_zeros = 3
+    counter_path = folder / counter_file_name
+    try:
+        number = int(counter_path.read_text())
+    except (FileNotFoundError,ValueError):
+        number = _last_file_number(folder)
+    while True:
+        number += 1
+        file_path = folder / (folder.name + '_' + str(number).zfill(fill_zeros) + file_extension)
+        try:
+            file_path.open('x').close()
+        except FileExistsError: #taken by another logger or written before the counter existed
+            continue
+        _write_counter(counter_path,number)
+        return(file_path)
 
 def get_unique_filepath_from_string(root_path:Path,trial:str,folder_content:str,file_ext:str='.txt') -> Path:
     """Returns a unique file path in the asigned folder